@@ -11,15 +11,25 @@ import json
 import logging
 import time
 import threading
+import queue
+import itertools
+import copy
+import bisect
 import uuid as _uuid
 import requests
+from requests.adapters import HTTPAdapter
 import re
 import base64
 import hmac
 import hashlib
+import sqlite3
+import atexit
 import subprocess
 import glob
 import platform
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from types import MappingProxyType
 from datetime import datetime
 from urllib.request import urlopen, Request
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -28,6 +38,11 @@ from FunPayAPI import types
 from FunPayAPI.common.enums import SubCategoryTypes, Currency, MessageTypes
 from FunPayAPI.updater.events import NewMessageEvent, NewOrderEvent
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = logging.getLogger("FPC.AutoSteam")
 LOGGER_PREFIX = "[AutoSteam]"
 
@@ -52,11 +67,29 @@ LICENSE_OK = False
 _cardinal_instance: "Cardinal | None" = None
 
 def _on_delete_plugin(cardinal: "Cardinal") -> None:
-    pass
+    if _storage is not None:
+        _storage.flush()
 
 BIND_TO_DELETE = _on_delete_plugin
 
 PLUGIN_STORAGE_DIR = os.path.join("storage", "autosteam")
+SYNC_MAX_WORKERS = 25
+PRICE_SYNC_FX_TOLERANCE = float(os.getenv("AS_PRICE_SYNC_FX_TOLERANCE", "0.005"))
+PRICE_SYNC_FULL_INTERVAL = int(os.getenv("AS_PRICE_SYNC_FULL_INTERVAL", "3600"))
+LOT_FIELDS_MAX_AGE = int(os.getenv("AS_LOT_FIELDS_MAX_AGE", "1800"))
+PRICE_SYNC_WRITES_PER_MINUTE = int(os.getenv("AS_PRICE_SYNC_WRITES_PER_MINUTE", "30"))
+PRICE_SYNC_PLAN_TTL = int(os.getenv("AS_PRICE_SYNC_PLAN_TTL", "300"))
+PACKAGE_PIN_TTL = int(os.getenv("AS_PACKAGE_PIN_TTL", "1800"))
+BALANCE_MAX_AGE = int(os.getenv("AS_BALANCE_MAX_AGE", "60"))
+LOT_STATE_WORKERS = int(os.getenv("AS_LOT_STATE_WORKERS", "8"))
+LOT_STATE_RATE = float(os.getenv("AS_LOT_STATE_RATE", "5"))
+ORDER_WORKERS = int(os.getenv("AS_ORDER_WORKERS", "6"))
+ORDER_QUEUE_MAX = int(os.getenv("AS_ORDER_QUEUE_MAX", "500"))
+ORDER_STAGE_LIMITS = {
+    "chat": 3,
+    "catalog": 4,
+    "gift": 2
+}
 
 CB_OPEN_MAIN = "AS_MAIN"
 CB_TOGGLE_ACTIVE = "AS_TOGGLE_ACTIVE"
@@ -66,6 +99,7 @@ CB_OPEN_TEMPLATES = "AS_TEMPLATES"
 CB_OPEN_BALANCE = "AS_BALANCE"
 CB_AUTO_LIST_ALL = "AS_AUTO_LIST_ALL"
 CB_MANUAL_SYNC = "AS_MANUAL_SYNC"
+CB_SYNC_PLAN_APPLY = "AS_SYNC_PLAN_APPLY"
 CB_BACK = "AS_BACK"
 CB_CANCEL = "AS_CANCEL"
 CB_TEST_PURCHASE = "AS_TEST_PURCHASE"
@@ -85,19 +119,155 @@ STATE_EDIT_TEMPLATE_SUCCESS_STEAM = "AS_EDIT_TEMPLATE_SUCCESS_STEAM"
 STATE_EDIT_TEMPLATE_SUCCESS_MOBILE = "AS_EDIT_TEMPLATE_SUCCESS_MOBILE"
 STATE_SET_MARKUP = "AS_SET_MARKUP"
 STATE_SET_BALANCE_THRESHOLD = "AS_SET_BALANCE_THRESHOLD"
+STATE_SET_FORECAST_HORIZON = "AS_SET_FORECAST_HORIZON"
 STATE_SEARCH_GAMES = "AS_SEARCH_GAMES"
 
+def _freeze(value):
+    """Неизменяемая копия JSON-данных: словари - MappingProxyType, списки - кортежи"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    """Изменяемая копия данных, замороженных _freeze"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_thaw(item) for item in value]
+    return value
+
+
+class LotDescriptionMatcher:
+    """Сопоставление описаний лотов с названиями из конфига за один проход по описанию"""
+    
+    def __init__(self, lots_config):
+        self.names: list[str] = []
+        self.configs: list[MappingProxyType] = []
+        self.exact: dict[str, MappingProxyType] = {}
+        for config in lots_config:
+            if not isinstance(config, dict):
+                continue
+            name = str(config.get("lot_name", "")).strip().lower()
+            if not name:
+                continue
+            config = _freeze(config)
+            self.exact.setdefault(name, config)
+            self.names.append(name)
+            self.configs.append(config)
+        
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[tuple] = [()]
+        for index, name in enumerate(self.names):
+            node = 0
+            for char in name:
+                child = self._goto[node].get(char)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][char] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                node = child
+            self._out[node] += (index,)
+        
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for char, child in self._goto[node].items():
+                pending.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[child] = fail if fail != child else 0
+                self._out[child] += self._out[self._fail[child]]
+        
+        self._joined = "\x00".join(self.names)
+        self._starts = list(itertools.accumulate((len(name) + 1 for name in self.names[:-1]), initial=0))
+    
+    def _contained(self, text: str) -> set[int]:
+        """Названия из конфига, которые входят в text"""
+        found = set()
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+    
+    def _containing(self, text: str) -> set[int]:
+        """Названия из конфига, в которые входит text"""
+        found = set()
+        if not text or "\x00" in text:
+            return found
+        position = self._joined.find(text)
+        while position != -1:
+            index = bisect.bisect_right(self._starts, position) - 1
+            found.add(index)
+            if index + 1 >= len(self._starts):
+                break
+            position = self._joined.find(text, self._starts[index + 1])
+        return found
+    
+    def find_exact(self, lot_name: str) -> MappingProxyType | None:
+        return self.exact.get(lot_name.lower().strip())
+    
+    def is_known(self, description: str) -> bool:
+        """Совпадает ли описание с каким-либо лотом из конфига (равенство или вхождение в любую сторону)"""
+        text = description.lower().strip()
+        if not text:
+            return False
+        return text in self.exact or bool(self._containing(text)) or bool(self._contained(text))
+    
+    def partial_matches(self, description: str) -> list[dict]:
+        """Копии конфигов, название которых входит в описание или содержит его, в порядке конфига"""
+        text = description.lower().strip()
+        if not text:
+            return []
+        return [_thaw(self.configs[index]) for index in sorted(self._contained(text) | self._containing(text))]
+
+
 class Storage:
+    CACHE_REVALIDATE_INTERVAL = 1.0
+    WRITE_BEHIND_DELAY = float(os.getenv("AS_WRITE_BEHIND_DELAY", "0.5"))
+    
     def __init__(self, base_dir: str):
         self.base_dir = base_dir
         self.settings_path = os.path.join(base_dir, "settings.json")
         self.games_path = os.path.join(base_dir, "games.json")
         self.templates_path = os.path.join(base_dir, "templates.json")
         self.orders_path = os.path.join(base_dir, "orders.json")
+        self.orders_journal_path = os.path.join(base_dir, "orders.jsonl")
         self.black_list_path = os.path.join(base_dir, "black_list.json")
         self.lots_config_path = os.path.join(base_dir, "lots_config.json")
+        self.bindings_path = os.path.join(base_dir, "bindings.json")
+        self.exchange_rates_path = os.path.join(base_dir, "exchange_rates.json")
+        self._orders_lock = threading.Lock()
+        self._orders_index: list[dict] | None = None
+        self._orders_by_id: dict[str, int] = {}
+        self._cache: dict[str, dict] = {}
+        self._cache_generation: dict[str, int] = {}
+        self._cache_lock = threading.Lock()
+        self._lot_matcher: LotDescriptionMatcher | None = None
+        self._lot_matcher_source: list | None = None
+        self._views: dict[str, tuple] = {}
+        self._black_list_set: frozenset = frozenset()
+        self._black_list_set_source: list | None = None
+        self._pending_writes: dict[str, str] = {}
+        self._pending_writes_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer: threading.Timer | None = None
         self._ensure_dirs()
         self._init_files()
+        self._init_orders_journal()
+        atexit.register(self.flush)
     
     def _ensure_dirs(self) -> None:
         if not os.path.exists(self.base_dir):
@@ -115,7 +285,16 @@ class Storage:
             "warning_sent": False,
             "warning_time": None,
             "deactivated_lots": [],
+            "forecast_enabled": False,
+            "forecast_horizon_hours": 2.0,
+            "forecast_deactivated_lots": [],
+            "forecast_warning_sent": False,
             "auto_markup_enabled": True,
+            "incremental_sync": True,
+            "reprice_abs_deadband": 1.0,
+            "reprice_pct_deadband": 1.0,
+            "reprice_lower_threshold_pct": 3.0,
+            "reprice_write_budget": 20,
             "blacklist_enabled": True
         })
         self._init_file(self.games_path, [])
@@ -127,60 +306,302 @@ class Storage:
             "success_steam_template": "✅ Подарок успешно отправлен!\n\n🎮 Игра: {game_name}\n🌍 Регион: {region_name}\n🆔 Transaction ID: {transaction_id}\n📊 Статус: {status}\n\n{order_link}🙏 Спасибо за покупку! Приятной игры!\n\n{admin_call_message}",
             "success_mobile_template": "✅ Пополнение успешно отправлено!\n\n🎮 Игра: {game_name}\n💎 Позиция: {position_name}\n{field_labels}{server_text}🆔 Transaction ID: {transaction_id}\n📊 Статус: {status}\n\n{order_link}🙏 Спасибо за покупку! Приятной игры!{admin_call_message}"
         })
-        self._init_file(self.orders_path, [])
         self._init_file(self.black_list_path, [])
         self._init_file(self.lots_config_path, [])
+        self._init_file(self.bindings_path, {})
+        self._init_file(self.exchange_rates_path, {})
     
     def _init_file(self, path: str, default_value: any) -> None:
         if not os.path.exists(path):
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(default_value, f, ensure_ascii=False, indent=2)
+            self._write_atomic(path, json.dumps(default_value, ensure_ascii=False, indent=2))
+    
+    @staticmethod
+    def _write_atomic(path: str, content: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
     
     def _load(self, path: str) -> any:
+        with self._pending_writes_lock:
+            content = self._pending_writes.get(path)
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                if not content:
-                    return {}
-                return json.loads(content)
+            if content is None:
+                with open(path, "r", encoding="utf-8") as f:
+                    content = f.read()
+            content = content.strip()
+            if not content:
+                return {}
+            return json.loads(content)
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка загрузки {path}: {e}")
             return {}
     
     def _save(self, path: str, data: any) -> None:
+        """Ставит запись в очередь: серия сохранений одного файла сливается в одну запись на диск"""
         try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            content = json.dumps(data, ensure_ascii=False, indent=2)
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка сохранения {path}: {e}")
+            return
+        with self._pending_writes_lock:
+            self._pending_writes[path] = content
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.WRITE_BEHIND_DELAY, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        self._invalidate(path)
+    
+    def flush(self) -> None:
+        """Записывает на диск все отложенные сохранения"""
+        with self._flush_lock:
+            with self._pending_writes_lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                pending = dict(self._pending_writes)
+            for path, content in pending.items():
+                try:
+                    self._write_atomic(path, content)
+                except Exception as e:
+                    logger.error(f"{LOGGER_PREFIX} Ошибка сохранения {path}: {e}")
+                    continue
+                with self._pending_writes_lock:
+                    if self._pending_writes.get(path) is content:
+                        del self._pending_writes[path]
     
-    def load_settings(self) -> dict:
+    def _cache_signature(self, path: str) -> tuple | None:
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+    
+    def _cached(self, path: str, reader) -> any:
+        """Возвращает разобранное содержимое из памяти, перечитывая его только при изменении"""
+        now = time.monotonic()
+        with self._cache_lock:
+            generation = self._cache_generation.get(path, 0)
+            entry = self._cache.get(path)
+            if entry is not None and entry["generation"] == generation \
+                    and now - entry["checked_at"] < self.CACHE_REVALIDATE_INTERVAL:
+                return entry["data"]
+        signature = self._cache_signature(path)
+        with self._cache_lock:
+            entry = self._cache.get(path)
+            if entry is not None and entry["generation"] == generation and entry["signature"] == signature:
+                entry["checked_at"] = now
+                return entry["data"]
+        data = reader()
+        with self._cache_lock:
+            if self._cache_generation.get(path, 0) == generation:
+                self._cache[path] = {"data": data, "signature": signature, "generation": generation, "checked_at": now}
+        return data
+    
+    def _view(self, path: str, reader) -> any:
+        """Замороженное (_freeze) содержимое из кэша, пересобирается только при изменении файла"""
+        data = self._cached(path, reader)
+        with self._cache_lock:
+            source, view = self._views.get(path, (None, None))
+            if source is not data:
+                view = _freeze(data)
+                self._views[path] = (data, view)
+            return view
+    
+    def _invalidate(self, path: str) -> None:
+        with self._cache_lock:
+            self._cache_generation[path] = self._cache_generation.get(path, 0) + 1
+            self._cache.pop(path, None)
+    
+    def _read_settings(self) -> dict:
         return dict(self._load(self.settings_path))
     
+    def load_settings(self) -> dict:
+        return copy.deepcopy(self._cached(self.settings_path, self._read_settings))
+    
+    def settings_view(self) -> MappingProxyType:
+        """Настройки только для чтения (включая вложенные списки), без копирования на каждый вызов"""
+        return self._view(self.settings_path, self._read_settings)
+    
     def save_settings(self, settings: dict) -> None:
         self._save(self.settings_path, settings)
     
-    def load_games(self) -> list:
+    def _read_games(self) -> list:
         result = self._load(self.games_path)
         return result if isinstance(result, list) else []
     
+    def load_games(self) -> list:
+        return copy.deepcopy(self._cached(self.games_path, self._read_games))
+    
     def save_games(self, games: list) -> None:
         self._save(self.games_path, games)
     
-    def load_templates(self) -> dict:
+    def _read_templates(self) -> dict:
         return dict(self._load(self.templates_path))
     
+    def load_templates(self) -> dict:
+        return dict(self._cached(self.templates_path, self._read_templates))
+    
+    def templates_view(self) -> MappingProxyType:
+        return self._view(self.templates_path, self._read_templates)
+    
     def save_templates(self, templates: dict) -> None:
         self._save(self.templates_path, templates)
     
+    def _init_orders_journal(self) -> None:
+        """Создает журнал заказов, один раз перенося в него старый orders.json"""
+        has_legacy = os.path.exists(self.orders_path)
+        if not os.path.exists(self.orders_journal_path):
+            legacy = self._load(self.orders_path) if has_legacy else []
+            legacy = legacy if isinstance(legacy, list) else []
+            self._write_orders_journal(legacy)
+            if legacy:
+                logger.info(f"{LOGGER_PREFIX} Перенесено заказов в журнал: {len(legacy)}")
+        if has_legacy:
+            # orders.json больше не обновляется - переименовываем, чтобы его не принимали за актуальную историю
+            try:
+                os.replace(self.orders_path, self.orders_path + ".migrated")
+                logger.info(f"{LOGGER_PREFIX} Старый orders.json переименован в orders.json.migrated, заказы хранятся в orders.jsonl")
+            except OSError as e:
+                logger.warning(f"{LOGGER_PREFIX} Не удалось переименовать старый orders.json: {e}")
+    
+    def _write_orders_journal(self, orders: list) -> None:
+        tmp_path = self.orders_journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for order in orders:
+                f.write(json.dumps(order, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.orders_journal_path)
+        self._orders_index = None
+        self._orders_by_id = {}
+    
+    @staticmethod
+    def _order_index_entry(order: dict, offset: int, length: int) -> dict:
+        price = order.get("price")
+        try:
+            price = float(price) if price is not None else None
+        except (ValueError, TypeError):
+            price = None
+        return {
+            "timestamp": order.get("timestamp", 0) or 0,
+            "order_id": str(order.get("order_id", "")),
+            "status": order.get("status"),
+            "type": order.get("type"),
+            "price": price,
+            "lot_name": order.get("lot_name"),
+            "offset": offset,
+            "length": length
+        }
+    
+    def _ensure_orders_index(self) -> list[dict]:
+        if self._orders_index is not None:
+            return self._orders_index
+        index = []
+        by_id = {}
+        offset = 0
+        try:
+            with open(self.orders_journal_path, "rb") as f:
+                for raw in f:
+                    length = len(raw)
+                    line = raw.strip()
+                    if line:
+                        try:
+                            order = json.loads(line.decode("utf-8"))
+                        except Exception:
+                            logger.warning(f"{LOGGER_PREFIX} Пропущена поврежденная запись журнала заказов (offset={offset})")
+                            order = None
+                        if isinstance(order, dict):
+                            entry = self._order_index_entry(order, offset, length)
+                            if entry["order_id"]:
+                                by_id[entry["order_id"]] = len(index)
+                            index.append(entry)
+                    offset += length
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка чтения журнала заказов: {e}")
+        self._orders_index = index
+        self._orders_by_id = by_id
+        return index
+    
+    def _read_orders(self, entries: list[dict]) -> list:
+        result = []
+        if not entries:
+            return result
+        with open(self.orders_journal_path, "rb") as f:
+            for entry in entries:
+                f.seek(entry["offset"])
+                raw = f.read(entry["length"])
+                try:
+                    result.append(json.loads(raw.decode("utf-8")))
+                except Exception:
+                    continue
+        return result
+    
+    def _live_order_entries(self) -> list[dict]:
+        index = self._ensure_orders_index()
+        return [entry for i, entry in enumerate(index)
+                if not entry["order_id"] or self._orders_by_id.get(entry["order_id"]) == i]
+    
+    def append_order(self, order: dict) -> None:
+        """Дописывает заказ в журнал, не перезаписывая историю"""
+        line = (json.dumps(order, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._orders_lock:
+            index = self._ensure_orders_index()
+            with open(self.orders_journal_path, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+                f.flush()
+            entry = self._order_index_entry(order, offset, len(line))
+            if entry["order_id"]:
+                self._orders_by_id[entry["order_id"]] = len(index)
+            index.append(entry)
+            if len(index) - len(self._orders_by_id) > max(100, len(index) // 4):
+                self._compact_orders_locked()
+    
+    def _compact_orders_locked(self) -> None:
+        orders = self._read_orders(self._live_order_entries())
+        self._write_orders_journal(orders)
+        logger.info(f"{LOGGER_PREFIX} Журнал заказов сжат: {len(orders)} записей")
+    
+    def compact_orders(self) -> None:
+        with self._orders_lock:
+            self._compact_orders_locked()
+    
+    def load_order_index(self, status: str | None = None, since: float | None = None) -> list[dict]:
+        """Возвращает краткие записи индекса заказов (timestamp, order_id, status, type, price, lot_name)"""
+        with self._orders_lock:
+            entries = self._live_order_entries()
+        return [dict(entry) for entry in entries
+                if (status is None or entry["status"] == status)
+                and (since is None or entry["timestamp"] >= since)]
+    
+    def load_orders_page(self, page: int, page_size: int) -> tuple[list, int]:
+        """Возвращает страницу заказов (новые сначала) и общее количество"""
+        with self._orders_lock:
+            entries = sorted(self._live_order_entries(), key=lambda x: x["timestamp"], reverse=True)
+            page_entries = entries[page * page_size:(page + 1) * page_size]
+            return self._read_orders(page_entries), len(entries)
+    
     def load_orders(self) -> list:
-        result = self._load(self.orders_path)
-        return result if isinstance(result, list) else []
+        with self._orders_lock:
+            return self._read_orders(self._live_order_entries())
     
     def save_orders(self, orders: list) -> None:
-        self._save(self.orders_path, orders)
+        with self._orders_lock:
+            self._write_orders_journal(orders)
     
-    def load_black_list(self) -> list:
+    def _read_black_list(self) -> list:
         result = self._load(self.black_list_path)
         if isinstance(result, list):
             if result and isinstance(result[0], dict):
@@ -188,15 +609,307 @@ class Storage:
             return result
         return []
     
+    def load_black_list(self) -> list:
+        return list(self._cached(self.black_list_path, self._read_black_list))
+    
     def save_black_list(self, black_list: list) -> None:
         self._save(self.black_list_path, black_list)
     
-    def load_lots_config(self) -> list:
+    def is_blacklisted(self, username: str) -> bool:
+        black_list = self._cached(self.black_list_path, self._read_black_list)
+        with self._cache_lock:
+            if self._black_list_set_source is not black_list:
+                self._black_list_set = frozenset(str(item).lower().strip() for item in black_list)
+                self._black_list_set_source = black_list
+            black_list_set = self._black_list_set
+        return username.lower().strip() in black_list_set
+    
+    def _read_lots_config(self) -> list:
         result = self._load(self.lots_config_path)
         return result if isinstance(result, list) else []
     
+    def load_lots_config(self) -> list:
+        return copy.deepcopy(self._cached(self.lots_config_path, self._read_lots_config))
+    
+    def lots_config_view(self) -> tuple:
+        """Конфиги лотов только для чтения (кортеж MappingProxyType), без копирования на каждый вызов"""
+        return self._view(self.lots_config_path, self._read_lots_config)
+    
     def save_lots_config(self, lots_config: list) -> None:
         self._save(self.lots_config_path, lots_config)
+    
+    def lot_matcher(self) -> LotDescriptionMatcher:
+        """Матчер описаний лотов, пересобирается только при изменении конфига лотов"""
+        lots_config = self._cached(self.lots_config_path, self._read_lots_config)
+        with self._cache_lock:
+            if self._lot_matcher_source is not lots_config:
+                self._lot_matcher = LotDescriptionMatcher(lots_config)
+                self._lot_matcher_source = lots_config
+            return self._lot_matcher
+    
+    def find_lot_config(self, lot_name: str) -> dict | None:
+        config = self.lot_matcher().find_exact(lot_name)
+        return _thaw(config) if config is not None else None
+    
+    def _read_bindings(self) -> dict:
+        result = self._load(self.bindings_path)
+        return result if isinstance(result, dict) else {}
+    
+    def load_bindings(self) -> dict:
+        return copy.deepcopy(self._cached(self.bindings_path, self._read_bindings))
+    
+    def save_bindings(self, bindings: dict) -> None:
+        self._save(self.bindings_path, bindings)
+    
+    def _read_exchange_rates(self) -> dict:
+        result = self._load(self.exchange_rates_path)
+        return result if isinstance(result, dict) else {}
+    
+    def load_exchange_rates(self) -> dict:
+        return copy.deepcopy(self._cached(self.exchange_rates_path, self._read_exchange_rates))
+    
+    def save_exchange_rates(self, snapshot: dict) -> None:
+        self._save(self.exchange_rates_path, snapshot)
+
+
+class SQLiteStorage(Storage):
+    """Хранилище на SQLite (WAL) с тем же API, что и JSON-хранилище"""
+    
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS lots_config (position INTEGER PRIMARY KEY, lot_name_lower TEXT NOT NULL, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_lots_config_lot_name ON lots_config (lot_name_lower)",
+        "CREATE TABLE IF NOT EXISTS blacklist (username_lower TEXT PRIMARY KEY, username TEXT NOT NULL, position INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, order_id TEXT, timestamp REAL NOT NULL DEFAULT 0, "
+        "status TEXT, type TEXT, price REAL, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_timestamp ON orders (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_order_id ON orders (order_id)"
+    ]
+    
+    def __init__(self, base_dir: str):
+        super().__init__(base_dir)
+        self.db_path = os.path.join(base_dir, "autosteam.db")
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._db_lock:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+        self._migrate_from_json()
+    
+    @staticmethod
+    def _encode(value: any) -> str:
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+    
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+    
+    @contextmanager
+    def _transaction(self):
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    def _migrate_from_json(self) -> None:
+        if self._execute("SELECT 1 FROM meta WHERE key = 'migrated'"):
+            return
+        logger.info(f"{LOGGER_PREFIX} Перенос данных из JSON в SQLite...")
+        self.save_settings(Storage._read_settings(self))
+        self.save_games(Storage._read_games(self))
+        self.save_templates(Storage._read_templates(self))
+        self.save_black_list(Storage._read_black_list(self))
+        self.save_lots_config(Storage._read_lots_config(self))
+        self.save_bindings(Storage._read_bindings(self))
+        self.save_exchange_rates(Storage._read_exchange_rates(self))
+        self.save_orders(Storage.load_orders(self))
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+        logger.info(f"{LOGGER_PREFIX} Перенос данных в SQLite завершен")
+    
+    def _load_document(self, name: str, default: any) -> any:
+        rows = self._execute("SELECT value FROM documents WHERE name = ?", (name,))
+        if not rows:
+            return default
+        try:
+            return json.loads(rows[0][0])
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка загрузки {name} из SQLite: {e}")
+            return default
+    
+    def _save_document(self, name: str, value: any, path: str) -> None:
+        try:
+            self._execute("INSERT OR REPLACE INTO documents (name, value) VALUES (?, ?)", (name, self._encode(value)))
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения {name} в SQLite: {e}")
+        finally:
+            self._invalidate(path)
+    
+    def _cache_signature(self, path: str) -> tuple | None:
+        # Единственный писатель в базу - этот процесс, достаточно счетчика поколений
+        return None
+    
+    def _read_settings(self) -> dict:
+        result = {}
+        for key, value in self._execute("SELECT key, value FROM settings"):
+            try:
+                result[key] = json.loads(value)
+            except Exception:
+                continue
+        return result
+    
+    def save_settings(self, settings: dict) -> None:
+        try:
+            with self._transaction() as conn:
+                existing = dict(conn.execute("SELECT key, value FROM settings").fetchall())
+                for key, value in settings.items():
+                    encoded = self._encode(value)
+                    if existing.get(key) != encoded:
+                        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, encoded))
+                for key in existing.keys() - settings.keys():
+                    conn.execute("DELETE FROM settings WHERE key = ?", (key,))
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения настроек в SQLite: {e}")
+        finally:
+            self._invalidate(self.settings_path)
+    
+    def _read_games(self) -> list:
+        result = self._load_document("games", [])
+        return result if isinstance(result, list) else []
+    
+    def save_games(self, games: list) -> None:
+        self._save_document("games", games, self.games_path)
+    
+    def _read_templates(self) -> dict:
+        return dict(self._load_document("templates", {}))
+    
+    def save_templates(self, templates: dict) -> None:
+        self._save_document("templates", templates, self.templates_path)
+    
+    def _read_bindings(self) -> dict:
+        result = self._load_document("bindings", {})
+        return result if isinstance(result, dict) else {}
+    
+    def save_bindings(self, bindings: dict) -> None:
+        self._save_document("bindings", bindings, self.bindings_path)
+    
+    def _read_exchange_rates(self) -> dict:
+        result = self._load_document("exchange_rates", {})
+        return result if isinstance(result, dict) else {}
+    
+    def save_exchange_rates(self, snapshot: dict) -> None:
+        self._save_document("exchange_rates", snapshot, self.exchange_rates_path)
+    
+    def _read_black_list(self) -> list:
+        return [row[0] for row in self._execute("SELECT username FROM blacklist ORDER BY position")]
+    
+    def save_black_list(self, black_list: list) -> None:
+        try:
+            with self._transaction() as conn:
+                existing = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT username_lower, username, position FROM blacklist")}
+                wanted = {}
+                for position, username in enumerate(black_list):
+                    if isinstance(username, dict):
+                        username = username.get("value", "")
+                    username = str(username).strip()
+                    if username and username.lower() not in wanted:
+                        wanted[username.lower()] = (username, position)
+                for username_lower, row in wanted.items():
+                    if existing.get(username_lower) != row:
+                        conn.execute("INSERT OR REPLACE INTO blacklist (username_lower, username, position) VALUES (?, ?, ?)",
+                                     (username_lower, row[0], row[1]))
+                for username_lower in existing.keys() - wanted.keys():
+                    conn.execute("DELETE FROM blacklist WHERE username_lower = ?", (username_lower,))
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения черного списка в SQLite: {e}")
+        finally:
+            self._invalidate(self.black_list_path)
+    
+    def _read_lots_config(self) -> list:
+        result = []
+        for (data,) in self._execute("SELECT data FROM lots_config ORDER BY position"):
+            try:
+                result.append(json.loads(data))
+            except Exception:
+                continue
+        return result
+    
+    def save_lots_config(self, lots_config: list) -> None:
+        try:
+            with self._transaction() as conn:
+                existing = dict(conn.execute("SELECT position, data FROM lots_config").fetchall())
+                for position, config in enumerate(lots_config):
+                    encoded = self._encode(config)
+                    if existing.get(position) != encoded:
+                        lot_name_lower = str(config.get("lot_name", "")).strip().lower() if isinstance(config, dict) else ""
+                        conn.execute("INSERT OR REPLACE INTO lots_config (position, lot_name_lower, data) VALUES (?, ?, ?)",
+                                     (position, lot_name_lower, encoded))
+                conn.execute("DELETE FROM lots_config WHERE position >= ?", (len(lots_config),))
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения конфига лотов в SQLite: {e}")
+        finally:
+            self._invalidate(self.lots_config_path)
+    
+    @staticmethod
+    def _order_row(order: dict) -> tuple:
+        price = order.get("price")
+        try:
+            price = float(price) if price is not None else None
+        except (ValueError, TypeError):
+            price = None
+        order_id = order.get("order_id")
+        return (str(order_id) if order_id else None, order.get("timestamp", 0) or 0,
+                order.get("status"), order.get("type"), price, json.dumps(order, ensure_ascii=False))
+    
+    def append_order(self, order: dict) -> None:
+        row = self._order_row(order)
+        with self._transaction() as conn:
+            if row[0]:
+                conn.execute("DELETE FROM orders WHERE order_id = ?", (row[0],))
+            conn.execute("INSERT INTO orders (order_id, timestamp, status, type, price, data) VALUES (?, ?, ?, ?, ?, ?)", row)
+    
+    def compact_orders(self) -> None:
+        self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def load_order_index(self, status: str | None = None, since: float | None = None) -> list[dict]:
+        sql = "SELECT timestamp, order_id, status, type, price, json_extract(data, '$.lot_name') FROM orders WHERE 1=1"
+        params = []
+        if status is not None:
+            sql += " AND status = ?"
+            params.append(status)
+        if since is not None:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        return [
+            {"timestamp": row[0], "order_id": row[1] or "", "status": row[2], "type": row[3], "price": row[4], "lot_name": row[5]}
+            for row in self._execute(sql + " ORDER BY id", tuple(params))
+        ]
+    
+    def load_orders_page(self, page: int, page_size: int) -> tuple[list, int]:
+        total = self._execute("SELECT COUNT(*) FROM orders")[0][0]
+        rows = self._execute("SELECT data FROM orders ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+                             (page_size, page * page_size))
+        return [json.loads(row[0]) for row in rows], total
+    
+    def load_orders(self) -> list:
+        return [json.loads(row[0]) for row in self._execute("SELECT data FROM orders ORDER BY id")]
+    
+    def save_orders(self, orders: list) -> None:
+        try:
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM orders")
+                conn.executemany("INSERT INTO orders (order_id, timestamp, status, type, price, data) VALUES (?, ?, ?, ?, ?, ?)",
+                                 [self._order_row(order) for order in orders if isinstance(order, dict)])
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения заказов в SQLite: {e}")
 
 
 _storage: Storage | None = None
@@ -207,16 +920,41 @@ _desslyhub_games_cache: dict | None = None
 _desslyhub_cache_timestamp: float = 0
 _desslyhub_cache_ttl: int = 3600
 _desslyhub_cache_lock = threading.Lock()
+_desslyhub_catalog_version: str = ""
+_lot_bindings: dict | None = None
+_lot_bindings_lock = threading.Lock()
 _game_app_id_cache: dict[str, int] = {}
 _game_app_id_cache_lock = threading.Lock()
-_exchange_rates_cache: dict | None = None
-_exchange_rates_cache_timestamp: float = 0
-_exchange_rates_cache_ttl: int = 300
-_exchange_rates_cache_lock = threading.Lock()
+_steam_catalog_index: "SteamCatalogIndex" | None = None
+_steam_catalog_index_source: dict | None = None
+_steam_catalog_index_lock = threading.Lock()
+_exchange_rates_service: "ExchangeRatesService" | None = None
+_exchange_rates_service_lock = threading.Lock()
 _mobile_games_cache: list | None = None
 _mobile_games_cache_timestamp: float = 0
 _mobile_games_cache_ttl: int = 3600
 _mobile_games_cache_lock = threading.Lock()
+_steam_game_cache: OrderedDict[int, tuple[float, list]] = OrderedDict()
+_steam_game_cache_ttl: int = 300
+_steam_game_cache_max_size: int = 512
+_steam_game_cache_lock = threading.Lock()
+_steam_game_inflight: dict[int, threading.Event] = {}
+_http_session: requests.Session | None = None
+_price_sync_state: dict = {"upstream": {}, "lots": {}, "last_full_sync": 0.0}
+_price_sync_state_lock = threading.Lock()
+_lot_fields_cache: "LotFieldsCache" | None = None
+_lot_fields_cache_lock = threading.Lock()
+_price_sync_scheduler: "PriceSyncScheduler" | None = None
+_price_sync_scheduler_lock = threading.Lock()
+_price_sync_plan: dict | None = None
+_lot_state_engine: "LotStateEngine" | None = None
+_balance_ledger: "BalanceLedger" | None = None
+_balance_ledger_lock = threading.Lock()
+_balance_monitor_wakeup = threading.Event()
+_burn_rate_forecaster: "BurnRateForecaster" | None = None
+_burn_rate_forecaster_lock = threading.Lock()
+_lot_state_engine_lock = threading.Lock()
+_http_session_lock = threading.Lock()
 _test_purchases: dict[str, dict] = {}
 _previous_balance: float | None = None
 _deactivated_lots_ids: list[int] = []
@@ -224,10 +962,31 @@ _deactivated_lots_ids: list[int] = []
 def _get_storage() -> Storage:
     global _storage
     if _storage is None:
-        _storage = Storage(PLUGIN_STORAGE_DIR)
+        backend = os.getenv("AS_STORAGE_BACKEND", "json").strip().lower()
+        if backend == "sqlite":
+            _storage = SQLiteStorage(PLUGIN_STORAGE_DIR)
+        else:
+            _storage = Storage(PLUGIN_STORAGE_DIR)
     return _storage
 
 
+def _get_http_session() -> requests.Session:
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SYNC_MAX_WORKERS, pool_block=False)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    "Accept-Encoding": "gzip, deflate",
+                    "Connection": "keep-alive"
+                })
+                _http_session = session
+    return _http_session
+
+
 class DesslyHubAPI:
     """Класс-обертка для работы с DesslyHub API"""
     
@@ -250,14 +1009,14 @@ class DesslyHubAPI:
     def _get(self, path: str, **kwargs) -> dict:
         """GET запрос к API"""
         url = f"{self.base_url}{path}"
-        resp = requests.get(url, headers=self.headers, timeout=30, **kwargs)
+        resp = _get_http_session().get(url, headers=self.headers, timeout=30, **kwargs)
         resp.raise_for_status()
         return resp.json()
     
     def _post(self, path: str, json_payload: dict = None, **kwargs) -> dict:
         """POST запрос к API"""
         url = f"{self.base_url}{path}"
-        resp = requests.post(url, headers=self.headers, json=json_payload or {}, timeout=30, **kwargs)
+        resp = _get_http_session().post(url, headers=self.headers, json=json_payload or {}, timeout=30, **kwargs)
         resp.raise_for_status()
         return resp.json()
     
@@ -280,7 +1039,7 @@ class DesslyHubAPI:
         """Получает актуальные курсы валют из внешнего API (Frankfurter)"""
         try:
             url = "https://api.frankfurter.dev/v1/latest?base=USD"
-            response = requests.get(url, timeout=10)
+            response = _get_http_session().get(url, timeout=10)
             response.raise_for_status()
             data = response.json()
             
@@ -302,20 +1061,10 @@ class DesslyHubAPI:
             logger.error(f"{LOGGER_PREFIX} Не удалось получить курсы из внешнего API: {e}")
             return {}
     
-    def get_exchange_rates(self) -> dict:
-        """Получает курсы валют с кэшированием"""
-        global _exchange_rates_cache, _exchange_rates_cache_timestamp, _exchange_rates_cache_lock
-        
-        import time
-        current_time = time.time()
-        
-        with _exchange_rates_cache_lock:
-            if (_exchange_rates_cache is not None and 
-                current_time - _exchange_rates_cache_timestamp < _exchange_rates_cache_ttl):
-                logger.debug(f"{LOGGER_PREFIX} Использован кэш курсов валют")
-                return _exchange_rates_cache.copy()
-        
+    def fetch_exchange_rates(self) -> tuple[dict, str]:
+        """Запрашивает курсы валют у DesslyHub (или внешнего API) и возвращает их вместе с источником"""
         mapped = {}
+        source = "desslyhub"
         
         try:
             data = self._get("/exchange_rates/steam")
@@ -340,30 +1089,27 @@ class DesslyHubAPI:
                     if cur not in mapped or mapped.get(cur, 0) < 10:
                         mapped[cur] = rate
                 mapped["USD"] = 1.0
+                source = "external"
                 logger.info(f"{LOGGER_PREFIX} Используем реальные курсы из внешнего API: {mapped}")
             else:
-                if not mapped.get("RUB") or mapped.get("RUB", 0) < 10:
-                    mapped["RUB"] = 100.0
-                if not mapped.get("UAH") or mapped.get("UAH", 0) < 10:
-                    mapped["UAH"] = 42.0
-                if not mapped.get("KZT") or mapped.get("KZT", 0) < 10:
-                    mapped["KZT"] = 500.0
-                mapped["USD"] = 1.0
+                for cur, rate in ExchangeRatesService.FALLBACK_RATES.items():
+                    if not mapped.get(cur) or (cur != "USD" and mapped.get(cur, 0) < 10):
+                        mapped[cur] = rate
+                source = "fallback"
                 logger.warning(f"{LOGGER_PREFIX} Используем fallback курсы: {mapped}")
         else:
             if "USD" not in mapped:
                 mapped["USD"] = 1.0
             logger.info(f"{LOGGER_PREFIX} Используем курсы из DesslyHub API: {mapped}")
         
-        for cur, rate in self.manual_rates.items():
-            mapped[cur] = rate
-        
-        with _exchange_rates_cache_lock:
-            _exchange_rates_cache = mapped.copy()
-            _exchange_rates_cache_timestamp = current_time
-        
-        logger.info(f"{LOGGER_PREFIX} Финальные курсы валют: {mapped}")
-        return mapped
+        return mapped, source
+    
+    def get_exchange_rates(self) -> dict:
+        """Возвращает курсы валют из общего снимка (без блокировок и сетевых запросов)"""
+        rates = _get_exchange_rates_service().get(self.api_key).rates
+        if self.manual_rates:
+            return MappingProxyType({**rates, **self.manual_rates})
+        return rates
     
     def set_manual_rate(self, currency: str, rate: float):
         """Устанавливает ручной курс валюты"""
@@ -387,7 +1133,7 @@ class DesslyHubAPI:
                 rate = 1.0
         
         usd_amount = float(amount) / float(rate)
-        logger.info(f"{LOGGER_PREFIX} Конвертация: {amount} {clean_cur} = {usd_amount:.2f} USD (курс {rate})")
+        logger.debug(f"{LOGGER_PREFIX} Конвертация: {amount} {clean_cur} = {usd_amount:.2f} USD (курс {rate})")
         return usd_amount
     
     def convert_from_usd(self, usd_amount: float, target_currency: str) -> float | None:
@@ -404,7 +1150,7 @@ class DesslyHubAPI:
             logger.warning(f"{LOGGER_PREFIX} Курс для {clean_cur} не найден в кэше, запрашиваем из внешнего API")
             try:
                 url = f"https://api.frankfurter.dev/v1/latest?base=USD&symbols={clean_cur}"
-                response = requests.get(url, timeout=10)
+                response = _get_http_session().get(url, timeout=10)
                 response.raise_for_status()
                 data = response.json()
                 rate = float(data.get("rates", {}).get(clean_cur, 0))
@@ -453,6 +1199,109 @@ class DesslyHubAPI:
         return last
 
 
+class ExchangeRatesSnapshot:
+    """Неизменяемый снимок курсов валют"""
+    
+    __slots__ = ("rates", "version", "timestamp", "source")
+    
+    def __init__(self, rates: dict, version: int, timestamp: float, source: str):
+        self.rates = MappingProxyType(dict(rates))
+        self.version = version
+        self.timestamp = timestamp
+        self.source = source
+    
+    def age(self) -> float:
+        return time.time() - self.timestamp
+    
+    def to_dict(self) -> dict:
+        return {"rates": dict(self.rates), "version": self.version, "timestamp": self.timestamp, "source": self.source}
+
+
+class ExchangeRatesService:
+    """Общие для процесса курсы валют: фоновое обновление, устаревший снимок отдается до получения нового"""
+    
+    FALLBACK_RATES = {"USD": 1.0, "RUB": 100.0, "UAH": 42.0, "KZT": 500.0}
+    
+    def __init__(self, ttl: int = 300, refresh_interval: int = 240):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._snapshot: ExchangeRatesSnapshot | None = None
+        self._restored = False
+        self._refresh_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+    
+    def _restore(self) -> ExchangeRatesSnapshot | None:
+        self._restored = True
+        try:
+            data = _get_storage().load_exchange_rates()
+            rates = data.get("rates")
+            if isinstance(rates, dict) and rates.get("RUB"):
+                self._snapshot = ExchangeRatesSnapshot(rates, int(data.get("version", 0)),
+                                                       float(data.get("timestamp", 0)), data.get("source", "disk"))
+                logger.info(f"{LOGGER_PREFIX} Восстановлены курсы валют с диска (v{self._snapshot.version}): {rates}")
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} Не удалось восстановить курсы валют с диска: {e}")
+        return self._snapshot
+    
+    def get(self, api_key: str) -> ExchangeRatesSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None and not self._restored:
+            with self._refresh_lock:
+                snapshot = self._snapshot if self._restored else self._restore()
+        if snapshot is None:
+            return self.refresh(api_key)
+        if snapshot.age() >= self.ttl and not self._refresh_lock.locked():
+            threading.Thread(target=self.refresh, args=(api_key, False), daemon=True).start()
+        return snapshot
+    
+    def refresh(self, api_key: str, wait: bool = True, force: bool = False) -> ExchangeRatesSnapshot | None:
+        if not self._refresh_lock.acquire(blocking=wait):
+            return self._snapshot
+        try:
+            current = self._snapshot
+            if not force and current is not None and current.age() < self.ttl:
+                return current
+            rates, source = DesslyHubAPI(api_key).fetch_exchange_rates()
+            if source == "fallback" and current is not None:
+                logger.warning(f"{LOGGER_PREFIX} Курсы не обновлены, продолжаем использовать снимок v{current.version}")
+                return current
+            snapshot = ExchangeRatesSnapshot(rates, (current.version if current else 0) + 1, time.time(), source)
+            self._snapshot = snapshot
+            if source != "fallback":
+                _get_storage().save_exchange_rates(snapshot.to_dict())
+            logger.info(f"{LOGGER_PREFIX} Курсы валют обновлены (v{snapshot.version}, {source}): {dict(snapshot.rates)}")
+            return snapshot
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка обновления курсов валют: {e}")
+            return self._snapshot or ExchangeRatesSnapshot(self.FALLBACK_RATES, 0, 0, "fallback")
+        finally:
+            self._refresh_lock.release()
+    
+    def _worker(self) -> None:
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                api_key = _get_storage().settings_view().get("desslyhub_api_key", "")
+                if api_key:
+                    self.refresh(api_key, wait=False, force=True)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка фонового обновления курсов валют: {e}")
+    
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, name="AS-ExchangeRates", daemon=True)
+            self._thread.start()
+
+
+def _get_exchange_rates_service() -> ExchangeRatesService:
+    global _exchange_rates_service
+    if _exchange_rates_service is None:
+        with _exchange_rates_service_lock:
+            if _exchange_rates_service is None:
+                _exchange_rates_service = ExchangeRatesService()
+    return _exchange_rates_service
+
+
 def _kb_main(active: bool) -> K:
     kb = K()
     toggle_text = "🔴 Остановить" if active else "🟢 Запустить"
@@ -469,6 +1318,7 @@ def _kb_main(active: bool) -> K:
         B("📜 История заказов", callback_data=CB_OPEN_ORDERS_HISTORY),
         B("🚫 Черный список", callback_data=CB_OPEN_BLACKLIST)
     )
+    kb.add(B("🔄 Синхронизация цен", callback_data=CB_MANUAL_SYNC))
     kb.row(B("🔑 Перепроверить лицензию", callback_data=CB_LICENSE_RECHECK))
     return kb
 
@@ -496,6 +1346,10 @@ def _kb_settings_menu() -> K:
     balance_threshold_enabled = settings.get("balance_threshold_enabled", True)
     kb.add(B(f"💰 Порог цены: {balance_threshold} USD", callback_data="AS_EDIT_BALANCE_THRESHOLD"))
     kb.add(B(f"🔔 Мониторинг порога: {'✅' if balance_threshold_enabled else '❌'}", callback_data="AS_TOGGLE_BALANCE_THRESHOLD"))
+    forecast_enabled = settings.get("forecast_enabled", False)
+    forecast_horizon = settings.get("forecast_horizon_hours", 2.0)
+    kb.add(B(f"⏳ Прогноз баланса: {'✅' if forecast_enabled else '❌'}", callback_data="AS_TOGGLE_FORECAST"))
+    kb.add(B(f"🕒 Горизонт прогноза: {forecast_horizon} ч", callback_data="AS_EDIT_FORECAST_HORIZON"))
     auto_markup = settings.get("auto_markup_enabled", True)
     kb.add(B(f"📊 Автонаценка: {'✅' if auto_markup else '❌'}", callback_data="AS_TOGGLE_AUTO_MARKUP"))
     kb.add(B("🔑 API ключ DesslyHub", callback_data="AS_EDIT_API_KEY"))
@@ -557,8 +1411,20 @@ def _determine_lot(cardinal: "Cardinal", game_name: str) -> dict | None:
         return None
 
 
+def _compute_catalog_version(games_list: list) -> str:
+    entries = []
+    for game in games_list:
+        if not isinstance(game, dict):
+            continue
+        app_id = game.get("appid") or game.get("app_id") or game.get("appId") or game.get("appID") or game.get("id")
+        title = game.get("name", "") or game.get("title", "") or game.get("game_name", "") or game.get("gameName", "")
+        entries.append(f"{app_id}:{title}")
+    entries.sort()
+    return hashlib.sha1("\n".join(entries).encode("utf-8")).hexdigest()[:16]
+
+
 def _get_desslyhub_games(api_key: str, use_cache: bool = True) -> dict | None:
-    global _desslyhub_games_cache, _desslyhub_cache_timestamp, _desslyhub_cache_lock
+    global _desslyhub_games_cache, _desslyhub_cache_timestamp, _desslyhub_cache_lock, _desslyhub_catalog_version
     
     if use_cache:
         with _desslyhub_cache_lock:
@@ -583,7 +1449,7 @@ def _get_desslyhub_games(api_key: str, use_cache: bool = True) -> dict | None:
         for url in urls_to_try:
             try:
                 logger.debug(f"{LOGGER_PREFIX} [TEST] Запрос списка игр: URL={url}")
-                response = requests.get(url, headers=headers, timeout=30)
+                response = _get_http_session().get(url, headers=headers, timeout=30)
                 if response.status_code == 200:
                     break
                 else:
@@ -616,9 +1482,11 @@ def _get_desslyhub_games(api_key: str, use_cache: bool = True) -> dict | None:
             if result:
                 games_list = result.get("games", []) or result.get("data", []) or result.get("items", [])
                 logger.debug(f"{LOGGER_PREFIX} [TEST] Всего игр в ответе: {len(games_list)}")
+                catalog_version = _compute_catalog_version(games_list)
                 with _desslyhub_cache_lock:
                     _desslyhub_games_cache = result
                     _desslyhub_cache_timestamp = time.time()
+                    _desslyhub_catalog_version = catalog_version
                 return result
         else:
             error_text = ""
@@ -654,7 +1522,7 @@ def _get_desslyhub_price_by_app_id(app_id: int, api_key: str) -> float | None:
         for url in urls_to_try:
             try:
                 logger.info(f"{LOGGER_PREFIX} [TEST] Запрос информации об игре: URL={url}, app_id={app_id}")
-                response = requests.get(url, headers=headers, timeout=30)
+                response = _get_http_session().get(url, headers=headers, timeout=30)
                 if response.status_code == 200:
                     break
                 else:
@@ -755,7 +1623,7 @@ def _get_desslyhub_balance(api_key: str) -> dict | None:
             "Content-Type": "application/json"
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = _get_http_session().get(url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -782,6 +1650,197 @@ def _get_desslyhub_balance(api_key: str) -> dict | None:
         return None
 
 
+class BalanceLedger:
+    """Локальный баланс DesslyHub: значение из API минус наши списания после него и резервы заказов в работе"""
+    
+    RESERVATION_TTL = max(600, PACKAGE_PIN_TTL)
+    
+    def __init__(self):
+        self.balance: float | None = None
+        self.currency = "USD"
+        self.synced_at = 0.0
+        self._reserved: dict[str, tuple[float, float]] = {}
+        self._debited: dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def refresh(self, api_key: str) -> float | None:
+        """Сверяет локальный баланс с API"""
+        data = _get_desslyhub_balance(api_key)
+        if data:
+            with self._lock:
+                if self.balance is not None and abs(data["balance"] - self.balance) >= 0.01:
+                    logger.debug(f"{LOGGER_PREFIX} [BALANCE] Сверка с API: {self.balance:.4f} -> {data['balance']:.4f} {data['currency']}")
+                self.balance = data["balance"]
+                self.currency = data["currency"]
+                self.synced_at = time.time()
+                self._debited.clear()
+        return self.available()
+    
+    def refresh_async(self, api_key: str) -> None:
+        def run():
+            self.refresh(api_key)
+            _check_low_balance(self)
+        threading.Thread(target=run, daemon=True, name="AS-BalanceRefresh").start()
+    
+    def available(self) -> float | None:
+        """Баланс за вычетом резервов заказов в работе"""
+        now = time.time()
+        with self._lock:
+            if self.balance is None:
+                return None
+            for key in [key for key, (_, reserved_at) in self._reserved.items() if now - reserved_at >= self.RESERVATION_TTL]:
+                del self._reserved[key]
+            return self.balance - sum(amount for amount, _ in self._reserved.values())
+    
+    def balance_data(self, api_key: str, max_age: float = BALANCE_MAX_AGE) -> dict | None:
+        """То же, что _get_desslyhub_balance, но без запроса к API, если локальный баланс свежее max_age секунд"""
+        if self.balance is None or time.time() - self.synced_at >= max_age:
+            self.refresh(api_key)
+        available = self.available()
+        if available is None:
+            return None
+        return {"balance": available, "currency": self.currency}
+    
+    def reserve(self, key: str, amount) -> None:
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            self._reserved[key] = (amount, time.time())
+    
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._reserved.pop(key, None)
+    
+    def release_missing(self, keys: set, prefix: str) -> None:
+        """Снимает резервы с ключом prefix..., которых нет в keys (заказ завершен или отменен)"""
+        with self._lock:
+            for key in [key for key in self._reserved if key.startswith(prefix) and key not in keys]:
+                del self._reserved[key]
+    
+    def debit(self, key: str, amount) -> None:
+        """Оптимистично списывает ожидаемую цену после успешной отправки"""
+        with self._lock:
+            self._reserved.pop(key, None)
+            try:
+                amount = float(amount)
+            except (TypeError, ValueError):
+                return
+            if self.balance is not None:
+                self.balance -= amount
+                self._debited[key] = amount
+        _check_low_balance(self)
+    
+    def settle(self, key: str, final_amount) -> None:
+        """Поправляет оптимистичное списание по final_amount транзакции"""
+        try:
+            final_amount = float(final_amount)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            expected = self._debited.pop(key, None)
+            if expected is not None and self.balance is not None:
+                self.balance -= final_amount - expected
+
+
+def _get_balance_ledger() -> BalanceLedger:
+    global _balance_ledger
+    with _balance_ledger_lock:
+        if _balance_ledger is None:
+            _balance_ledger = BalanceLedger()
+        return _balance_ledger
+
+
+def _check_low_balance(ledger: BalanceLedger) -> None:
+    """Будит мониторинг баланса сразу, как только доступный баланс опустился ниже порога"""
+    settings = _get_storage().settings_view()
+    if not settings.get("balance_threshold_enabled", True):
+        return
+    available = ledger.available()
+    if available is not None and available < float(settings.get("balance_threshold", 30.0)):
+        _balance_monitor_wakeup.set()
+
+
+def _lot_config_hash(lot_config: dict) -> str:
+    payload = json.dumps(lot_config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _load_lot_bindings() -> dict:
+    global _lot_bindings
+    with _lot_bindings_lock:
+        if _lot_bindings is None:
+            _lot_bindings = _get_storage().load_bindings()
+        return _lot_bindings
+
+
+def _get_lot_binding(lot_config: dict, api_key: str | None = None) -> dict | None:
+    lot_name = lot_config.get("lot_name", "").strip()
+    if not lot_name:
+        return None
+    
+    binding = _load_lot_bindings().get(lot_name)
+    if not binding:
+        return None
+    
+    if binding.get("config_hash") != _lot_config_hash(lot_config):
+        logger.debug(f"{LOGGER_PREFIX} [BIND] Конфиг лота '{lot_name}' изменился, привязка сброшена")
+        return None
+    
+    if not _desslyhub_catalog_version and api_key:
+        _get_desslyhub_games(api_key)
+    catalog_version = _desslyhub_catalog_version
+    if not catalog_version:
+        logger.debug(f"{LOGGER_PREFIX} [BIND] Версия каталога DesslyHub неизвестна, привязка '{lot_name}' не проверена")
+        return None
+    if binding.get("catalog_version") != catalog_version:
+        logger.debug(f"{LOGGER_PREFIX} [BIND] Каталог DesslyHub изменился, привязка '{lot_name}' сброшена")
+        return None
+    
+    return binding
+
+
+def _save_lot_binding(lot_config: dict, **fields) -> None:
+    lot_name = lot_config.get("lot_name", "").strip()
+    if not lot_name:
+        return
+    
+    config_hash = _lot_config_hash(lot_config)
+    bindings = _load_lot_bindings()
+    with _lot_bindings_lock:
+        current = bindings.get(lot_name) or {}
+        if current.get("config_hash") != config_hash:
+            current = {}
+        
+        updated = dict(current)
+        updated.update({k: v for k, v in fields.items() if v is not None})
+        updated["config_hash"] = config_hash
+        if _desslyhub_catalog_version:
+            updated["catalog_version"] = _desslyhub_catalog_version
+        
+        if updated == current:
+            return
+        
+        updated["updated_at"] = time.time()
+        bindings[lot_name] = updated
+        _get_storage().save_bindings(bindings)
+    logger.debug(f"{LOGGER_PREFIX} [BIND] Сохранена привязка для '{lot_name}': {fields}")
+
+
+def _prune_lot_bindings(lots_config: list) -> None:
+    lot_names = {config.get("lot_name", "").strip() for config in lots_config}
+    bindings = _load_lot_bindings()
+    with _lot_bindings_lock:
+        stale = [name for name in bindings if name not in lot_names]
+        if not stale:
+            return
+        for name in stale:
+            del bindings[name]
+        _get_storage().save_bindings(bindings)
+    logger.info(f"{LOGGER_PREFIX} [BIND] Удалено устаревших привязок: {len(stale)}")
+
+
 def _calculate_price_with_markup(base_price: float, markup_percent: float) -> float:
     return base_price * (1 + markup_percent / 100.0)
 
@@ -815,6 +1874,92 @@ def _normalize_game_name(name: str) -> str:
     
     return normalized.strip()
 
+class SteamCatalogIndex:
+    """Индекс каталога Steam DesslyHub для быстрого поиска app_id по названию"""
+    
+    def __init__(self, games_list: list, version: str = ""):
+        self.version = version
+        self.entries: list[tuple[str, str, frozenset, int]] = []
+        self._exact: dict[str, int] = {}
+        self._tokens: dict[str, list[int]] = {}
+        
+        for game in games_list:
+            if not isinstance(game, dict):
+                continue
+            game_title = (game.get("name", "") or game.get("title", "") or
+                          game.get("game_name", "") or game.get("gameName", "") or
+                          game.get("title_ru", "") or game.get("title_en", "")).strip()
+            if not game_title:
+                continue
+            
+            app_id = game.get("appid") or game.get("app_id") or game.get("appId") or game.get("appID") or game.get("id")
+            if not app_id:
+                continue
+            try:
+                app_id_int = int(app_id)
+            except (ValueError, TypeError):
+                continue
+            
+            idx = len(self.entries)
+            game_title_normalized = _normalize_game_name(game_title)
+            game_title_words = frozenset(game_title_normalized.split())
+            self.entries.append((game_title, game_title_normalized, game_title_words, app_id_int))
+            
+            self._exact.setdefault(game_title_normalized, idx)
+            self._exact.setdefault(game_title.lower(), idx)
+            for word in game_title_words:
+                self._tokens.setdefault(word, []).append(idx)
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def find_exact(self, name_normalized: str, name_lower: str, name_words: set) -> tuple[int, str, str] | None:
+        """Возвращает первое по порядку каталога точное совпадение или совпадение всех слов"""
+        best_idx = None
+        kind = None
+        for key in (name_normalized, name_lower):
+            idx = self._exact.get(key)
+            if idx is not None and (best_idx is None or idx < best_idx):
+                best_idx, kind = idx, "exact"
+        
+        if len(name_words) >= 2:
+            postings = [self._tokens.get(word) for word in name_words]
+            if all(postings):
+                postings.sort(key=len)
+                common = set(postings[0])
+                for posting in postings[1:]:
+                    common.intersection_update(posting)
+                    if not common:
+                        break
+                if common:
+                    idx = min(common)
+                    if best_idx is None or idx < best_idx:
+                        best_idx, kind = idx, "words"
+        
+        if best_idx is None:
+            return None
+        game_title, _, _, app_id_int = self.entries[best_idx]
+        return app_id_int, game_title, kind
+    
+    def candidates(self, name_words: set) -> list[tuple[str, str, frozenset, int]]:
+        """Игры каталога, имеющие хотя бы одно общее слово с названием, в исходном порядке"""
+        indices = set()
+        for word in name_words:
+            indices.update(self._tokens.get(word, ()))
+        return [self.entries[idx] for idx in sorted(indices)]
+
+
+def _get_steam_catalog_index(games_data: dict, games_list: list) -> SteamCatalogIndex:
+    global _steam_catalog_index, _steam_catalog_index_source
+    with _steam_catalog_index_lock:
+        if _steam_catalog_index is None or _steam_catalog_index_source is not games_data:
+            started = time.time()
+            _steam_catalog_index = SteamCatalogIndex(games_list, _desslyhub_catalog_version)
+            _steam_catalog_index_source = games_data
+            logger.debug(f"{LOGGER_PREFIX} [TEST] Построен индекс каталога: {len(_steam_catalog_index)} игр за {time.time() - started:.2f} сек")
+        return _steam_catalog_index
+
+
 def _get_game_app_id_by_name(game_name: str, api_key: str) -> int | None:
     global _game_app_id_cache, _game_app_id_cache_lock
     
@@ -847,71 +1992,46 @@ def _get_game_app_id_by_name(game_name: str, api_key: str) -> int | None:
             logger.warning(f"{LOGGER_PREFIX} Не удалось нормализовать название игры '{game_name}'")
             return None
         
-        exact_matches = []
+        index = _get_steam_catalog_index(games_data, games_list)
+        exact = index.find_exact(game_name_normalized, game_name_lower, game_name_words)
+        if exact:
+            app_id_int, game_title, kind = exact
+            if kind == "exact":
+                logger.debug(f"{LOGGER_PREFIX} [TEST] Найдено точное совпадение: appid={app_id_int} для '{game_name}' (найдено как '{game_title}')")
+            else:
+                logger.debug(f"{LOGGER_PREFIX} [TEST] Найдено полное совпадение слов: appid={app_id_int} для '{game_name}' (найдено как '{game_title}')")
+            with _game_app_id_cache_lock:
+                _game_app_id_cache[game_name_normalized_key] = app_id_int
+            return app_id_int
+        
         high_similarity = []
         partial_matches = []
         
-        for idx, game in enumerate(games_list):
-            if isinstance(game, dict):
-                game_title = (game.get("name", "") or game.get("title", "") or 
-                             game.get("game_name", "") or game.get("gameName", "") or
-                             game.get("title_ru", "") or game.get("title_en", "")).strip()
-                
-                if not game_title:
-                    continue
-                
-                game_title_normalized = _normalize_game_name(game_title)
-                game_title_lower = game_title.lower()
-                
-                app_id = game.get("appid") or game.get("app_id") or game.get("appId") or game.get("appID") or game.get("id")
-                if not app_id:
-                    continue
-                
-                try:
-                    app_id_int = int(app_id)
-                except (ValueError, TypeError):
-                    continue
-                
-                if game_name_normalized == game_title_normalized or game_name_lower == game_title_lower:
-                    logger.debug(f"{LOGGER_PREFIX} [TEST] Найдено точное совпадение: appid={app_id_int} для '{game_name}' (найдено как '{game_title}')")
-                    with _game_app_id_cache_lock:
-                        _game_app_id_cache[game_name_normalized_key] = app_id_int
-                    return app_id_int
-                
-                game_title_words = set(game_title_normalized.split())
-                common_words = game_name_words & game_title_words
-                
-                if not common_words:
-                    continue
-                
-                if len(common_words) == len(game_name_words) and len(game_name_words) >= 2:
-                    logger.debug(f"{LOGGER_PREFIX} [TEST] Найдено полное совпадение слов: appid={app_id_int} для '{game_name}' (найдено как '{game_title}')")
-                    with _game_app_id_cache_lock:
-                        _game_app_id_cache[game_name_normalized_key] = app_id_int
-                    return app_id_int
-                
-                if game_name_normalized in game_title_normalized:
-                    similarity = len(game_name_normalized) / len(game_title_normalized)
-                    if similarity >= 0.7:
-                        high_similarity.append((game_title, app_id_int, similarity))
-                    elif similarity >= 0.5:
-                        partial_matches.append((game_title, app_id_int, similarity))
-                    continue
-                
-                if game_title_normalized in game_name_normalized:
-                    similarity = len(game_title_normalized) / len(game_name_normalized)
-                    if similarity >= 0.7:
-                        high_similarity.append((game_title, app_id_int, similarity))
-                    elif similarity >= 0.5:
-                        partial_matches.append((game_title, app_id_int, similarity))
-                    continue
-                
-                if len(common_words) >= 2:
-                    similarity = len(common_words) / max(len(game_name_words), len(game_title_words))
-                    if similarity >= 0.6:
-                        high_similarity.append((game_title, app_id_int, similarity))
-                    elif similarity >= 0.4:
-                        partial_matches.append((game_title, app_id_int, similarity))
+        for game_title, game_title_normalized, game_title_words, app_id_int in index.candidates(game_name_words):
+            common_words = game_name_words & game_title_words
+            
+            if game_name_normalized in game_title_normalized:
+                similarity = len(game_name_normalized) / len(game_title_normalized)
+                if similarity >= 0.7:
+                    high_similarity.append((game_title, app_id_int, similarity))
+                elif similarity >= 0.5:
+                    partial_matches.append((game_title, app_id_int, similarity))
+                continue
+            
+            if game_title_normalized in game_name_normalized:
+                similarity = len(game_title_normalized) / len(game_name_normalized)
+                if similarity >= 0.7:
+                    high_similarity.append((game_title, app_id_int, similarity))
+                elif similarity >= 0.5:
+                    partial_matches.append((game_title, app_id_int, similarity))
+                continue
+            
+            if len(common_words) >= 2:
+                similarity = len(common_words) / max(len(game_name_words), len(game_title_words))
+                if similarity >= 0.6:
+                    high_similarity.append((game_title, app_id_int, similarity))
+                elif similarity >= 0.4:
+                    partial_matches.append((game_title, app_id_int, similarity))
         
         if high_similarity:
             high_similarity.sort(key=lambda x: x[2], reverse=True)
@@ -953,13 +2073,13 @@ def _get_game_app_id_by_name(game_name: str, api_key: str) -> int | None:
         return None
 
 
-def _get_package_id_by_app_id(api_key: str, app_id: int, region: str = "KZ", game_name: str = None, lot_name: str = None) -> dict | None:
+def _fetch_steam_game_editions(api_key: str, app_id: int) -> list | None:
     max_retries = 3
     retry_delay = 1.0
     
     for attempt in range(max_retries):
         try:
-            logger.debug(f"{LOGGER_PREFIX} [TEST] Получение package_id для app_id={app_id}, region={region}, game_name={game_name}, lot_name={lot_name} (попытка {attempt + 1}/{max_retries})")
+            logger.debug(f"{LOGGER_PREFIX} [TEST] Получение изданий для app_id={app_id} (попытка {attempt + 1}/{max_retries})")
             
             url = f"https://desslyhub.com/api/v1/service/steamgift/games/{app_id}"
             headers = {
@@ -967,7 +2087,7 @@ def _get_package_id_by_app_id(api_key: str, app_id: int, region: str = "KZ", gam
                 "Content-Type": "application/json"
             }
             
-            response = requests.get(url, headers=headers, timeout=30)
+            response = _get_http_session().get(url, headers=headers, timeout=30)
             
             if response.status_code == 429:
                 if attempt < max_retries - 1:
@@ -993,283 +2113,9 @@ def _get_package_id_by_app_id(api_key: str, app_id: int, region: str = "KZ", gam
                 logger.debug(f"{LOGGER_PREFIX} [TEST] Получен ответ от Get Game By App ID: {json.dumps(data, ensure_ascii=False)[:500]}")
                 
                 game_list = data.get("game", []) or data.get("games", []) or []
-                if not game_list:
-                    logger.warning(f"{LOGGER_PREFIX} Список изданий игры пуст для app_id={app_id}")
-                    return None
-            
                 if not isinstance(game_list, list):
                     game_list = [game_list]
-                
-                edition_keywords = []
-                if lot_name:
-                    lot_name_lower = lot_name.lower()
-                    lot_name_normalized = _normalize_lot_name(lot_name)
-                    edition_patterns = [
-                        # Полные названия изданий (приоритет)
-                        (r'\bvault\s+edition\b', 'vault edition'),
-                        (r'\bultimate\s+edition\b', 'ultimate edition'),
-                        (r'\bdeluxe\s+edition\b', 'deluxe edition'),
-                        (r'\bpremium\s+edition\b', 'premium edition'),
-                        (r'\bgold\s+edition\b', 'gold edition'),
-                        (r'\bstandard\s+edition\b', 'standard edition'),
-                        (r'\brevolution\s+edition\b', 'revolution edition'),
-                        (r'\bdefinitive\s+edition\b', 'definitive edition'),
-                        (r'\bphantom\s+edition\b', 'phantom edition'),
-                        (r'\bpalace\s+edition\b', 'palace edition'),
-                        (r'\btournament\s+edition\b', 'tournament edition'),
-                        (r'\ball-star\s+edition\b', 'all-star edition'),
-                        (r'\bcomplete\s+edition\b', 'complete edition'),
-                        (r'\bdigital\s+deluxe\b', 'digital deluxe'),
-                        (r'\badvanced\s+edition\b', 'advanced edition'),
-                        (r'\blegendary\s+edition\b', 'legendary edition'),
-                        (r'\bcollector[\'\u2019]?s?\s+edition\b', 'collector edition'),
-                        (r'\bgame\s+of\s+the\s+year\b', 'game of the year'),
-                        (r'\bgoty\s+edition\b', 'goty edition'),
-                        (r'\bgoty\b', 'goty'),
-                        (r'\bchampion\s+edition\b', 'champion edition'),
-                        (r'\banniversary\s+edition\b', 'anniversary edition'),
-                        (r'\bspecial\s+edition\b', 'special edition'),
-                        (r'\benhanced\s+edition\b', 'enhanced edition'),
-                        (r'\bextended\s+edition\b', 'extended edition'),
-                        (r'\bfounder[\'\u2019]?s?\s+edition\b', 'founder edition'),
-                        (r'\blaunch\s+edition\b', 'launch edition'),
-                        (r'\blimited\s+edition\b', 'limited edition'),
-                        (r'\bplatinum\s+edition\b', 'platinum edition'),
-                        (r'\bsilver\s+edition\b', 'silver edition'),
-                        (r'\bbronze\s+edition\b', 'bronze edition'),
-                        (r'\bsuper\s+deluxe\b', 'super deluxe'),
-                        (r'\bseason\s+pass\s+edition\b', 'season pass edition'),
-                        (r'\bbundle\b', 'bundle'),
-                        (r'\bcollection\b', 'collection'),
-                        # Короткие ключевые слова (меньший приоритет)
-                        (r'\bvault\b', 'vault'),
-                        (r'\bultimate\b', 'ultimate'),
-                        (r'\bdeluxe\b', 'deluxe'),
-                        (r'\bpremium\b', 'premium'),
-                        (r'\bgold\b', 'gold'),
-                        (r'\blegendary\b', 'legendary'),
-                        (r'\bcollector\b', 'collector'),
-                        (r'\bchampion\b', 'champion'),
-                        (r'\bplatinum\b', 'platinum'),
-                        (r'\benhanced\b', 'enhanced'),
-                        (r'\bdefinitive\b', 'definitive'),
-                        (r'\bcomplete\b', 'complete'),
-                        (r'\bspecial\b', 'special'),
-                    ]
-                    for pattern, keyword in edition_patterns:
-                        match = re.search(pattern, lot_name_lower)
-                        if match:
-                            edition_keywords.append(keyword)
-                
-                if game_name:
-                    game_name_lower = game_name.lower()
-                    game_name_normalized = _normalize_game_name(game_name)
-                
-                exact_matches = []
-                partial_matches = []
-                keyword_matches = []
-                other_editions = []
-                
-                for edition in game_list:
-                    if not isinstance(edition, dict):
-                        continue
-                    
-                    package_id = edition.get("package_id")
-                    if not package_id:
-                        continue
-                    
-                    edition_name = edition.get("edition", "").strip()
-                    regions_info = edition.get("regions_info", [])
-                    if not isinstance(regions_info, list):
-                        regions_info = []
-                    
-                    region_price = None
-                    region_found = False
-                    for region_info in regions_info:
-                        if isinstance(region_info, dict) and region_info.get("region") == region:
-                            region_found = True
-                            price_value = region_info.get("price")
-                            currency_value = region_info.get("currency") or region_info.get("curr")
-                            logger.debug(f"{LOGGER_PREFIX} [TEST] Регион {region}: price={price_value}, currency={currency_value}, полные данные: {json.dumps(region_info, ensure_ascii=False)[:200]}")
-                            if price_value is not None:
-                                try:
-                                    region_price = float(price_value)
-                                except (ValueError, TypeError):
-                                    logger.warning(f"{LOGGER_PREFIX} [TEST] Неверный формат цены для региона {region}: {price_value}")
-                                    region_price = None
-                            break
-                    
-                    if not region_found and regions_info:
-                        first_region_info = regions_info[0] if regions_info else None
-                        if first_region_info and isinstance(first_region_info, dict):
-                            price_value = first_region_info.get("price")
-                            if price_value is not None:
-                                try:
-                                    region_price = float(price_value)
-                                    logger.debug(f"{LOGGER_PREFIX} [TEST] Регион {region} не найден, используется цена из первого доступного региона: {region_price}")
-                                except (ValueError, TypeError):
-                                    region_price = None
-                    
-                    if region_price is None:
-                        if regions_info:
-                            for alt_region_info in regions_info:
-                                if isinstance(alt_region_info, dict):
-                                    alt_price = alt_region_info.get("price")
-                                    if alt_price is not None:
-                                        try:
-                                            region_price = float(alt_price)
-                                            logger.debug(f"{LOGGER_PREFIX} [TEST] Цена для региона {region} не найдена, используется альтернативная цена: {region_price}")
-                                            break
-                                        except (ValueError, TypeError):
-                                            continue
-                        if region_price is None:
-                            logger.warning(f"{LOGGER_PREFIX} [TEST] Цена для региона {region} не найдена для издания '{edition_name}'")
-                            continue
-                    
-                    edition_info = {
-                        "package_id": str(package_id),
-                        "price": region_price,
-                        "edition": edition_name
-                    }
-                    
-                    edition_lower = edition_name.lower().strip()
-                    edition_normalized = _normalize_game_name(edition_name)
-                    matched = False
-                    match_score = 0
-                    
-                    # Маппинг синонимов для поиска изданий
-                    keyword_synonyms = {
-                        'goty': ['goty', 'game of the year'],
-                        'game of the year': ['goty', 'game of the year'],
-                        'collector edition': ['collector', 'collector edition', "collector's edition"],
-                        'collector': ['collector', 'collector edition', "collector's edition"],
-                        'founder edition': ['founder', 'founder edition', "founder's edition"],
-                        'founder': ['founder', 'founder edition', "founder's edition"],
-                    }
-                    
-                    if edition_keywords:
-                        for keyword in edition_keywords:
-                            # Получаем список синонимов для ключевого слова
-                            synonyms = keyword_synonyms.get(keyword, [keyword])
-                            for synonym in synonyms:
-                                if synonym in edition_lower:
-                                    keyword_matches.append(edition_info)
-                                    matched = True
-                                    match_score = 100
-                                    break
-                            if matched:
-                                break
-                    
-                    if not matched and game_name:
-                        game_name_lower = game_name.lower().strip()
-                        game_name_normalized = _normalize_game_name(game_name)
-                        
-                        if game_name_normalized == edition_normalized or game_name_lower == edition_lower:
-                            exact_matches.append(edition_info)
-                            matched = True
-                            match_score = 90
-                        elif game_name_normalized in edition_normalized:
-                            similarity = len(game_name_normalized) / len(edition_normalized)
-                            if similarity >= 0.7:
-                                partial_matches.append(edition_info)
-                                matched = True
-                                match_score = int(similarity * 80)
-                        elif edition_normalized in game_name_normalized:
-                            similarity = len(edition_normalized) / len(game_name_normalized)
-                            if similarity >= 0.7:
-                                partial_matches.append(edition_info)
-                                matched = True
-                                match_score = int(similarity * 80)
-                        else:
-                            game_words = set(game_name_normalized.split())
-                            edition_words = set(edition_normalized.split())
-                            common_words = game_words & edition_words
-                            
-                            if common_words and len(common_words) >= 2:
-                                similarity = len(common_words) / max(len(game_words), len(edition_words))
-                                if similarity >= 0.6:
-                                    partial_matches.append(edition_info)
-                                    matched = True
-                                    match_score = int(similarity * 70)
-                    
-                    if not matched:
-                        other_editions.append(edition_info)
-            
-                if keyword_matches:
-                    for match in keyword_matches:
-                        edition_words = set(_normalize_game_name(match["edition"]).split())
-                        if game_name:
-                            game_words = set(_normalize_game_name(game_name).split())
-                            common_words = game_words & edition_words
-                            match["word_overlap"] = len(common_words)
-                        else:
-                            match["word_overlap"] = 0
-                    keyword_matches.sort(key=lambda x: (-x.get("word_overlap", 0), x["price"], len(x["edition"])))
-                    if keyword_matches:
-                        selected = keyword_matches[0]
-                        logger.info(f"{LOGGER_PREFIX} [PRICE] Найдено совпадение по ключевому слову издания: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
-                        return {
-                            "package_id": selected["package_id"],
-                            "price": selected["price"],
-                            "edition": selected["edition"]
-                        }
-            
-                if exact_matches:
-                    for match in exact_matches:
-                        edition_words = set(_normalize_game_name(match["edition"]).split())
-                        if game_name:
-                            game_words = set(_normalize_game_name(game_name).split())
-                            common_words = game_words & edition_words
-                            match["word_overlap"] = len(common_words)
-                        else:
-                            match["word_overlap"] = 0
-                    exact_matches.sort(key=lambda x: (-x.get("word_overlap", 0), x["price"], len(x["edition"])))
-                    if exact_matches:
-                        selected = exact_matches[0]
-                        logger.info(f"{LOGGER_PREFIX} [PRICE] Найдено точное совпадение издания: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
-                        return {
-                            "package_id": selected["package_id"],
-                            "price": selected["price"],
-                            "edition": selected["edition"]
-                        }
-            
-                if partial_matches:
-                    for match in partial_matches:
-                        edition_words = set(_normalize_game_name(match["edition"]).split())
-                        if game_name:
-                            game_words = set(_normalize_game_name(game_name).split())
-                            common_words = game_words & edition_words
-                            match["word_overlap"] = len(common_words)
-                        else:
-                            match["word_overlap"] = 0
-                    partial_matches.sort(key=lambda x: (-x.get("word_overlap", 0), x["price"], len(x["edition"])))
-                    if partial_matches:
-                        selected = partial_matches[0]
-                        logger.info(f"{LOGGER_PREFIX} [PRICE] Найдено частичное совпадение издания: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
-                        return {
-                            "package_id": selected["package_id"],
-                            "price": selected["price"],
-                            "edition": selected["edition"]
-                        }
-            
-                if other_editions:
-                    standard_editions = [e for e in other_editions if "standard" in e["edition"].lower() and not any(x in e["edition"].lower() for x in ["deluxe", "ultimate", "premium", "gold", "vault"])]
-                    if standard_editions:
-                        standard_editions.sort(key=lambda x: (x["price"], len(x["edition"])))
-                        selected = standard_editions[0]
-                        logger.warning(f"{LOGGER_PREFIX} [PRICE] Используется стандартное издание: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
-                    else:
-                        other_editions.sort(key=lambda x: (x["price"], len(x["edition"])))
-                        selected = other_editions[0]
-                        logger.warning(f"{LOGGER_PREFIX} [PRICE] Совпадение не найдено, используется самое дешевое издание: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
-                    return {
-                        "package_id": selected["package_id"],
-                        "price": selected["price"],
-                        "edition": selected["edition"]
-                    }
-                
-                logger.warning(f"{LOGGER_PREFIX} package_id не найден в ответе для app_id={app_id}")
-                return None
+                return game_list
             else:
                 error_text = ""
                 try:
@@ -1277,7 +2123,7 @@ def _get_package_id_by_app_id(api_key: str, app_id: int, region: str = "KZ", gam
                     error_text = f": {error_data}"
                 except:
                     error_text = f": {response.text[:100]}"
-                logger.error(f"{LOGGER_PREFIX} DesslyHub API вернул ошибку при получении package_id: status_code={response.status_code}{error_text}")
+                logger.error(f"{LOGGER_PREFIX} DesslyHub API вернул ошибку при получении изданий игры: status_code={response.status_code}{error_text}")
                 if attempt < max_retries - 1 and response.status_code >= 500:
                     wait_time = retry_delay * (2 ** attempt)
                     logger.warning(f"{LOGGER_PREFIX} [TEST] Повторная попытка через {wait_time:.1f} сек...")
@@ -1287,31 +2133,363 @@ def _get_package_id_by_app_id(api_key: str, app_id: int, region: str = "KZ", gam
         except requests.exceptions.Timeout as e:
             if attempt < max_retries - 1:
                 wait_time = retry_delay * (2 ** attempt)
-                logger.warning(f"{LOGGER_PREFIX} Таймаут при получении package_id (попытка {attempt + 1}/{max_retries}), ожидание {wait_time:.1f} сек...")
+                logger.warning(f"{LOGGER_PREFIX} Таймаут при получении изданий игры (попытка {attempt + 1}/{max_retries}), ожидание {wait_time:.1f} сек...")
                 time.sleep(wait_time)
                 continue
-            logger.error(f"{LOGGER_PREFIX} Таймаут при получении package_id после {max_retries} попыток: {e}")
+            logger.error(f"{LOGGER_PREFIX} Таймаут при получении изданий игры после {max_retries} попыток: {e}")
             return None
         except requests.exceptions.RequestException as e:
             if attempt < max_retries - 1:
                 wait_time = retry_delay * (2 ** attempt)
-                logger.warning(f"{LOGGER_PREFIX} Ошибка сети при получении package_id (попытка {attempt + 1}/{max_retries}), ожидание {wait_time:.1f} сек...")
+                logger.warning(f"{LOGGER_PREFIX} Ошибка сети при получении изданий игры (попытка {attempt + 1}/{max_retries}), ожидание {wait_time:.1f} сек...")
                 time.sleep(wait_time)
                 continue
-            logger.error(f"{LOGGER_PREFIX} Ошибка сети при получении package_id после {max_retries} попыток: {e}")
+            logger.error(f"{LOGGER_PREFIX} Ошибка сети при получении изданий игры после {max_retries} попыток: {e}")
             return None
         except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка при получении package_id для app_id={app_id}: {e}", exc_info=True)
+            logger.error(f"{LOGGER_PREFIX} Ошибка при получении изданий игры для app_id={app_id}: {e}", exc_info=True)
             return None
     
-    return None
+    return None
+
+
+def _get_steam_game_editions(api_key: str, app_id: int, use_cache: bool = True) -> list | None:
+    try:
+        app_id = int(app_id)
+    except (ValueError, TypeError):
+        pass
+    
+    with _steam_game_cache_lock:
+        cached = _steam_game_cache.get(app_id)
+        if use_cache and cached and (time.time() - cached[0]) < _steam_game_cache_ttl:
+            _steam_game_cache.move_to_end(app_id)
+            return cached[1]
+        
+        inflight = _steam_game_inflight.get(app_id)
+        is_leader = inflight is None
+        if is_leader:
+            inflight = threading.Event()
+            _steam_game_inflight[app_id] = inflight
+    
+    if not is_leader:
+        logger.debug(f"{LOGGER_PREFIX} [TEST] Ожидание параллельного запроса изданий для app_id={app_id}")
+        inflight.wait(timeout=120)
+        with _steam_game_cache_lock:
+            cached = _steam_game_cache.get(app_id)
+        return cached[1] if cached else None
+    
+    try:
+        game_list = _fetch_steam_game_editions(api_key, app_id)
+        if game_list:
+            with _steam_game_cache_lock:
+                _steam_game_cache[app_id] = (time.time(), game_list)
+                _steam_game_cache.move_to_end(app_id)
+                while len(_steam_game_cache) > _steam_game_cache_max_size:
+                    _steam_game_cache.popitem(last=False)
+        return game_list
+    finally:
+        with _steam_game_cache_lock:
+            _steam_game_inflight.pop(app_id, None)
+        inflight.set()
+
+
+EDITION_PATTERNS = [
+    # Полные названия изданий (приоритет)
+    (r'\bvault\s+edition\b', 'vault edition'),
+    (r'\bultimate\s+edition\b', 'ultimate edition'),
+    (r'\bdeluxe\s+edition\b', 'deluxe edition'),
+    (r'\bpremium\s+edition\b', 'premium edition'),
+    (r'\bgold\s+edition\b', 'gold edition'),
+    (r'\bstandard\s+edition\b', 'standard edition'),
+    (r'\brevolution\s+edition\b', 'revolution edition'),
+    (r'\bdefinitive\s+edition\b', 'definitive edition'),
+    (r'\bphantom\s+edition\b', 'phantom edition'),
+    (r'\bpalace\s+edition\b', 'palace edition'),
+    (r'\btournament\s+edition\b', 'tournament edition'),
+    (r'\ball-star\s+edition\b', 'all-star edition'),
+    (r'\bcomplete\s+edition\b', 'complete edition'),
+    (r'\bdigital\s+deluxe\b', 'digital deluxe'),
+    (r'\badvanced\s+edition\b', 'advanced edition'),
+    (r'\blegendary\s+edition\b', 'legendary edition'),
+    (r'\bcollector[\'\u2019]?s?\s+edition\b', 'collector edition'),
+    (r'\bgame\s+of\s+the\s+year\b', 'game of the year'),
+    (r'\bgoty\s+edition\b', 'goty edition'),
+    (r'\bgoty\b', 'goty'),
+    (r'\bchampion\s+edition\b', 'champion edition'),
+    (r'\banniversary\s+edition\b', 'anniversary edition'),
+    (r'\bspecial\s+edition\b', 'special edition'),
+    (r'\benhanced\s+edition\b', 'enhanced edition'),
+    (r'\bextended\s+edition\b', 'extended edition'),
+    (r'\bfounder[\'\u2019]?s?\s+edition\b', 'founder edition'),
+    (r'\blaunch\s+edition\b', 'launch edition'),
+    (r'\blimited\s+edition\b', 'limited edition'),
+    (r'\bplatinum\s+edition\b', 'platinum edition'),
+    (r'\bsilver\s+edition\b', 'silver edition'),
+    (r'\bbronze\s+edition\b', 'bronze edition'),
+    (r'\bsuper\s+deluxe\b', 'super deluxe'),
+    (r'\bseason\s+pass\s+edition\b', 'season pass edition'),
+    (r'\bbundle\b', 'bundle'),
+    (r'\bcollection\b', 'collection'),
+    # Короткие ключевые слова (меньший приоритет)
+    (r'\bvault\b', 'vault'),
+    (r'\bultimate\b', 'ultimate'),
+    (r'\bdeluxe\b', 'deluxe'),
+    (r'\bpremium\b', 'premium'),
+    (r'\bgold\b', 'gold'),
+    (r'\blegendary\b', 'legendary'),
+    (r'\bcollector\b', 'collector'),
+    (r'\bchampion\b', 'champion'),
+    (r'\bplatinum\b', 'platinum'),
+    (r'\benhanced\b', 'enhanced'),
+    (r'\bdefinitive\b', 'definitive'),
+    (r'\bcomplete\b', 'complete'),
+    (r'\bspecial\b', 'special'),
+]
+
+
+def _extract_edition_keywords(lot_name: str | None) -> tuple:
+    if not lot_name:
+        return ()
+    lot_name_lower = lot_name.lower()
+    return tuple(keyword for pattern, keyword in EDITION_PATTERNS if re.search(pattern, lot_name_lower))
+
+
+def _get_package_id_by_app_id(api_key: str, app_id: int, region: str = "KZ", game_name: str = None, lot_name: str = None, package_id: str = None) -> dict | None:
+    logger.debug(f"{LOGGER_PREFIX} [TEST] Получение package_id для app_id={app_id}, region={region}, game_name={game_name}, lot_name={lot_name}")
+    
+    game_list = _get_steam_game_editions(api_key, app_id)
+    if not game_list:
+        logger.warning(f"{LOGGER_PREFIX} Список изданий игры пуст для app_id={app_id}")
+        return None
+    
+    try:
+        edition_keywords = list(_extract_edition_keywords(lot_name))
+    
+        if game_name:
+            game_name_lower = game_name.lower()
+            game_name_normalized = _normalize_game_name(game_name)
+    
+        exact_matches = []
+        partial_matches = []
+        keyword_matches = []
+        other_editions = []
+    
+        for edition in game_list:
+            if not isinstance(edition, dict):
+                continue
+        
+            edition_package_id = edition.get("package_id")
+            if not edition_package_id:
+                continue
+        
+            edition_name = edition.get("edition", "").strip()
+            regions_info = edition.get("regions_info", [])
+            if not isinstance(regions_info, list):
+                regions_info = []
+        
+            region_price = None
+            region_found = False
+            for region_info in regions_info:
+                if isinstance(region_info, dict) and region_info.get("region") == region:
+                    region_found = True
+                    price_value = region_info.get("price")
+                    currency_value = region_info.get("currency") or region_info.get("curr")
+                    logger.debug(f"{LOGGER_PREFIX} [TEST] Регион {region}: price={price_value}, currency={currency_value}, полные данные: {json.dumps(region_info, ensure_ascii=False)[:200]}")
+                    if price_value is not None:
+                        try:
+                            region_price = float(price_value)
+                        except (ValueError, TypeError):
+                            logger.warning(f"{LOGGER_PREFIX} [TEST] Неверный формат цены для региона {region}: {price_value}")
+                            region_price = None
+                    break
+        
+            if not region_found and regions_info:
+                first_region_info = regions_info[0] if regions_info else None
+                if first_region_info and isinstance(first_region_info, dict):
+                    price_value = first_region_info.get("price")
+                    if price_value is not None:
+                        try:
+                            region_price = float(price_value)
+                            logger.debug(f"{LOGGER_PREFIX} [TEST] Регион {region} не найден, используется цена из первого доступного региона: {region_price}")
+                        except (ValueError, TypeError):
+                            region_price = None
+        
+            if region_price is None:
+                if regions_info:
+                    for alt_region_info in regions_info:
+                        if isinstance(alt_region_info, dict):
+                            alt_price = alt_region_info.get("price")
+                            if alt_price is not None:
+                                try:
+                                    region_price = float(alt_price)
+                                    logger.debug(f"{LOGGER_PREFIX} [TEST] Цена для региона {region} не найдена, используется альтернативная цена: {region_price}")
+                                    break
+                                except (ValueError, TypeError):
+                                    continue
+                if region_price is None:
+                    logger.warning(f"{LOGGER_PREFIX} [TEST] Цена для региона {region} не найдена для издания '{edition_name}'")
+                    continue
+        
+            edition_info = {
+                "package_id": str(edition_package_id),
+                "price": region_price,
+                "edition": edition_name
+            }
+        
+            if package_id and edition_info["package_id"] == str(package_id):
+                logger.debug(f"{LOGGER_PREFIX} [PRICE] Использовано привязанное издание: edition='{edition_name}', package_id={package_id}, region={region}, price={region_price} USD")
+                return edition_info
+        
+            edition_lower = edition_name.lower().strip()
+            edition_normalized = _normalize_game_name(edition_name)
+            matched = False
+            match_score = 0
+        
+            # Маппинг синонимов для поиска изданий
+            keyword_synonyms = {
+                'goty': ['goty', 'game of the year'],
+                'game of the year': ['goty', 'game of the year'],
+                'collector edition': ['collector', 'collector edition', "collector's edition"],
+                'collector': ['collector', 'collector edition', "collector's edition"],
+                'founder edition': ['founder', 'founder edition', "founder's edition"],
+                'founder': ['founder', 'founder edition', "founder's edition"],
+            }
+        
+            if edition_keywords:
+                for keyword in edition_keywords:
+                    # Получаем список синонимов для ключевого слова
+                    synonyms = keyword_synonyms.get(keyword, [keyword])
+                    for synonym in synonyms:
+                        if synonym in edition_lower:
+                            keyword_matches.append(edition_info)
+                            matched = True
+                            match_score = 100
+                            break
+                    if matched:
+                        break
+        
+            if not matched and game_name:
+                game_name_lower = game_name.lower().strip()
+                game_name_normalized = _normalize_game_name(game_name)
+            
+                if game_name_normalized == edition_normalized or game_name_lower == edition_lower:
+                    exact_matches.append(edition_info)
+                    matched = True
+                    match_score = 90
+                elif game_name_normalized in edition_normalized:
+                    similarity = len(game_name_normalized) / len(edition_normalized)
+                    if similarity >= 0.7:
+                        partial_matches.append(edition_info)
+                        matched = True
+                        match_score = int(similarity * 80)
+                elif edition_normalized in game_name_normalized:
+                    similarity = len(edition_normalized) / len(game_name_normalized)
+                    if similarity >= 0.7:
+                        partial_matches.append(edition_info)
+                        matched = True
+                        match_score = int(similarity * 80)
+                else:
+                    game_words = set(game_name_normalized.split())
+                    edition_words = set(edition_normalized.split())
+                    common_words = game_words & edition_words
+                
+                    if common_words and len(common_words) >= 2:
+                        similarity = len(common_words) / max(len(game_words), len(edition_words))
+                        if similarity >= 0.6:
+                            partial_matches.append(edition_info)
+                            matched = True
+                            match_score = int(similarity * 70)
+        
+            if not matched:
+                other_editions.append(edition_info)
+
+        if keyword_matches:
+            for match in keyword_matches:
+                edition_words = set(_normalize_game_name(match["edition"]).split())
+                if game_name:
+                    game_words = set(_normalize_game_name(game_name).split())
+                    common_words = game_words & edition_words
+                    match["word_overlap"] = len(common_words)
+                else:
+                    match["word_overlap"] = 0
+            keyword_matches.sort(key=lambda x: (-x.get("word_overlap", 0), x["price"], len(x["edition"])))
+            if keyword_matches:
+                selected = keyword_matches[0]
+                logger.info(f"{LOGGER_PREFIX} [PRICE] Найдено совпадение по ключевому слову издания: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
+                return {
+                    "package_id": selected["package_id"],
+                    "price": selected["price"],
+                    "edition": selected["edition"]
+                }
+
+        if exact_matches:
+            for match in exact_matches:
+                edition_words = set(_normalize_game_name(match["edition"]).split())
+                if game_name:
+                    game_words = set(_normalize_game_name(game_name).split())
+                    common_words = game_words & edition_words
+                    match["word_overlap"] = len(common_words)
+                else:
+                    match["word_overlap"] = 0
+            exact_matches.sort(key=lambda x: (-x.get("word_overlap", 0), x["price"], len(x["edition"])))
+            if exact_matches:
+                selected = exact_matches[0]
+                logger.info(f"{LOGGER_PREFIX} [PRICE] Найдено точное совпадение издания: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
+                return {
+                    "package_id": selected["package_id"],
+                    "price": selected["price"],
+                    "edition": selected["edition"]
+                }
+
+        if partial_matches:
+            for match in partial_matches:
+                edition_words = set(_normalize_game_name(match["edition"]).split())
+                if game_name:
+                    game_words = set(_normalize_game_name(game_name).split())
+                    common_words = game_words & edition_words
+                    match["word_overlap"] = len(common_words)
+                else:
+                    match["word_overlap"] = 0
+            partial_matches.sort(key=lambda x: (-x.get("word_overlap", 0), x["price"], len(x["edition"])))
+            if partial_matches:
+                selected = partial_matches[0]
+                logger.info(f"{LOGGER_PREFIX} [PRICE] Найдено частичное совпадение издания: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
+                return {
+                    "package_id": selected["package_id"],
+                    "price": selected["price"],
+                    "edition": selected["edition"]
+                }
+
+        if other_editions:
+            standard_editions = [e for e in other_editions if "standard" in e["edition"].lower() and not any(x in e["edition"].lower() for x in ["deluxe", "ultimate", "premium", "gold", "vault"])]
+            if standard_editions:
+                standard_editions.sort(key=lambda x: (x["price"], len(x["edition"])))
+                selected = standard_editions[0]
+                logger.warning(f"{LOGGER_PREFIX} [PRICE] Используется стандартное издание: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
+            else:
+                other_editions.sort(key=lambda x: (x["price"], len(x["edition"])))
+                selected = other_editions[0]
+                logger.warning(f"{LOGGER_PREFIX} [PRICE] Совпадение не найдено, используется самое дешевое издание: edition='{selected['edition']}', package_id={selected['package_id']}, region={region}, price={selected['price']} USD")
+            return {
+                "package_id": selected["package_id"],
+                "price": selected["price"],
+                "edition": selected["edition"]
+            }
+    
+        logger.warning(f"{LOGGER_PREFIX} package_id не найден в ответе для app_id={app_id}")
+        return None
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка при выборе издания для app_id={app_id}: {e}", exc_info=True)
+        return None
 
 
-def _send_steam_gift(api_key: str, app_id: int, friend_link: str, region: str = "KZ", game_name: str = None, lot_name: str = None) -> dict | None:
+def _send_steam_gift(api_key: str, app_id: int, friend_link: str, region: str = "KZ", game_name: str = None, lot_name: str = None, package_id: str = None,
+                     package_info: dict | None = None) -> dict | None:
     try:
         logger.debug(f"{LOGGER_PREFIX} [TEST] Отправка подарка через DesslyHub API: app_id={app_id}, friend_link={friend_link}, region={region}, game_name={game_name}, lot_name={lot_name}")
         
-        package_info = _get_package_id_by_app_id(api_key, app_id, region, game_name=game_name, lot_name=lot_name)
+        if package_info is None:
+            package_info = _get_package_id_by_app_id(api_key, app_id, region, game_name=game_name, lot_name=lot_name, package_id=package_id)
         if not package_info:
             logger.error(f"{LOGGER_PREFIX} Не удалось получить package_id для app_id={app_id}")
             return None
@@ -1340,7 +2518,7 @@ def _send_steam_gift(api_key: str, app_id: int, friend_link: str, region: str =
         logger.debug(f"{LOGGER_PREFIX} [TEST] Payload (типы): invite_url={type(payload['invite_url']).__name__}, package_id={type(payload['package_id']).__name__}, region={type(payload['region']).__name__}")
         logger.debug(f"{LOGGER_PREFIX} [TEST] Payload (значения): {json.dumps(payload, ensure_ascii=False)}")
         
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = _get_http_session().post(url, headers=headers, json=payload, timeout=30)
         
         logger.debug(f"{LOGGER_PREFIX} [TEST] Ответ DesslyHub: status_code={response.status_code}")
         logger.debug(f"{LOGGER_PREFIX} [TEST] Response text: {response.text[:1000]}")
@@ -1419,7 +2597,7 @@ def _get_mobile_games(api_key: str) -> list | None:
             "Content-Type": "application/json"
         }
         
-        response = requests.get(url, headers=headers, timeout=30)
+        response = _get_http_session().get(url, headers=headers, timeout=30)
         
         if response.status_code == 200:
             data = response.json()
@@ -1462,7 +2640,7 @@ def _get_mobile_game_by_id(api_key: str, game_id: int) -> dict | None:
             "Content-Type": "application/json"
         }
         
-        response = requests.get(url, headers=headers, timeout=30)
+        response = _get_http_session().get(url, headers=headers, timeout=30)
         
         if response.status_code == 200:
             data = response.json()
@@ -1650,7 +2828,7 @@ def _send_mobile_refill(api_key: str, position_id: int, fields: dict, reference:
         logger.info(f"{LOGGER_PREFIX} [MOBILE] Запрос к DesslyHub: URL={url}")
         logger.info(f"{LOGGER_PREFIX} [MOBILE] Payload: {json.dumps(payload, ensure_ascii=False)}")
         
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        response = _get_http_session().post(url, headers=headers, json=payload, timeout=30)
         
         logger.info(f"{LOGGER_PREFIX} [MOBILE] Ответ DesslyHub: status_code={response.status_code}")
         logger.info(f"{LOGGER_PREFIX} [MOBILE] Response text: {response.text[:1000]}")
@@ -1784,6 +2962,7 @@ def _create_or_update_lot(cardinal: "Cardinal", game_name: str, lot_id: int | No
         lot_fields.active = True
         
         account.save_lot(lot_fields)
+        _get_lot_fields_cache().invalidate(lot_id)
         logger.info(f"{LOGGER_PREFIX} Лот {lot_id} обновлен для игры '{game_name}'")
         return True
         
@@ -1961,9 +3140,10 @@ def _derive_game_name(lot_name: str, raw_game_name: str | None) -> str:
     return raw_game_name or lot_name
 
 def _calculate_similarity(name1: str, name2: str) -> float:
-    norm1 = _normalize_lot_name(name1)
-    norm2 = _normalize_lot_name(name2)
-    
+    return _calculate_normalized_similarity(_normalize_lot_name(name1), _normalize_lot_name(name2))
+
+
+def _calculate_normalized_similarity(norm1: str, norm2: str) -> float:
     if norm1 == norm2:
         return 1.0
     
@@ -1988,11 +3168,56 @@ def _calculate_similarity(name1: str, name2: str) -> float:
     
     return (jaccard * 0.5 + word_coverage * 0.5)
 
-def _find_lot_by_name_in_profile(cardinal: "Cardinal", lot_name: str) -> types.LotShortcut | None:
-    try:
-        if not hasattr(cardinal, 'profile') or not cardinal.profile:
-            return None
+
+class ProfileLotsSnapshot:
+    """Снимок лотов профиля FunPay с предрассчитанными признаками для сопоставления"""
+    
+    REGIONS = ["турция", "россия", "беларусь", "украина", "казахстан", "аргентина", "любой"]
+    EDITIONS = ["deluxe", "standard", "gold", "premium", "revolution", "definitive", "ultimate"]
+    
+    def __init__(self, lots: list):
+        self.created_at = time.time()
+        self.entries: list[dict] = []
+        self.by_id: dict = {}
+        self._by_normalized: dict[str, types.LotShortcut] = {}
+        self._by_lower: dict[str, types.LotShortcut] = {}
+        self._by_word: dict[str, list[int]] = {}
         
+        for lot in lots:
+            self.by_id[lot.id] = lot
+            description = (lot.description or "").strip()
+            if not description:
+                continue
+            
+            normalized = _normalize_lot_name(description)
+            lower = description.lower()
+            entry = {
+                "lot": lot,
+                "normalized": normalized,
+                "lower": lower,
+                "words": set(normalized.split()),
+                "base": _extract_base_game_name(description),
+                "region": self._detect(lower, self.REGIONS),
+                "edition": self._detect(lower, self.EDITIONS),
+            }
+            entry["base_words"] = set(entry["base"].split())
+            for word in entry["words"]:
+                self._by_word.setdefault(word, []).append(len(self.entries))
+            self.entries.append(entry)
+            self._by_normalized.setdefault(normalized, lot)
+            self._by_lower.setdefault(lower, lot)
+    
+    @staticmethod
+    def _detect(text: str, words: list[str]) -> str | None:
+        for word in words:
+            if word in text:
+                return word
+        return None
+    
+    @classmethod
+    def fetch(cls, cardinal: "Cardinal") -> "ProfileLotsSnapshot":
+        """Загружает профиль один раз и строит по нему снимок"""
+        lots = []
         try:
             if hasattr(cardinal, 'account') and cardinal.account and cardinal.account.is_initiated:
                 updated_profile = cardinal.account.get_user(cardinal.account.id)
@@ -2004,138 +3229,95 @@ def _find_lot_by_name_in_profile(cardinal: "Cardinal", lot_name: str) -> types.L
         except Exception as e:
             logger.debug(f"{LOGGER_PREFIX} Не удалось обновить профиль: {e}")
         
-        if 'lots' not in locals() or not lots:
+        if not lots and hasattr(cardinal, 'profile') and cardinal.profile:
             lots_dict = cardinal.profile.get_sorted_lots(1)
             lots = list(lots_dict.values()) if lots_dict else []
-        
-        if not lots:
-            lots = cardinal.profile.get_lots()
+            if not lots:
+                lots = cardinal.profile.get_lots()
         
         if hasattr(cardinal, 'curr_profile') and cardinal.curr_profile:
             try:
                 curr_lots_dict = cardinal.curr_profile.get_sorted_lots(1)
                 curr_lots = list(curr_lots_dict.values()) if curr_lots_dict else []
                 if curr_lots:
-                    lots.extend(curr_lots)
                     unique_lots = {}
-                    for lot in lots:
+                    for lot in list(lots) + curr_lots:
                         unique_lots[lot.id] = lot
                     lots = list(unique_lots.values())
             except Exception:
                 pass
+        
+        return cls(lots)
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def get(self, lot_id) -> types.LotShortcut | None:
+        lot = self.by_id.get(lot_id)
+        if lot is None and isinstance(lot_id, str) and lot_id.isnumeric():
+            lot = self.by_id.get(int(lot_id))
+        return lot
+    
+    def find(self, lot_name: str) -> types.LotShortcut | None:
+        """Ищет лот профиля по названию лота из конфига"""
         lot_name_normalized = _normalize_lot_name(lot_name)
         lot_name_lower = lot_name.lower().strip()
-        lot_base_name = _extract_base_game_name(lot_name)
         
-        regions = ["турция", "россия", "беларусь", "украина", "казахстан", "аргентина", "любой"]
-        editions = ["deluxe", "standard", "gold", "premium", "revolution", "definitive", "ultimate"]
+        exact_match = self._by_normalized.get(lot_name_normalized) or self._by_lower.get(lot_name_lower)
+        if exact_match:
+            logger.debug(f"{LOGGER_PREFIX} Найдено точное совпадение для '{lot_name}': ID={exact_match.id}, описание='{exact_match.description}'")
+            return exact_match
         
-        lot_region = None
-        lot_edition = None
-        for region in regions:
-            if region in lot_name_lower:
-                lot_region = region
-                break
-        for edition in editions:
-            if edition in lot_name_lower:
-                lot_edition = edition
-                break
+        lot_base_name = _extract_base_game_name(lot_name)
+        lot_base_words = set(lot_base_name.split())
+        lot_region = self._detect(lot_name_lower, self.REGIONS)
+        lot_edition = self._detect(lot_name_lower, self.EDITIONS)
         
         logger.debug(f"{LOGGER_PREFIX} Поиск лота '{lot_name}': извлеченный регион='{lot_region}', издание='{lot_edition}'")
         
-        exact_match = None
         all_matches = []
-        
         lot_name_words = set(lot_name_normalized.split())
+        candidates = sorted({index for word in lot_name_words for index in self._by_word.get(word, ())})
         
-        for lot in lots:
-            lot_desc = (lot.description or "").strip()
-            if not lot_desc:
-                continue
-            
-            lot_desc_normalized = _normalize_lot_name(lot_desc)
-            lot_desc_lower = lot_desc.lower()
-            lot_desc_base = _extract_base_game_name(lot_desc)
-            
-            base_overlap = True
+        for entry in (self.entries[index] for index in candidates):
             if lot_base_name:
-                if lot_desc_base:
-                    if lot_base_name in lot_desc_base or lot_desc_base in lot_base_name:
-                        base_overlap = True
-                    else:
-                        base_overlap = bool(set(lot_base_name.split()) & set(lot_desc_base.split()))
-                else:
-                    base_overlap = False
-            if not base_overlap:
-                continue
-            
-            if lot_name_normalized == lot_desc_normalized or lot_name_lower == lot_desc_lower:
-                exact_match = lot
-                logger.debug(f"{LOGGER_PREFIX} Найдено точное совпадение для '{lot_name}': ID={exact_match.id}, описание='{exact_match.description}'")
-                break
-            
-            lot_desc_words = set(lot_desc_normalized.split())
-            common_words = lot_name_words & lot_desc_words
+                lot_desc_base = entry["base"]
+                if not lot_desc_base:
+                    continue
+                if not (lot_base_name in lot_desc_base or lot_desc_base in lot_base_name or lot_base_words & entry["base_words"]):
+                    continue
             
+            common_words = lot_name_words & entry["words"]
             if not common_words:
                 continue
             
             if len(common_words) == len(lot_name_words) and len(lot_name_words) >= 2:
                 similarity = 0.9
             else:
-                similarity = _calculate_similarity(lot_name, lot_desc)
+                similarity = _calculate_normalized_similarity(lot_name_normalized, entry["normalized"])
             
             if similarity < 0.5:
                 continue
             
-            desc_region = None
-            desc_edition = None
-            for region in regions:
-                if region in lot_desc_lower:
-                    desc_region = region
-                    break
-            for edition in editions:
-                if edition in lot_desc_lower:
-                    desc_edition = edition
-                    break
-            
-            region_match = False
+            lot_desc_lower = entry["lower"]
             if lot_region and lot_region != "любой":
-                if desc_region and desc_region == lot_region:
-                    region_match = True
-                elif lot_region in lot_desc_lower:
-                    region_match = True
-            else:
-                region_match = True
+                if entry["region"] != lot_region and lot_region not in lot_desc_lower:
+                    continue
             
-            if not region_match:
+            if lot_edition and entry["edition"] != lot_edition and lot_edition not in lot_desc_lower:
                 continue
             
-            edition_match = True
-            if lot_edition:
-                if desc_edition and desc_edition == lot_edition:
-                    edition_match = True
-                elif lot_edition in lot_desc_lower:
-                    edition_match = True
-                else:
-                    edition_match = False
-            
-            if lot_name_normalized in lot_desc_normalized or lot_desc_normalized in lot_name_normalized:
+            if lot_name_normalized in entry["normalized"] or entry["normalized"] in lot_name_normalized:
                 similarity = 0.9
             
-            if region_match and edition_match:
-                all_matches.append((lot, similarity, region_match, edition_match))
-        
-        if exact_match:
-            return exact_match
+            all_matches.append((entry["lot"], similarity))
         
         if not all_matches:
             logger.debug(f"{LOGGER_PREFIX} Лот не найден для '{lot_name}'")
             return None
         
-        all_matches.sort(key=lambda x: (x[2], x[3], x[1]), reverse=True)
-        best_match = all_matches[0][0]
-        best_similarity = all_matches[0][1]
+        all_matches.sort(key=lambda x: x[1], reverse=True)
+        best_match, best_similarity = all_matches[0]
         
         if best_similarity < 0.6:
             logger.warning(f"{LOGGER_PREFIX} ⚠️ Схожесть слишком низкая для '{lot_name}': ID={best_match.id}, схожесть={best_similarity:.2f}, описание='{best_match.description}'")
@@ -2143,33 +3325,410 @@ def _find_lot_by_name_in_profile(cardinal: "Cardinal", lot_name: str) -> types.L
         
         logger.debug(f"{LOGGER_PREFIX} Найдено совпадение для '{lot_name}': ID={best_match.id}, схожесть={best_similarity:.2f}, описание='{best_match.description}'")
         return best_match
-        
+
+
+class LotFieldsCache:
+    """Последняя известная цена каждого лота FunPay (прочитанная или записанная нами)"""
+    
+    def __init__(self, max_age: int):
+        self.max_age = max_age
+        self._entries: dict[int, dict] = {}
+        self._active: dict[int, tuple[bool, float]] = {}
+        self._lock = threading.Lock()
+    
+    def get_price(self, lot_id: int) -> float | None:
+        with self._lock:
+            entry = self._entries.get(lot_id)
+            if entry is None:
+                return None
+            if time.time() - entry["fetched_at"] >= self.max_age:
+                del self._entries[lot_id]
+                return None
+            return entry["price"]
+    
+    def remember(self, lot_id: int, price: float, written: bool = False) -> None:
+        with self._lock:
+            self._entries[lot_id] = {"price": price, "fetched_at": time.time(), "written": written}
+    
+    def get_active(self, lot_id: int) -> bool | None:
+        with self._lock:
+            entry = self._active.get(lot_id)
+            if entry is None:
+                return None
+            if time.time() - entry[1] >= self.max_age:
+                del self._active[lot_id]
+                return None
+            return entry[0]
+    
+    def remember_active(self, lot_id: int, active: bool) -> None:
+        with self._lock:
+            self._active[lot_id] = (bool(active), time.time())
+    
+    def invalidate(self, lot_id: int) -> None:
+        with self._lock:
+            self._entries.pop(lot_id, None)
+            self._active.pop(lot_id, None)
+
+
+def _get_lot_fields_cache() -> LotFieldsCache:
+    global _lot_fields_cache
+    with _lot_fields_cache_lock:
+        if _lot_fields_cache is None:
+            _lot_fields_cache = LotFieldsCache(LOT_FIELDS_MAX_AGE)
+        return _lot_fields_cache
+
+
+def _find_lot_by_name_in_profile(cardinal: "Cardinal", lot_name: str, snapshot: ProfileLotsSnapshot | None = None) -> types.LotShortcut | None:
+    try:
+        if snapshot is None:
+            if not hasattr(cardinal, 'profile') or not cardinal.profile:
+                return None
+            snapshot = ProfileLotsSnapshot.fetch(cardinal)
+        return snapshot.find(lot_name)
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка поиска лота '{lot_name}': {e}")
         return None
 
-def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
+def _price_sync_inputs_unchanged(lot_name: str, inputs: dict) -> bool:
+    """Проверяет, изменились ли входные данные цены лота с момента последней записи на FunPay"""
+    with _price_sync_state_lock:
+        upstream_key = inputs["upstream_key"]
+        previous_upstream = _price_sync_state["upstream"].get(upstream_key)
+        if previous_upstream is not None and abs(previous_upstream - inputs["base_price_usd"]) > 1e-9:
+            logger.info(f"{LOGGER_PREFIX} [PRICE] Изменилась цена {upstream_key}: {previous_upstream:.2f} -> {inputs['base_price_usd']:.2f} USD")
+        _price_sync_state["upstream"][upstream_key] = inputs["base_price_usd"]
+        previous = _price_sync_state["lots"].get(lot_name)
+    if not previous:
+        return False
+    for key in ("upstream_key", "config_hash", "markup_percent"):
+        if previous[key] != inputs[key]:
+            return False
+    if abs(previous["base_price_usd"] - inputs["base_price_usd"]) > 1e-9:
+        return False
+    previous_rate = previous["rub_rate"]
+    return previous_rate > 0 and abs(inputs["rub_rate"] - previous_rate) / previous_rate <= PRICE_SYNC_FX_TOLERANCE
+
+
+def _remember_price_sync(lot_name: str, inputs: dict, written_price: float) -> None:
+    with _price_sync_state_lock:
+        _price_sync_state["lots"][lot_name] = dict(inputs, written_price=written_price, time=time.time())
+
+
+def _resolve_sync_game_name(lot_name: str, raw_game_name: str) -> str:
+    game_name = _derive_game_name(lot_name, raw_game_name)
+    if game_name and (game_name == lot_name or (len(game_name) > 20 and any(x in game_name for x in ['[АВТОВЫДАЧА]', '🎁', '🔵STEAM', 'ПОДАРКОМ']))):
+        cleaned_base = _extract_base_game_name(game_name)
+        if cleaned_base and len(cleaned_base) > 1:
+            formatted_name = _format_base_game_name(cleaned_base)
+            if formatted_name:
+                logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Очищено название игры: '{game_name}' -> '{formatted_name}'")
+                game_name = formatted_name
+    return game_name
+
+
+class PriceSyncPlanner:
+    """Общие для цикла синхронизации запросы к DesslyHub: одна выборка на (app_id, регион, издание)"""
+    
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._lock = threading.Lock()
+        self._results: dict[tuple, any] = {}
+        self._inflight: dict[tuple, threading.Event] = {}
+        self.requested = 0
+        self.fetched = 0
+    
+    def _once(self, key: tuple, fn, *args):
+        with self._lock:
+            self.requested += 1
+            if key in self._results:
+                return self._results[key]
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self._inflight[key] = event
+        if not owner:
+            event.wait()
+            with self._lock:
+                return self._results.get(key)
+        value = None
+        try:
+            value = fn(*args)
+            return value
+        finally:
+            with self._lock:
+                self._results[key] = value
+                self.fetched += 1
+                self._inflight.pop(key, None)
+            event.set()
+    
+    def app_id(self, game_name: str) -> int | None:
+        return self._once(("app_id", _normalize_game_name(game_name)), _get_game_app_id_by_name, game_name, self.api_key)
+    
+    @staticmethod
+    def package_key(app_id: int, region: str, game_name: str, lot_name: str, package_id: str = None) -> tuple:
+        if package_id:
+            return ("package", app_id, region, str(package_id))
+        return ("package", app_id, region, _extract_edition_keywords(lot_name), _normalize_game_name(game_name or ""))
+    
+    def package_info(self, app_id: int, region: str, game_name: str, lot_name: str, package_id: str = None) -> dict | None:
+        key = self.package_key(app_id, region, game_name, lot_name, package_id)
+        return self._once(key, _get_package_id_by_app_id, self.api_key, app_id, region, game_name, lot_name, package_id)
+    
+    def mobile_game(self, game_id: int) -> dict | None:
+        return self._once(("mobile", game_id), _get_mobile_game_by_id, self.api_key, game_id)
+    
+    def plan(self, lots_config: list) -> int:
+        """Разрешает app_id лотов Steam, прогревает кэш изданий по уникальным играм и возвращает число групп"""
+        groups = set()
+        app_ids = set()
+        for lot_config in lots_config:
+            lot_name = lot_config.get("lot_name", "").strip()
+            if not lot_name or lot_config.get("type", "").strip().lower() != "steam gift":
+                continue
+            binding = _get_lot_binding(lot_config, self.api_key) or {}
+            game_name = _resolve_sync_game_name(lot_name, lot_config.get("game_name", "").strip())
+            app_id = binding.get("app_id") or (self.app_id(game_name) if game_name else None)
+            if not app_id:
+                continue
+            app_ids.add(app_id)
+            groups.add(self.package_key(app_id, lot_config.get("region", "KZ"), game_name, lot_name, binding.get("package_id")))
+        if app_ids:
+            with ThreadPoolExecutor(max_workers=min(SYNC_MAX_WORKERS, len(app_ids))) as executor:
+                list(executor.map(lambda app_id: _get_steam_game_editions(self.api_key, app_id), app_ids))
+        return len(groups)
+
+
+class PriceSyncScheduler:
+    """Расписание синхронизации цен: у каждого лота свое время следующей проверки"""
+    
+    MIN_INTERVAL = 60
+    BASE_INTERVAL = 600
+    MAX_INTERVAL = 3600
+    SALES_WINDOW = 86400
+    
+    def __init__(self, writes_per_minute: int):
+        self.writes_per_minute = writes_per_minute
+        self._lock = threading.Lock()
+        self._cycle_lock = threading.Lock()
+        self._lots: dict[str, dict] = {}
+        self._writes: deque = deque()
+    
+    def _state(self, lot_name: str) -> dict:
+        state = self._lots.get(lot_name)
+        if state is None:
+            state = {"next_due": 0.0, "interval": self.BASE_INTERVAL, "errors": 0, "last_error": None, "sales": deque()}
+            self._lots[lot_name] = state
+        return state
+    
+    def _effective_interval(self, state: dict, now: float) -> float:
+        sales = state["sales"]
+        while sales and now - sales[0] > self.SALES_WINDOW:
+            sales.popleft()
+        interval = state["interval"] / (1 + len(sales))
+        return max(self.MIN_INTERVAL, min(self.MAX_INTERVAL, interval))
+    
+    def due(self, lot_names: list[str]) -> list[str]:
+        """Возвращает лоты, которым пора обновить цену (самые просроченные первыми)"""
+        now = time.time()
+        with self._lock:
+            wanted = set(lot_names)
+            for lot_name in list(self._lots):
+                if lot_name not in wanted:
+                    del self._lots[lot_name]
+            due = [(self._state(lot_name)["next_due"], lot_name) for lot_name in wanted if lot_name]
+        return [lot_name for next_due, lot_name in sorted(due) if next_due <= now]
+    
+    def wait_time(self) -> float:
+        with self._lock:
+            if not self._lots:
+                return 60.0
+            next_due = min(state["next_due"] for state in self._lots.values())
+        return max(5.0, min(60.0, next_due - time.time()))
+    
+    def record(self, lot_name: str, result: dict | None) -> None:
+        now = time.time()
+        with self._lock:
+            state = self._state(lot_name)
+            if result is None or result.get("error"):
+                state["errors"] += 1
+                state["last_error"] = (result or {}).get("error", "unknown")
+                interval = min(self.MAX_INTERVAL, self.MIN_INTERVAL * 2 ** min(state["errors"], 6))
+            else:
+                state["errors"] = 0
+                state["last_error"] = None
+                if result.get("deferred"):
+                    state["next_due"] = now + self.MIN_INTERVAL
+                    return
+                if result.get("skipped"):
+                    state["interval"] = min(self.MAX_INTERVAL, state["interval"] * 1.5)
+                else:
+                    state["interval"] = max(self.MIN_INTERVAL, state["interval"] / 2)
+                interval = self._effective_interval(state, now)
+            state["next_due"] = now + interval
+    
+    def mark_due(self, lot_names: list[str]) -> None:
+        now = time.time()
+        with self._lock:
+            for lot_name in lot_names:
+                self._state(lot_name)["next_due"] = now
+    
+    def seed_sales(self, orders: list[dict]) -> int:
+        """Восстанавливает продажи за SALES_WINDOW из истории заказов (после перезапуска)"""
+        now = time.time()
+        seeded = 0
+        with self._lock:
+            for order in sorted(orders, key=lambda x: x.get("timestamp", 0) or 0):
+                lot_name = (order.get("lot_name") or "").strip()
+                timestamp = order.get("timestamp", 0) or 0
+                if not lot_name or now - timestamp > self.SALES_WINDOW:
+                    continue
+                self._state(lot_name)["sales"].append(timestamp)
+                seeded += 1
+        return seeded
+    
+    def note_sale(self, lot_name: str) -> None:
+        now = time.time()
+        with self._lock:
+            state = self._state(lot_name)
+            state["sales"].append(now)
+            state["next_due"] = min(state["next_due"], now + self.MIN_INTERVAL)
+    
+    def acquire_write(self) -> bool:
+        """Ограничивает число записей на FunPay в минуту"""
+        now = time.time()
+        with self._lock:
+            while self._writes and now - self._writes[0] >= 60:
+                self._writes.popleft()
+            if len(self._writes) >= self.writes_per_minute:
+                return False
+            self._writes.append(now)
+            return True
+    
+    @contextmanager
+    def cycle(self):
+        acquired = self._cycle_lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self._cycle_lock.release()
+
+
+def _get_price_sync_scheduler() -> PriceSyncScheduler:
+    global _price_sync_scheduler
+    with _price_sync_scheduler_lock:
+        if _price_sync_scheduler is None:
+            _price_sync_scheduler = PriceSyncScheduler(PRICE_SYNC_WRITES_PER_MINUTE)
+            try:
+                orders = _get_storage().load_order_index(status="success", since=time.time() - PriceSyncScheduler.SALES_WINDOW)
+                seeded = _price_sync_scheduler.seed_sales(orders)
+                if seeded:
+                    logger.info(f"{LOGGER_PREFIX} [PRICE] Учтено {seeded} продаж из истории заказов для расписания синхронизации")
+            except Exception as e:
+                logger.warning(f"{LOGGER_PREFIX} [PRICE] Не удалось загрузить продажи из истории заказов: {e}")
+        return _price_sync_scheduler
+
+
+def _get_repricing_policy(settings) -> dict:
+    return {
+        "abs_band": float(settings.get("reprice_abs_deadband", 1.0)),
+        "pct_band": float(settings.get("reprice_pct_deadband", 1.0)),
+        "lower_pct": float(settings.get("reprice_lower_threshold_pct", 3.0)),
+        "write_budget": int(settings.get("reprice_write_budget", 20))
+    }
+
+
+def _decide_reprice(current_price: float, target_price: float, cost_price: float, policy: dict) -> str:
+    """Возвращает "loss" (продаем в убыток), "raise", "lower" или "hold" (оставить текущую цену)"""
+    if cost_price > 0 and current_price < cost_price:
+        return "loss"
+    diff = target_price - current_price
+    if diff > 0:
+        return "raise" if diff >= max(policy["abs_band"], current_price * policy["pct_band"] / 100) else "hold"
+    return "lower" if -diff >= max(policy["abs_band"], current_price * policy["lower_pct"] / 100) else "hold"
+
+
+def _bulk_reprice(base_prices_usd: list, markups: list, rub_rates: list, current_prices: list, policy: dict) -> tuple[list, list, list]:
+    """Считает целевые цены в RUB, себестоимость и решения _decide_reprice для всех лотов за один проход
+    (None в current_prices - цена на FunPay неизвестна, решение "unknown")"""
+    if np is not None and base_prices_usd:
+        base = np.asarray(base_prices_usd, dtype=float)
+        rate = np.asarray(rub_rates, dtype=float)
+        current = np.array([np.nan if price is None else price for price in current_prices], dtype=float)
+        targets = np.round(base * (1 + np.asarray(markups, dtype=float) / 100.0) * rate, 2)
+        costs = base * rate
+        diff = targets - current
+        known = ~np.isnan(current)
+        loss = known & (costs > 0) & (current < costs)
+        raise_mask = known & ~loss & (diff > 0) & (diff >= np.maximum(policy["abs_band"], current * policy["pct_band"] / 100))
+        lower_mask = known & ~loss & (diff < 0) & (-diff >= np.maximum(policy["abs_band"], current * policy["lower_pct"] / 100))
+        actions = np.select([~known, loss, raise_mask, lower_mask], ["unknown", "loss", "raise", "lower"], default="hold")
+        return targets.tolist(), costs.tolist(), actions.tolist()
+    
+    targets, costs, actions = [], [], []
+    for base, markup, rate, current in zip(base_prices_usd, markups, rub_rates, current_prices):
+        target = round(_calculate_price_with_markup(base, markup) * rate, 2)
+        cost = base * rate
+        targets.append(target)
+        costs.append(cost)
+        actions.append("unknown" if current is None else _decide_reprice(current, target, cost, policy))
+    return targets, costs, actions
+
+
+def _reprice_rows(rows: list, price_key: str, policy: dict) -> list[str]:
+    targets, costs, actions = _bulk_reprice(
+        [priced["base_price_usd"] for _, priced in rows],
+        [priced["markup_percent"] for _, priced in rows],
+        [priced["rub_rate"] for _, priced in rows],
+        [priced.get(price_key) for _, priced in rows],
+        policy
+    )
+    for (_, priced), target, cost in zip(rows, targets, costs):
+        priced["target_price"] = target
+        priced["cost_price"] = cost
+    return actions
+
+
+def _reprice_known_lots(markup_percent: float, rub_rate: float | None = None, policy: dict | None = None) -> list[dict]:
+    """Пересчитывает цены всех лотов по последним известным входным данным, без запросов к DesslyHub и FunPay"""
+    with _price_sync_state_lock:
+        states = [(lot_name, dict(state)) for lot_name, state in _price_sync_state["lots"].items()]
+    rows = [(lot_name, {
+        "base_price_usd": state["base_price_usd"],
+        "markup_percent": markup_percent,
+        "rub_rate": rub_rate or state["rub_rate"],
+        "known_price": state.get("written_price"),
+        "upstream_key": state["upstream_key"]
+    }) for lot_name, state in states]
+    actions = _reprice_rows(rows, "known_price", policy or _get_repricing_policy(_get_storage().settings_view()))
+    return [dict(priced, lot_name=lot_name, action=action) for (lot_name, priced), action in zip(rows, actions)]
+
+
+def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api, snapshot: ProfileLotsSnapshot | None = None,
+                        incremental: bool = False, planner: PriceSyncPlanner | None = None, dry_run: bool = False):
     lot_name = lot_config.get("lot_name", "").strip()
     if not lot_name:
         return None
     
     lot_type = lot_config.get("type", "").strip()
     raw_game_name = lot_config.get("game_name", "").strip()
-    game_name = _derive_game_name(lot_name, raw_game_name)
+    game_name = _resolve_sync_game_name(lot_name, raw_game_name)
     
     if not game_name:
         return {"error": "no_game_name", "message": f"Не указано название игры для лота '{lot_name}'"}
     
-    if game_name == lot_name or (len(game_name) > 20 and any(x in game_name for x in ['[АВТОВЫДАЧА]', '🎁', '🔵STEAM', 'ПОДАРКОМ'])):
-        cleaned_base = _extract_base_game_name(game_name)
-        if cleaned_base and len(cleaned_base) > 1:
-            formatted_name = _format_base_game_name(cleaned_base)
-            if formatted_name:
-                logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Очищено название игры: '{game_name}' -> '{formatted_name}'")
-                game_name = formatted_name
+    planner = planner or PriceSyncPlanner(api_key)
+    binding = _get_lot_binding(lot_config, api_key) or {}
     
     try:
-        funpay_lot = _find_lot_by_name_in_profile(cardinal, lot_name)
+        funpay_lot = None
+        if snapshot is not None and binding.get("funpay_lot_id") is not None:
+            funpay_lot = snapshot.get(binding["funpay_lot_id"])
+        if not funpay_lot:
+            funpay_lot = _find_lot_by_name_in_profile(cardinal, lot_name, snapshot)
+            if funpay_lot and not dry_run:
+                _save_lot_binding(lot_config, funpay_lot_id=funpay_lot.id)
     except Exception as e:
         logger.warning(f"{LOGGER_PREFIX} Ошибка поиска лота '{lot_name}' (игра: {game_name}): {e}")
         return {"error": "lot_not_found", "message": f"Ошибка поиска лота '{lot_name}' (игра: {game_name}): {e}"}
@@ -2186,13 +3745,18 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
     logger.info(f"{LOGGER_PREFIX} [{lot_name}] Найден лот: ID={lot_id_str} (тип: {lot_id_type}), описание='{funpay_lot.description}', цена из профиля={lot_price_from_profile}")
     
     base_price_usd = None
+    upstream_key = None
     
     if lot_type.lower() == "steam gift":
         logger.info(f"{LOGGER_PREFIX} [{lot_name}] Используется регион: {region} для запроса цены")
-        app_id = _get_game_app_id_by_name(game_name, api_key)
+        app_id = binding.get("app_id") or planner.app_id(game_name)
         if app_id:
-            package_info = _get_package_id_by_app_id(api_key, app_id, region, game_name, lot_name)
+            package_info = planner.package_info(app_id, region, game_name, lot_name, package_id=binding.get("package_id"))
             if package_info:
+                if not dry_run:
+                    _save_lot_binding(lot_config, app_id=app_id, package_id=package_info.get("package_id"),
+                                      edition=package_info.get("edition"), region=region)
+                upstream_key = f"steam:{app_id}:{package_info.get('package_id')}:{region}"
                 price_value = package_info.get("price")
                 edition_name = package_info.get("edition", "N/A")
                 price_currency = package_info.get("currency") or package_info.get("curr")
@@ -2240,7 +3804,7 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
                     if alt_region == region:
                         continue
                     logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Попытка получить цену для альтернативного региона: {alt_region}")
-                    package_info = _get_package_id_by_app_id(api_key, app_id, alt_region, game_name, lot_name)
+                    package_info = planner.package_info(app_id, alt_region, game_name, lot_name)
                     if package_info and package_info.get("price") is not None:
                         price_value = package_info.get("price")
                         price_currency = package_info.get("currency") or package_info.get("curr")
@@ -2261,6 +3825,7 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
                                 base_price_usd = raw_price
                             
                             if base_price_usd and base_price_usd > 0:
+                                upstream_key = f"steam:{app_id}:{package_info.get('package_id')}:{alt_region}"
                                 logger.warning(f"{LOGGER_PREFIX} [{lot_name}] Получена цена для альтернативного региона {alt_region}: {base_price_usd:.2f} USD")
                                 break
                         except (ValueError, TypeError):
@@ -2275,11 +3840,13 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
         amount = lot_config.get("amount", "").strip()
         if not amount:
             return {"error": "price_not_found", "message": f"Не указана сумма для мобильной пополнения '{lot_name}' (игра: {game_name})"}
-        game_id = _get_mobile_game_id_by_name(game_name, api_key)
+        game_id = binding.get("game_id") or _get_mobile_game_id_by_name(game_name, api_key)
+        if game_id and not dry_run:
+            _save_lot_binding(lot_config, game_id=game_id)
         if not game_id:
             logger.error(f"{LOGGER_PREFIX} [{lot_name}] (игра: {game_name}) Не удалось найти game_id для мобильной игры")
             return {"error": "price_not_found", "message": f"Не удалось найти игру '{game_name}' в списке мобильных игр для лота '{lot_name}'"}
-        game_info = _get_mobile_game_by_id(api_key, game_id)
+        game_info = planner.mobile_game(game_id)
         if not game_info:
             logger.error(f"{LOGGER_PREFIX} [{lot_name}] (игра: {game_name}) Не удалось получить информацию об игре game_id={game_id}")
             return {"error": "price_not_found", "message": f"Не удалось получить информацию об игре '{game_name}' (game_id={game_id}) для лота '{lot_name}'"}
@@ -2295,6 +3862,7 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
                 if price_value is not None:
                     try:
                         base_price_usd = float(price_value)
+                        upstream_key = f"mobile:{game_id}:{pos.get('name', '')}"
                         logger.info(f"{LOGGER_PREFIX} [{lot_name}] Найдена цена для позиции '{pos.get('name')}': {base_price_usd:.2f} USD")
                         break
                     except (ValueError, TypeError) as price_error:
@@ -2318,38 +3886,63 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
         if rub_rate <= 0:
             logger.error(f"{LOGGER_PREFIX} [{lot_name}] (игра: {game_name}) Неверный курс USD/RUB: {rub_rate}")
             return {"error": "conversion_error", "message": f"Неверный курс USD/RUB для '{lot_name}' (игра: {game_name})"}
-        
-        logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Базовая цена: {base_price_usd:.2f} USD, наценка: {markup_percent}%, курс USD/RUB: {rub_rate}")
-        final_price_usd = _calculate_price_with_markup(base_price_usd, markup_percent)
-        logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Цена с наценкой: {final_price_usd:.2f} USD")
-        final_price_rub = api.convert_from_usd(final_price_usd, "RUB")
-        if final_price_rub is None or final_price_rub <= 0:
-            logger.error(f"{LOGGER_PREFIX} [{lot_name}] (игра: {game_name}) Не удалось конвертировать цену: {final_price_usd} USD -> RUB")
-            return {"error": "conversion_error", "message": f"Не удалось конвертировать цену для '{lot_name}' (игра: {game_name}) из USD в RUB"}
     except Exception as conversion_error:
         logger.error(f"{LOGGER_PREFIX} [{lot_name}] (игра: {game_name}) Ошибка конвертации валюты: {conversion_error}")
         return {"error": "conversion_error", "message": f"Ошибка конвертации валюты для '{lot_name}' (игра: {game_name}): {conversion_error}"}
     
-    logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Цена в RUB: {final_price_rub:.2f} RUB")
+    logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Базовая цена: {base_price_usd:.2f} USD, наценка: {markup_percent}%, курс USD/RUB: {rub_rate}")
     
-    try:
-        from FunPayAPI.common import exceptions as fp_exceptions
-        
-        lot_id = funpay_lot.id
-        if isinstance(lot_id, str):
-            if lot_id.isnumeric():
-                lot_id = int(lot_id)
-            elif "-" in lot_id:
-                parts = lot_id.split("-")
-                if len(parts) > 0 and parts[0].isnumeric():
-                    lot_id = int(parts[0])
-                    logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Преобразовал ID из '{funpay_lot.id}' в {lot_id}")
-                else:
-                    logger.error(f"{LOGGER_PREFIX} ❌ Неверный формат ID лота '{lot_name}': {funpay_lot.id}")
-                    return {"error": "update_error", "message": f"Неверный формат ID лота '{lot_name}': {funpay_lot.id}"}
+    sync_inputs = {
+        "upstream_key": upstream_key or f"lot:{lot_name}",
+        "base_price_usd": base_price_usd,
+        "rub_rate": rub_rate,
+        "markup_percent": markup_percent,
+        "config_hash": _lot_config_hash(lot_config)
+    }
+    unchanged = not dry_run and _price_sync_inputs_unchanged(lot_name, sync_inputs)
+    if incremental and unchanged:
+        logger.debug(f"{LOGGER_PREFIX} ⏭️ Входные данные для '{lot_name}' не изменились, FunPay не запрашиваем")
+        return {"success": True, "lot_name": lot_name, "skipped": True, "unchanged": True}
+    
+    lot_id = funpay_lot.id
+    if isinstance(lot_id, str):
+        if lot_id.isnumeric():
+            lot_id = int(lot_id)
+        elif "-" in lot_id:
+            parts = lot_id.split("-")
+            if len(parts) > 0 and parts[0].isnumeric():
+                lot_id = int(parts[0])
+                logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Преобразовал ID из '{funpay_lot.id}' в {lot_id}")
             else:
                 logger.error(f"{LOGGER_PREFIX} ❌ Неверный формат ID лота '{lot_name}': {funpay_lot.id}")
                 return {"error": "update_error", "message": f"Неверный формат ID лота '{lot_name}': {funpay_lot.id}"}
+        else:
+            logger.error(f"{LOGGER_PREFIX} ❌ Неверный формат ID лота '{lot_name}': {funpay_lot.id}")
+            return {"error": "update_error", "message": f"Неверный формат ID лота '{lot_name}': {funpay_lot.id}"}
+    
+    return {
+        "success": True,
+        "lot_name": lot_name,
+        "priced": {
+            "lot_id": lot_id,
+            "funpay_lot": funpay_lot,
+            "game_name": game_name,
+            "base_price_usd": base_price_usd,
+            "rub_rate": rub_rate,
+            "markup_percent": markup_percent,
+            "upstream_key": sync_inputs["upstream_key"],
+            "known_price": _get_lot_fields_cache().get_price(lot_id),
+            "sync_inputs": sync_inputs
+        }
+    }
+
+
+def _fetch_current_lot_price(cardinal: "Cardinal", lot_name: str, priced: dict) -> dict:
+    """Загружает LotFields лота и его текущую цену на FunPay"""
+    lot_id = priced["lot_id"]
+    funpay_lot = priced["funpay_lot"]
+    try:
+        from FunPayAPI.common import exceptions as fp_exceptions
         
         lot_fields = None
         current_price = None
@@ -2359,6 +3952,9 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
             if lot_fields and hasattr(lot_fields, 'price') and lot_fields.price is not None:
                 try:
                     current_price = float(lot_fields.price)
+                    _get_lot_fields_cache().remember(lot_id, current_price)
+                    if hasattr(lot_fields, 'active'):
+                        _get_lot_fields_cache().remember_active(lot_id, lot_fields.active)
                 except (ValueError, TypeError) as price_error:
                     logger.warning(f"{LOGGER_PREFIX} ⚠️ Не удалось преобразовать цену лота '{lot_name}' в число: {lot_fields.price}, ошибка: {price_error}")
                     current_price = None
@@ -2389,31 +3985,99 @@ def _process_single_lot(lot_config, cardinal, api_key, markup_percent, api):
             logger.warning(f"{LOGGER_PREFIX} ⚠️ Текущая цена для лота '{lot_name}' недоступна, обновляем без проверки")
             current_price = 0.0
         
-        final_price_rub_rounded = round(final_price_rub, 2)
-        
-        logger.debug(f"{LOGGER_PREFIX} [{lot_name}] Текущая цена на FunPay: {current_price:.2f} RUB, новая цена: {final_price_rub_rounded:.2f} RUB, разница: {abs(current_price - final_price_rub_rounded):.2f} RUB")
-        
-        if abs(current_price - final_price_rub_rounded) >= 0.01:
-            try:
-                lot_fields.price = final_price_rub_rounded
-                if hasattr(lot_fields, 'active'):
-                    lot_fields.active = True
-                cardinal.account.save_lot(lot_fields)
-                logger.info(f"{LOGGER_PREFIX} ✅ '{lot_name}': {current_price:.0f}₽ → {final_price_rub_rounded:.0f}₽")
-                return {"success": True, "lot_name": lot_name}
-            except Exception as save_error:
-                logger.error(f"{LOGGER_PREFIX} ❌ Ошибка сохранения цены для лота '{lot_name}' (игра: {game_name}): {save_error}")
-                return {"error": "update_error", "message": f"Ошибка сохранения цены для лота '{lot_name}' (игра: {game_name}): {save_error}"}
-        else:
-            logger.debug(f"{LOGGER_PREFIX} ⏭️ Цена для '{lot_name}' не изменилась: {current_price:.2f} RUB ≈ {final_price_rub_rounded:.2f} RUB")
-            return {"success": True, "lot_name": lot_name, "skipped": True}
+        return {"success": True, "lot_fields": lot_fields, "current_price": current_price}
     except Exception as e:
         error_msg = str(e)
         error_type = type(e).__name__
         logger.warning(f"{LOGGER_PREFIX} ❌ Ошибка обновления цены для '{lot_name}': {error_type}: {error_msg}")
         return {"error": "update_error", "message": f"Ошибка обновления цены для '{lot_name}': {error_type}: {error_msg}"}
 
-def _sync_prices_from_desslyhub(cardinal: "Cardinal") -> dict:
+
+REPRICE_REASONS = {
+    "raise": "повышение",
+    "lower": "понижение",
+    "loss": "ниже себестоимости",
+    "unknown": "цена неизвестна",
+    "hold": "без изменений"
+}
+
+
+def _build_price_sync_plan(priced_rows: list, results: list, policy: dict) -> dict:
+    """План синхронизации без записи: что и почему изменилось бы на FunPay"""
+    rows = []
+    for (lot_name, priced), action in zip(priced_rows, _reprice_rows(priced_rows, "known_price", policy)):
+        current_price = priced["known_price"]
+        target_price = priced["target_price"]
+        rows.append({
+            "lot_name": lot_name,
+            "current_price": current_price,
+            "target_price": target_price,
+            "reason": action,
+            "upstream": priced["upstream_key"],
+            "base_price_usd": priced["base_price_usd"],
+            "hysteresis_skip": action == "hold" and current_price is not None and abs(target_price - current_price) >= 0.01,
+            "write": action != "hold",
+            "deferred": False,
+            "impact": abs(target_price - current_price) if current_price is not None else 0.0
+        })
+    write_budget = policy["write_budget"]
+    for row in sorted((row for row in rows if row["write"]), key=lambda row: (row["reason"] != "loss", -row["impact"])):
+        if row["reason"] == "loss":
+            continue
+        if write_budget <= 0:
+            row["deferred"] = True
+        else:
+            write_budget -= 1
+    return {
+        "created_at": time.time(),
+        "rows": rows,
+        "errors": [result.get("message", "Неизвестная ошибка") for _, result in results if result and result.get("error")]
+    }
+
+
+def _apply_price_write(cardinal: "Cardinal", lot_name: str, write: dict) -> dict:
+    lot_id = write["lot_id"]
+    lot_fields = write["lot_fields"]
+    current_price = write["current_price"]
+    target_price = write["target_price"]
+    lot_fields_cache = _get_lot_fields_cache()
+    try:
+        lot_fields.price = target_price
+        if hasattr(lot_fields, 'active') and lot_id not in _held_inactive_lot_ids(_get_storage().settings_view()):
+            lot_fields.active = True
+        lot_fields_cache.invalidate(lot_id)
+        cardinal.account.save_lot(lot_fields)
+        lot_fields_cache.remember(lot_id, target_price, written=True)
+        if hasattr(lot_fields, 'active'):
+            lot_fields_cache.remember_active(lot_id, lot_fields.active)
+        _remember_price_sync(lot_name, write["sync_inputs"], target_price)
+        logger.info(f"{LOGGER_PREFIX} ✅ '{lot_name}': {current_price:.0f}₽ → {target_price:.0f}₽")
+        return {"success": True, "lot_name": lot_name}
+    except Exception as save_error:
+        logger.error(f"{LOGGER_PREFIX} ❌ Ошибка сохранения цены для лота '{lot_name}' (игра: {write['game_name']}): {save_error}")
+        return {"error": "update_error", "message": f"Ошибка сохранения цены для лота '{lot_name}' (игра: {write['game_name']}): {save_error}"}
+
+
+def _sync_prices_from_desslyhub(cardinal: "Cardinal", full: bool = False, lot_names: list[str] | None = None,
+                                dry_run: bool = False, plan: dict | None = None) -> dict:
+    """plan - одобренный план из предпросмотра: пишутся только его лоты и только по показанным ценам"""
+    global _price_sync_plan
+    scheduler = _get_price_sync_scheduler()
+    if dry_run:
+        return _run_price_sync_cycle(cardinal, scheduler, True, lot_names, dry_run=True)
+    with scheduler.cycle() as acquired:
+        if not acquired:
+            logger.info(f"{LOGGER_PREFIX} [PRICE] Синхронизация уже выполняется, пропускаем запуск")
+            return {"success": 0, "failed": 0, "errors": ["Синхронизация уже выполняется"]}
+        if plan is not None:
+            if _price_sync_plan is plan:
+                _price_sync_plan = None
+            lot_names = [row["lot_name"] for row in plan["rows"] if row["write"]]
+        return _run_price_sync_cycle(cardinal, scheduler, full, lot_names, plan=plan)
+
+
+def _run_price_sync_cycle(cardinal: "Cardinal", scheduler: PriceSyncScheduler, full: bool, lot_names: list[str] | None,
+                          dry_run: bool = False, plan: dict | None = None) -> dict:
     storage = _get_storage()
     settings = storage.load_settings()
     lots_config = storage.load_lots_config()
@@ -2426,10 +4090,31 @@ def _sync_prices_from_desslyhub(cardinal: "Cardinal") -> dict:
         return {"success": 0, "failed": 0, "errors": ["Автонаценка отключена"]}
     
     markup_percent = settings.get("markup_percent", 10.0)
+    policy = _get_repricing_policy(settings)
     success_count = 0
     failed_count = 0
+    unchanged_count = 0
     errors = []
     updated_lots = []
+    pending_writes = []
+    deferred_lots = []
+    moved_lots = []
+    
+    with _price_sync_state_lock:
+        full_due = time.time() - _price_sync_state["last_full_sync"] >= PRICE_SYNC_FULL_INTERVAL
+        full = full or full_due or not settings.get("incremental_sync", True)
+        if not dry_run:
+            configured = {config.get("lot_name", "").strip() for config in lots_config}
+            for lot_name in list(_price_sync_state["lots"]):
+                if lot_name not in configured:
+                    del _price_sync_state["lots"][lot_name]
+    
+    if not dry_run:
+        _prune_lot_bindings(lots_config)
+    scoped = lot_names is not None and (dry_run or plan is not None or not full_due)
+    if scoped:
+        selected = set(lot_names)
+        lots_config = [config for config in lots_config if config.get("lot_name", "").strip() in selected]
     
     error_stats = {
         "no_game_name": 0,
@@ -2462,44 +4147,152 @@ def _sync_prices_from_desslyhub(cardinal: "Cardinal") -> dict:
         cached_rates = None
         logger.warning(f"{LOGGER_PREFIX} Не удалось предзагрузить курсы валют: {e}")
     
-    funpay_lots_cache = {}
     try:
         logger.info(f"{LOGGER_PREFIX} ⚡ Загрузка списка лотов FunPay...")
-        profile_lots = cardinal.account.get_user().lots
-        for lot in profile_lots:
-            if hasattr(lot, 'description') and lot.description:
-                funpay_lots_cache[lot.description.strip().lower()] = lot
-        logger.info(f"{LOGGER_PREFIX} ⚡ Загружено {len(funpay_lots_cache)} лотов FunPay")
+        snapshot = ProfileLotsSnapshot.fetch(cardinal)
+        logger.info(f"{LOGGER_PREFIX} ⚡ Загружено {len(snapshot)} лотов FunPay")
     except Exception as e:
         logger.warning(f"{LOGGER_PREFIX} Не удалось предзагрузить лоты FunPay: {e}")
+        snapshot = None
     
-    price_cache = {}
+    planner = PriceSyncPlanner(api_key)
+    try:
+        groups_count = planner.plan(lots_config)
+        logger.info(f"{LOGGER_PREFIX} ⚡ Лоты Steam сгруппированы: {groups_count} уникальных (app_id, регион, издание)")
+    except Exception as e:
+        logger.warning(f"{LOGGER_PREFIX} Не удалось спланировать синхронизацию: {e}")
     
-    logger.info(f"{LOGGER_PREFIX} ⚡ Начинаем синхронизацию {len(lots_config)} лотов (25 потоков)")
+    logger.info(f"{LOGGER_PREFIX} ⚡ Начинаем {'полную' if full else 'инкрементальную'} синхронизацию {len(lots_config)} лотов ({SYNC_MAX_WORKERS} потоков)")
     
-    with ThreadPoolExecutor(max_workers=25) as executor:
+    with ThreadPoolExecutor(max_workers=SYNC_MAX_WORKERS) as executor:
         futures = {}
         for idx, lot_config in enumerate(lots_config):
-            future = executor.submit(_process_single_lot, lot_config, cardinal, api_key, markup_percent, api)
+            future = executor.submit(_process_single_lot, lot_config, cardinal, api_key, markup_percent, api, snapshot, not full, planner, dry_run)
             futures[future] = lot_config
         
+        results = []
+        priced_rows = []
         for future in as_completed(futures):
+            lot_name = futures[future].get("lot_name", "").strip()
             result = future.result()
-            if result is None:
-                continue
-            
-            if result.get("success"):
-                if not result.get("skipped"):
-                    success_count += 1
-                    updated_lots.append(result["lot_name"])
+            if result is not None and result.get("priced"):
+                priced_rows.append((lot_name, result["priced"]))
+            else:
+                results.append((lot_name, result))
+        
+        if dry_run:
+            for lot_name, priced in priced_rows:
+                if priced["known_price"] is None and getattr(priced["funpay_lot"], "price", None) is not None:
+                    try:
+                        priced["known_price"] = float(priced["funpay_lot"].price)
+                    except (ValueError, TypeError):
+                        pass
+            plan = _build_price_sync_plan(priced_rows, results, policy)
+            logger.info(f"{LOGGER_PREFIX} [PRICE] План синхронизации: лотов={len(plan['rows'])}, "
+                        f"к записи={sum(1 for row in plan['rows'] if row['write'])}, ошибок={len(plan['errors'])}")
+            return {"success": 0, "failed": len(plan["errors"]), "errors": plan["errors"], "plan": plan}
+        
+        if plan is not None:
+            # Применяем план только по тем ценам, которые видел администратор; сдвинувшиеся лоты оставляем расписанию
+            previewed = {row["lot_name"]: row["target_price"] for row in plan["rows"] if row["write"]}
+            _reprice_rows(priced_rows, "known_price", policy)
+            kept_rows = []
+            for lot_name, priced in priced_rows:
+                if round(priced["target_price"], 2) == round(previewed.get(lot_name, -1.0), 2):
+                    kept_rows.append((lot_name, priced))
+                    continue
+                logger.info(f"{LOGGER_PREFIX} [PRICE] '{lot_name}': цена изменилась после предпросмотра "
+                            f"({previewed.get(lot_name, 0.0):.0f}₽ → {priced['target_price']:.0f}₽), пропускаем")
+                moved_lots.append(f"{lot_name}: {previewed.get(lot_name, 0.0):.0f}₽ → {priced['target_price']:.0f}₽")
+                results.append((lot_name, {"success": True, "lot_name": lot_name, "skipped": True, "deferred": True}))
+            priced_rows = kept_rows
+        
+        # Сначала сравниваем с известными ценами лотов, страницы FunPay грузим только для возможных изменений
+        to_fetch = []
+        for (lot_name, priced), action in zip(priced_rows, _reprice_rows(priced_rows, "known_price", policy)):
+            if action == "hold":
+                logger.debug(f"{LOGGER_PREFIX} ⏭️ Цена для '{lot_name}' в пределах допуска от известной цены: {priced['known_price']:.2f} RUB ≈ {priced['target_price']:.2f} RUB")
+                _remember_price_sync(lot_name, priced["sync_inputs"], priced["known_price"])
+                results.append((lot_name, {"success": True, "lot_name": lot_name, "skipped": True}))
             else:
-                failed_count += 1
-                error_type = result.get("error", "unknown")
-                error_stats[error_type] = error_stats.get(error_type, 0) + 1
-                error_message = result.get("message", "Неизвестная ошибка")
-                errors.append(error_message)
-                if error_type in error_examples and len(error_examples[error_type]) < 5:
-                    error_examples[error_type].append(error_message)
+                to_fetch.append((lot_name, priced))
+        
+        fetched_rows = []
+        fetch_futures = {executor.submit(_fetch_current_lot_price, cardinal, lot_name, priced): (lot_name, priced)
+                         for lot_name, priced in to_fetch}
+        for future in as_completed(fetch_futures):
+            lot_name, priced = fetch_futures[future]
+            fetched = future.result()
+            if not fetched.get("success"):
+                results.append((lot_name, fetched))
+                continue
+            priced["lot_fields"] = fetched["lot_fields"]
+            priced["current_price"] = fetched["current_price"]
+            fetched_rows.append((lot_name, priced))
+    
+    for (lot_name, priced), action in zip(fetched_rows, _reprice_rows(fetched_rows, "current_price", policy)):
+        if action == "hold":
+            logger.debug(f"{LOGGER_PREFIX} ⏭️ Цена для '{lot_name}' в пределах допуска: {priced['current_price']:.2f} RUB ≈ {priced['target_price']:.2f} RUB")
+            _remember_price_sync(lot_name, priced["sync_inputs"], priced["current_price"])
+            results.append((lot_name, {"success": True, "lot_name": lot_name, "skipped": True}))
+            continue
+        pending_writes.append((lot_name, {
+            "lot_id": priced["lot_id"],
+            "lot_fields": priced["lot_fields"],
+            "game_name": priced["game_name"],
+            "current_price": priced["current_price"],
+            "target_price": priced["target_price"],
+            "cost_price": priced["cost_price"],
+            "action": action,
+            "impact": abs(priced["target_price"] - priced["current_price"]),
+            "sync_inputs": priced["sync_inputs"]
+        }))
+    
+    # Убыточные лоты пишутся всегда, остальные - в пределах бюджета, начиная с наибольшего изменения цены
+    pending_writes.sort(key=lambda item: (item[1]["action"] != "loss", -item[1]["impact"]))
+    write_budget = policy["write_budget"]
+    for lot_name, write in pending_writes:
+        if write["action"] != "loss":
+            if write_budget <= 0 or not scheduler.acquire_write():
+                deferred_lots.append(f"{lot_name}: {write['current_price']:.0f}₽ → {write['target_price']:.0f}₽")
+                results.append((lot_name, {"success": True, "lot_name": lot_name, "skipped": True, "deferred": True}))
+                continue
+            write_budget -= 1
+        else:
+            logger.warning(f"{LOGGER_PREFIX} [PRICE] '{lot_name}' продается ниже себестоимости ({write['current_price']:.2f} < {write['cost_price']:.2f} RUB), поднимаем цену вне очереди")
+        results.append((lot_name, _apply_price_write(cardinal, lot_name, write)))
+    
+    for lot_name, result in results:
+        scheduler.record(lot_name, result)
+        if result is None:
+            continue
+        
+        if result.get("success"):
+            if result.get("unchanged"):
+                unchanged_count += 1
+            elif not result.get("skipped"):
+                success_count += 1
+                updated_lots.append(result["lot_name"])
+        else:
+            failed_count += 1
+            error_type = result.get("error", "unknown")
+            error_stats[error_type] = error_stats.get(error_type, 0) + 1
+            error_message = result.get("message", "Неизвестная ошибка")
+            errors.append(error_message)
+            if error_type in error_examples and len(error_examples[error_type]) < 5:
+                error_examples[error_type].append(error_message)
+    
+    if deferred_lots:
+        logger.info(f"{LOGGER_PREFIX} [PRICE] Отложено записей на FunPay: {len(deferred_lots)} (бюджет цикла {policy['write_budget']})")
+        for deferred in deferred_lots[:10]:
+            logger.info(f"{LOGGER_PREFIX}   - {deferred}")
+    
+    if full and not scoped:
+        with _price_sync_state_lock:
+            _price_sync_state["last_full_sync"] = time.time()
+    
+    logger.info(f"{LOGGER_PREFIX} [PRICE] Синхронизация завершена: обновлено={success_count}, без изменений входных данных={unchanged_count}, ошибок={failed_count}, "
+                f"запросов к DesslyHub={planner.fetched} из {planner.requested}")
     
     if failed_count > 0:
         logger.warning(
@@ -2528,6 +4321,10 @@ def _sync_prices_from_desslyhub(cardinal: "Cardinal") -> dict:
         "failed": failed_count,
         "errors": errors,
         "updated_lots": updated_lots,
+        "unchanged": unchanged_count,
+        "deferred": deferred_lots,
+        "moved": moved_lots,
+        "full": full,
         "error_stats": error_stats
     }
 
@@ -2775,9 +4572,9 @@ def _parse_and_save_lots_ids(cardinal: "Cardinal") -> list[int]:
     lots_ids = []
     try:
         storage = _get_storage()
-        lots_config = storage.load_lots_config()
+        matcher = storage.lot_matcher()
         
-        if not lots_config:
+        if not matcher.names:
             logger.warning(f"{LOGGER_PREFIX} Конфиг лотов пуст, нечего сохранять")
             return lots_ids
         
@@ -2786,33 +4583,21 @@ def _parse_and_save_lots_ids(cardinal: "Cardinal") -> list[int]:
             return lots_ids
         
         all_lots = cardinal.profile.get_lots()
-        config_lot_names = [lot_config.get("lot_name", "").lower().strip() for lot_config in lots_config if lot_config.get("lot_name")]
+        lot_fields_cache = _get_lot_fields_cache()
         
         for lot in all_lots:
             try:
-                lot_description = (lot.description or "").lower().strip()
-                if not lot_description:
+                if not matcher.is_known(lot.description or ""):
                     continue
                 
-                is_in_config = False
-                for config_lot_name in config_lot_names:
-                    if not config_lot_name:
-                        continue
-                    if (config_lot_name == lot_description or 
-                        config_lot_name in lot_description or 
-                        lot_description in config_lot_name):
-                        is_in_config = True
-                        break
-                
-                if not is_in_config:
-                    continue
-                
-                is_active = False
                 if hasattr(lot, 'active'):
                     is_active = lot.active
                 else:
-                    lot_fields = cardinal.account.get_lot_fields(lot.id)
-                    is_active = lot_fields.active
+                    is_active = lot_fields_cache.get_active(lot.id)
+                    if is_active is None:
+                        lot_fields = cardinal.account.get_lot_fields(lot.id)
+                        is_active = lot_fields.active
+                        lot_fields_cache.remember_active(lot.id, is_active)
                 
                 if is_active:
                     lots_ids.append(lot.id)
@@ -2826,39 +4611,340 @@ def _parse_and_save_lots_ids(cardinal: "Cardinal") -> list[int]:
         logger.error(f"{LOGGER_PREFIX} Ошибка парсинга лотов: {e}")
     return lots_ids
 
-def _deactivate_lots_by_ids(cardinal: "Cardinal", lots_ids: list[int]) -> int:
-    deactivated = 0
-    for lot_id in lots_ids:
+class FunPayRateLimiter:
+    """Token bucket для запросов к FunPay: в среднем rate запросов в секунду, пачкой не больше burst"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(rate, 0.1)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class LotStateEngine:
+    """Массовое включение/выключение лотов FunPay с контрольной точкой в настройках"""
+    
+    CHECKPOINT_INTERVAL = 2.0
+    
+    def __init__(self, workers: int, rate: float):
+        self.workers = max(1, workers)
+        self.limiter = FunPayRateLimiter(rate, self.workers)
+        self._run_lock = threading.Lock()
+        self._job_lock = threading.Lock()
+    
+    def _save_job(self, job: dict | None) -> None:
+        storage = _get_storage()
+        with self._job_lock:
+            settings = storage.load_settings()
+            if job is None:
+                settings.pop("lot_state_job", None)
+            else:
+                settings["lot_state_job"] = job
+            storage.save_settings(settings)
+    
+    def _toggle(self, cardinal: "Cardinal", lot_id: int, active: bool) -> str:
+        cache = _get_lot_fields_cache()
+        self.limiter.acquire()
+        lot_fields = cardinal.account.get_lot_fields(lot_id)
+        if lot_fields.active == active:
+            cache.remember_active(lot_id, active)
+            return "skipped"
+        lot_fields.active = active
+        self.limiter.acquire()
+        cardinal.account.save_lot(lot_fields)
+        cache.invalidate(lot_id)
+        cache.remember_active(lot_id, active)
+        return "changed"
+    
+    def run(self, cardinal: "Cardinal", lots_ids: list[int], active: bool) -> dict:
+        job = {
+            "active": active,
+            "pending": list(dict.fromkeys(lots_ids)),
+            "changed": 0,
+            "skipped": 0,
+            "failed": [],
+            "started_at": time.time()
+        }
+        return self._execute(cardinal, job)
+    
+    def resume(self, cardinal: "Cardinal") -> dict | None:
+        """Досчитывает задание, прерванное перезапуском (если оно есть)"""
+        job = _get_storage().load_settings().get("lot_state_job")
+        if not job or not job.get("pending"):
+            return None
+        logger.info(f"{LOGGER_PREFIX} Продолжаем прерванное {'включение' if job.get('active') else 'выключение'} лотов: осталось {len(job['pending'])}")
+        return self._execute(cardinal, job)
+    
+    def discard(self) -> None:
+        with self._run_lock:
+            self._save_job(None)
+    
+    def _execute(self, cardinal: "Cardinal", job: dict) -> dict:
+        with self._run_lock:
+            started = time.time()
+            active = bool(job["active"])
+            cache = _get_lot_fields_cache()
+            self._save_job(job)
+            
+            pending = []
+            for lot_id in job["pending"]:
+                if cache.get_active(lot_id) == active:
+                    job["skipped"] += 1
+                else:
+                    pending.append(lot_id)
+            
+            remaining = set(pending)
+            last_checkpoint = time.time()
+            if pending:
+                with ThreadPoolExecutor(max_workers=min(self.workers, len(pending)), thread_name_prefix="AS-LotState") as pool:
+                    futures = {pool.submit(self._toggle, cardinal, lot_id, active): lot_id for lot_id in pending}
+                    for future in as_completed(futures):
+                        lot_id = futures[future]
+                        try:
+                            outcome = future.result()
+                            job[outcome] += 1
+                            if outcome == "changed":
+                                logger.info(f"{LOGGER_PREFIX} Лот ID {lot_id} {'активирован' if active else 'деактивирован'}")
+                        except Exception as e:
+                            job["failed"].append(lot_id)
+                            logger.error(f"{LOGGER_PREFIX} Ошибка {'активации' if active else 'деактивации'} лота {lot_id}: {e}")
+                        remaining.discard(lot_id)
+                        if time.time() - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                            job["pending"] = [pending_id for pending_id in pending if pending_id in remaining]
+                            self._save_job(job)
+                            last_checkpoint = time.time()
+            
+            self._save_job(None)
+            report = {
+                "active": active,
+                "changed": job["changed"],
+                "skipped": job["skipped"],
+                "failed": job["failed"],
+                "elapsed": time.time() - started
+            }
+            logger.info(
+                f"{LOGGER_PREFIX} {'Включение' if active else 'Выключение'} лотов завершено за {report['elapsed']:.1f} с: "
+                f"изменено {report['changed']}, уже в нужном состоянии {report['skipped']}, ошибок {len(report['failed'])}"
+            )
+            return report
+
+
+def _get_lot_state_engine() -> LotStateEngine:
+    global _lot_state_engine
+    with _lot_state_engine_lock:
+        if _lot_state_engine is None:
+            _lot_state_engine = LotStateEngine(LOT_STATE_WORKERS, LOT_STATE_RATE)
+        return _lot_state_engine
+
+def _deactivate_lots_by_ids(cardinal: "Cardinal", lots_ids: list[int]) -> dict:
+    return _get_lot_state_engine().run(cardinal, lots_ids, False)
+
+def _activate_lots_by_ids(cardinal: "Cardinal", lots_ids: list[int]) -> dict:
+    return _get_lot_state_engine().run(cardinal, lots_ids, True)
+
+class BurnRateForecaster:
+    """Прогноз расхода баланса по часам суток на основе истории успешных заказов"""
+    
+    HISTORY_DAYS = 14
+    KEEP_SHARE = 0.1
+    
+    def __init__(self, storage: Storage):
+        self.storage = storage
+    
+    def hourly_spend(self, now: float) -> list[float]:
+        """Средний расход в USD за каждый час суток"""
+        orders = self.storage.load_order_index(status="success", since=now - self.HISTORY_DAYS * 86400)
+        spend = [0.0] * 24
+        first = now
+        for order in orders:
+            if str(order.get("order_id") or "").startswith("TEST-"):
+                continue
+            try:
+                price = float(order.get("price"))
+            except (TypeError, ValueError):
+                continue
+            if price <= 0:
+                continue
+            spend[datetime.fromtimestamp(order["timestamp"]).hour] += price
+            first = min(first, order["timestamp"])
+        days = max(1.0, (now - first) / 86400)
+        return [amount / days for amount in spend]
+    
+    def forecast(self, balance: float, horizon: float) -> dict:
+        """Время до обнуления баланса (eta, сек; None - расход не ожидается) и расход за horizon секунд"""
+        now = time.time()
+        spend = self.hourly_spend(now)
+        result = {"eta": None, "spend": 0.0, "hourly": spend[datetime.fromtimestamp(now).hour]}
+        if not any(spend):
+            return result
+        if balance <= 0:
+            result["eta"] = 0.0
+        remaining = balance
+        elapsed = 0.0
+        moment = now
+        while elapsed < 7 * 86400 and (result["eta"] is None or elapsed < horizon):
+            current = datetime.fromtimestamp(moment)
+            step = 3600 - (current.minute * 60 + current.second)
+            rate = spend[current.hour] / 3600
+            if elapsed < horizon:
+                result["spend"] += rate * min(step, horizon - elapsed)
+            if result["eta"] is None and rate > 0 and rate * step >= remaining:
+                result["eta"] = elapsed + remaining / rate
+            remaining -= rate * step
+            elapsed += step
+            moment += step
+        return result
+
+
+def _get_burn_rate_forecaster() -> BurnRateForecaster:
+    global _burn_rate_forecaster
+    with _burn_rate_forecaster_lock:
+        if _burn_rate_forecaster is None:
+            _burn_rate_forecaster = BurnRateForecaster(_get_storage())
+        return _burn_rate_forecaster
+
+
+def _held_inactive_lot_ids(settings) -> set:
+    """Лоты, выключенные из-за баланса: синхронизация цен не должна их включать"""
+    return set(settings.get("deactivated_lots", []) or []) | set(settings.get("forecast_deactivated_lots", []) or [])
+
+
+def _config_lot_costs(cardinal: "Cardinal", api_key: str, settings) -> list[tuple[float, int]]:
+    """Себестоимость (USD) лотов из конфига, оцененная по их цене на FunPay; дорогие первыми"""
+    if not hasattr(cardinal, 'profile') or not cardinal.profile:
+        return []
+    rub_rate = DesslyHubAPI(api_key).get_exchange_rates().get("RUB", 0)
+    if rub_rate <= 0:
+        return []
+    markup_factor = 1 + float(settings.get("markup_percent", 10.0)) / 100
+    matcher = _get_storage().lot_matcher()
+    costs = []
+    for lot in cardinal.profile.get_lots():
+        if getattr(lot, 'active', True) is False or not matcher.is_known(lot.description or ""):
+            continue
         try:
-            lot_fields = cardinal.account.get_lot_fields(lot_id)
-            if lot_fields.active:
-                lot_fields.active = False
-                cardinal.account.save_lot(lot_fields)
-                deactivated += 1
-                logger.info(f"{LOGGER_PREFIX} Лот ID {lot_id} деактивирован")
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка деактивации лота {lot_id}: {e}")
-    return deactivated
+            costs.append((float(lot.price) / rub_rate / markup_factor, lot.id))
+        except (TypeError, ValueError):
+            continue
+    costs.sort(reverse=True)
+    return costs
+
+
+def _format_eta(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    return f"{minutes // 60} ч {minutes % 60} мин" if minutes >= 60 else f"{minutes} мин"
+
+
+def _run_burn_rate_guard(cardinal: "Cardinal", api_key: str, settings: dict, balance: float) -> None:
+    """Заранее выключает самые дорогие лоты, если по прогнозу баланс закончится в пределах горизонта"""
+    enabled = settings.get("forecast_enabled", False) and settings.get("balance_threshold_enabled", True)
+    if not enabled and not settings.get("forecast_deactivated_lots") and not settings.get("forecast_warning_sent", False):
+        return
+    storage = _get_storage()
+    admin_id = settings.get("admin_id", "")
+    horizon = float(settings.get("forecast_horizon_hours", 2.0)) * 3600
+    forecaster = _get_burn_rate_forecaster()
+    forecast = forecaster.forecast(balance, horizon)
+    eta = forecast["eta"]
+    held = list(settings.get("forecast_deactivated_lots", []) or [])
+    
+    def notify(message: str) -> None:
+        if admin_id and hasattr(cardinal, 'telegram') and hasattr(cardinal.telegram, 'bot'):
+            try:
+                cardinal.telegram.bot.send_message(int(admin_id), message, parse_mode="HTML")
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} [BALANCE] Ошибка отправки уведомления о прогнозе баланса: {e}")
+    
+    if enabled and eta is not None and eta <= horizon:
+        cutoff = max(balance - forecast["spend"], balance * forecaster.KEEP_SHARE)
+        new_ids = [lot_id for cost, lot_id in _config_lot_costs(cardinal, api_key, settings)
+                   if cost > cutoff and lot_id not in held]
+        report = None
+        if new_ids:
+            settings["forecast_deactivated_lots"] = held + new_ids
+            storage.save_settings(settings)
+            report = _deactivate_lots_by_ids(cardinal, new_ids)
+        logger.warning(
+            f"{LOGGER_PREFIX} [BALANCE] Прогноз: баланс {balance:.2f} USD закончится через {_format_eta(eta)} "
+            f"(расход {forecast['hourly']:.2f} USD/ч), выключаем лоты дороже {cutoff:.2f} USD: {len(new_ids)}"
+        )
+        if new_ids or not settings.get("forecast_warning_sent", False):
+            notify(
+                f"⏳ <b>Баланс скоро закончится</b>\n\n"
+                f"💰 <b>Доступно:</b> <code>{balance:.2f} USD</code>\n"
+                f"🔥 <b>Расход сейчас:</b> <code>{forecast['hourly']:.2f} USD/ч</code>\n"
+                f"⏰ <b>Хватит примерно на:</b> <code>{_format_eta(eta)}</code>\n"
+                + (f"🔴 <b>Выключены лоты дороже {cutoff:.2f} USD:</b> {report['changed']}\n" if report else "")
+                + f"📅 <b>Дата:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>"
+            )
+            settings["forecast_warning_sent"] = True
+            storage.save_settings(settings)
+    elif (held or settings.get("forecast_warning_sent", False)) and (not enabled or eta is None or eta > 2 * horizon):
+        if settings.get("deactivated_lots"):
+            return
+        report = _activate_lots_by_ids(cardinal, held) if held else None
+        settings["forecast_deactivated_lots"] = []
+        settings["forecast_warning_sent"] = False
+        storage.save_settings(settings)
+        if report:
+            notify(
+                f"✅ <b>Прогноз баланса в норме</b>\n\n"
+                f"💰 <b>Доступно:</b> <code>{balance:.2f} USD</code>\n"
+                f"✅ <b>Включено лотов:</b> {report['changed']}\n"
+                f"📅 <b>Дата:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>"
+            )
+
+
+def _resume_lot_state_job(cardinal: "Cardinal", settings, balance: float | None) -> None:
+    """Досчитывает прерванное задание включения/выключения лотов, только если оно еще соответствует балансу"""
+    job = settings.get("lot_state_job")
+    if not job or not job.get("pending"):
+        return
+    engine = _get_lot_state_engine()
+    held = _held_inactive_lot_ids(settings)
+    
+    if not job.get("active"):
+        if held:
+            engine.resume(cardinal)
+        else:
+            logger.info(f"{LOGGER_PREFIX} [BALANCE] Прерванное выключение лотов больше не нужно, задание отменено")
+            engine.discard()
+        return
+    
+    threshold_ok = not settings.get("balance_threshold_enabled", True) or (
+        balance is not None and balance >= float(settings.get("balance_threshold", 30.0)))
+    forecast_held = set(settings.get("forecast_deactivated_lots", []) or [])
+    if threshold_ok and forecast_held.isdisjoint(job["pending"]):
+        engine.resume(cardinal)
+        return
+    
+    # Включение выполнено частично: возвращаем все удерживаемые лоты в выключенное состояние,
+    # повторное включение сделают мониторинг порога или прогноз, когда баланс это позволит
+    logger.warning(f"{LOGGER_PREFIX} [BALANCE] Прерванное включение лотов больше не соответствует балансу, лоты выключаются снова")
+    engine.discard()
+    if held:
+        engine.run(cardinal, sorted(held), False)
 
-def _activate_lots_by_ids(cardinal: "Cardinal", lots_ids: list[int]) -> int:
-    activated = 0
-    for lot_id in lots_ids:
-        try:
-            lot_fields = cardinal.account.get_lot_fields(lot_id)
-            if not lot_fields.active:
-                lot_fields.active = True
-                cardinal.account.save_lot(lot_fields)
-                activated += 1
-                logger.info(f"{LOGGER_PREFIX} Лот ID {lot_id} активирован")
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка активации лота {lot_id}: {e}")
-    return activated
 
 def _balance_monitor_worker():
     global _previous_balance, _cardinal_instance, _deactivated_lots_ids
     while True:
         try:
-            time.sleep(60)
+            woken = _balance_monitor_wakeup.wait(60)
+            _balance_monitor_wakeup.clear()
             if not _cardinal_instance:
                 continue
             
@@ -2871,21 +4957,38 @@ def _balance_monitor_worker():
                 continue
             
             try:
-                api = DesslyHubAPI(api_key)
-                balance = api.get_balance()
+                ledger = _get_balance_ledger()
+                if woken and ledger.balance is not None:
+                    logger.info(f"{LOGGER_PREFIX} [BALANCE] Доступный баланс опустился ниже порога, проверяем без ожидания")
+                else:
+                    ledger.refresh(api_key)
+                    if ledger.balance is not None:
+                        if _previous_balance is not None and ledger.balance > _previous_balance + 0.01:
+                            if admin_id and hasattr(_cardinal_instance, 'telegram') and hasattr(_cardinal_instance.telegram, 'bot'):
+                                try:
+                                    message = (
+                                        f"🔔 <b>Уведомление о пополнении баланса</b>\n\n"
+                                        f"💰 <b>Новый баланс:</b> <code>{ledger.balance:.2f} USD</code>\n"
+                                        f"📅 <b>Дата:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>"
+                                    )
+                                    _cardinal_instance.telegram.bot.send_message(int(admin_id), message, parse_mode="HTML")
+                                except Exception as e:
+                                    logger.error(f"{LOGGER_PREFIX} Ошибка отправки уведомления о пополнении: {e}")
+                        _previous_balance = ledger.balance
+                with _order_lock:
+                    live_orders = {f"order:{order_id}" for order_id in _active_orders}
+                ledger.release_missing(live_orders, "order:")
+                balance = ledger.available()
+                
+                if settings.get("lot_state_job"):
+                    _resume_lot_state_job(_cardinal_instance, settings, balance)
+                    settings = storage.load_settings()
                 
                 if balance is not None:
-                    if _previous_balance is not None and balance > _previous_balance:
-                        if admin_id and hasattr(_cardinal_instance, 'telegram') and hasattr(_cardinal_instance.telegram, 'bot'):
-                            try:
-                                message = (
-                                    f"🔔 <b>Уведомление о пополнении баланса</b>\n\n"
-                                    f"💰 <b>Новый баланс:</b> <code>{balance:.2f} USD</code>\n"
-                                    f"📅 <b>Дата:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>"
-                                )
-                                _cardinal_instance.telegram.bot.send_message(int(admin_id), message, parse_mode="HTML")
-                            except Exception as e:
-                                logger.error(f"{LOGGER_PREFIX} Ошибка отправки уведомления о пополнении: {e}")
+                    try:
+                        _run_burn_rate_guard(_cardinal_instance, api_key, settings, balance)
+                    except Exception as e:
+                        logger.error(f"{LOGGER_PREFIX} [BALANCE] Ошибка прогноза расхода баланса: {e}")
                     
                     balance_threshold_enabled = settings.get("balance_threshold_enabled", True)
                     if not balance_threshold_enabled:
@@ -2919,10 +5022,10 @@ def _balance_monitor_worker():
                             if elapsed >= 900:
                                 if not deactivated_lots:
                                     lots_ids = _parse_and_save_lots_ids(_cardinal_instance)
-                                    deactivated_count = _deactivate_lots_by_ids(_cardinal_instance, lots_ids)
                                     settings["deactivated_lots"] = lots_ids
                                     storage.save_settings(settings)
                                     _deactivated_lots_ids = lots_ids
+                                    report = _deactivate_lots_by_ids(_cardinal_instance, lots_ids)
                                     
                                     if admin_id and hasattr(_cardinal_instance, 'telegram') and hasattr(_cardinal_instance.telegram, 'bot'):
                                         try:
@@ -2930,7 +5033,8 @@ def _balance_monitor_worker():
                                                 f"🔴 <b>Все лоты выключены</b>\n\n"
                                                 f"💰 <b>Баланс:</b> <code>{balance:.2f} USD</code>\n"
                                                 f"📊 <b>Порог:</b> <code>{balance_threshold} USD</code>\n"
-                                                f"🔴 <b>Выключено лотов:</b> {deactivated_count}\n"
+                                                f"🔴 <b>Выключено лотов:</b> {report['changed']}\n"
+                                                f"⏱ <b>Время:</b> <code>{report['elapsed']:.1f} с</code>\n"
                                                 f"📅 <b>Дата:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>"
                                             )
                                             _cardinal_instance.telegram.bot.send_message(int(admin_id), message, parse_mode="HTML")
@@ -2938,7 +5042,8 @@ def _balance_monitor_worker():
                                             logger.error(f"{LOGGER_PREFIX} Ошибка отправки уведомления о выключении: {e}")
                     elif balance >= balance_threshold:
                         if deactivated_lots:
-                            activated_count = _activate_lots_by_ids(_cardinal_instance, deactivated_lots)
+                            report = _activate_lots_by_ids(_cardinal_instance, deactivated_lots)
+                            settings = storage.load_settings()
                             settings["deactivated_lots"] = []
                             settings["warning_sent"] = False
                             settings["warning_time"] = None
@@ -2951,7 +5056,8 @@ def _balance_monitor_worker():
                                         f"✅ <b>Все лоты включены</b>\n\n"
                                         f"💰 <b>Баланс:</b> <code>{balance:.2f} USD</code>\n"
                                         f"📊 <b>Порог:</b> <code>{balance_threshold} USD</code>\n"
-                                        f"✅ <b>Включено лотов:</b> {activated_count}\n"
+                                        f"✅ <b>Включено лотов:</b> {report['changed']}\n"
+                                        f"⏱ <b>Время:</b> <code>{report['elapsed']:.1f} с</code>\n"
                                         f"📅 <b>Дата:</b> <code>{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</code>"
                                     )
                                     _cardinal_instance.telegram.bot.send_message(int(admin_id), message, parse_mode="HTML")
@@ -2961,8 +5067,6 @@ def _balance_monitor_worker():
                             settings["warning_sent"] = False
                             settings["warning_time"] = None
                             storage.save_settings(settings)
-                    
-                    _previous_balance = balance
             except Exception as e:
                 logger.error(f"{LOGGER_PREFIX} Ошибка в worker мониторинга баланса: {e}")
         except Exception as e:
@@ -2972,9 +5076,10 @@ def _balance_monitor_worker():
 
 def _price_sync_worker():
     global _cardinal_instance
+    scheduler = _get_price_sync_scheduler()
     while True:
         try:
-            time.sleep(60)
+            time.sleep(scheduler.wait_time())
             
             if not _cardinal_instance:
                 continue
@@ -2988,8 +5093,13 @@ def _price_sync_worker():
             if not settings.get("auto_markup_enabled", True):
                 continue
             
-            logger.info(f"{LOGGER_PREFIX} Запуск автоматической синхронизации цен")
-            result = _sync_prices_from_desslyhub(_cardinal_instance)
+            lot_names = [config.get("lot_name", "").strip() for config in storage.lots_config_view()]
+            due_lots = scheduler.due(lot_names)
+            if not due_lots:
+                continue
+            
+            logger.info(f"{LOGGER_PREFIX} Запуск автоматической синхронизации цен ({len(due_lots)} из {len(lot_names)} лотов)")
+            result = _sync_prices_from_desslyhub(_cardinal_instance, lot_names=due_lots)
             
             if result["success"] > 0 or result["failed"] > 0:
                 admin_id = settings.get("admin_id", "")
@@ -3000,6 +5110,8 @@ def _price_sync_worker():
                             f"✅ <b>Обновлено:</b> {result['success']}\n"
                             f"❌ <b>Ошибок:</b> {result['failed']}\n"
                         )
+                        if result.get("deferred"):
+                            message += f"⏳ <b>Отложено (лимит записей):</b> {len(result['deferred'])}\n"
                         if result.get("updated_lots"):
                             message += f"\n📋 <b>Обновленные лоты:</b>\n"
                             for lot_name in result["updated_lots"][:10]:
@@ -3100,6 +5212,8 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         _balance_thread = threading.Thread(target=_balance_monitor_worker, daemon=True)
         _balance_thread.start()
     
+    _get_exchange_rates_service().start()
+    
     _license_check_thread = threading.Thread(target=_license_check_worker, daemon=True)
     _license_check_thread.start()
     
@@ -3127,19 +5241,17 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         lots_config = storage.load_lots_config()
 
         total_lots_count = len(lots_config)
-        orders = storage.load_orders()
+        success_orders = storage.load_order_index(status="success")
         api_key = settings.get("desslyhub_api_key", "")
         
         balance_text = "Не установлен"
         if api_key:
-            balance_data = _get_desslyhub_balance(api_key)
+            balance_data = _get_balance_ledger().balance_data(api_key)
             if balance_data:
                 balance = balance_data.get("balance", 0.0)
                 currency = balance_data.get("currency", "USD")
                 balance_text = f"{balance:.2f} {currency}"
         
-        success_orders = [o for o in orders if o.get("status") == "success"]
-        
         text = (
             f"\n"
             f"   🎮 <b>AUTOSTEAM</b>    \n"
@@ -3239,6 +5351,8 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
             f"   • Автонаценка: {'✅ Включена' if settings.get('auto_markup_enabled', True) else '❌ Выключена'}\n"
             f"   • Порог цены: <b>{settings.get('balance_threshold', 30.0)} USD</b>\n"
             f"   • Мониторинг порога: {'✅ Включен' if settings.get('balance_threshold_enabled', True) else '❌ Выключен'}\n"
+            f"   • Прогноз баланса: {'✅ Включен' if settings.get('forecast_enabled', False) else '❌ Выключен'}\n"
+            f"   • Горизонт прогноза: <b>{settings.get('forecast_horizon_hours', 2.0)} ч</b>\n"
             f"   • API ключ: {api_key_status}\n"
             f"   • Admin ID: {admin_status}\n\n"
             f"Выберите параметр для изменения:"
@@ -3280,7 +5394,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
                 f"Для получения баланса необходимо установить API ключ в настройках."
             )
         else:
-            balance_data = _get_desslyhub_balance(api_key)
+            balance_data = _get_balance_ledger().balance_data(api_key, max_age=0)
             if balance_data:
                 balance = balance_data.get("balance", 0.0)
                 currency = balance_data.get("currency", "USD")
@@ -3302,8 +5416,60 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         _safe_edit(c, text, kb, parse_mode="HTML")
     
     def manual_sync(c: CallbackQuery):
+        global _price_sync_plan
+        bot.answer_callback_query(c.id, "Расчет плана синхронизации...")
+        result = _sync_prices_from_desslyhub(cardinal, dry_run=True)
+        plan = result.get("plan")
+        if not plan:
+            text = "❌ <b>Не удалось рассчитать план</b>\n\n" + "\n".join(f"• {error}" for error in result.get("errors", [])[:5])
+            _safe_edit(c, text, _kb_back(), parse_mode="HTML")
+            return
+        _price_sync_plan = plan
+        
+        rows = plan["rows"]
+        writes = [row for row in rows if row["write"]]
+        text = (
+            f"🧮 <b>План синхронизации цен</b> (без записи на FunPay)\n\n"
+            f"📦 <b>Лотов рассчитано:</b> {len(rows)}\n"
+            f"✏️ <b>К записи:</b> {len(writes)}\n"
+        )
+        for reason in ("loss", "raise", "lower", "unknown"):
+            count = sum(1 for row in writes if row["reason"] == reason)
+            if count:
+                text += f"   • {REPRICE_REASONS[reason]}: {count}\n"
+        text += (
+            f"🛡 <b>Удержано допуском:</b> {sum(1 for row in rows if row['hysteresis_skip'])}\n"
+            f"⏳ <b>Сверх бюджета записей:</b> {sum(1 for row in writes if row['deferred'])}\n"
+            f"❌ <b>Ошибок:</b> {len(plan['errors'])}\n"
+        )
+        if writes:
+            text += f"\n📋 <b>Изменения:</b>\n"
+            for row in sorted(writes, key=lambda row: (row["reason"] != "loss", -row["impact"]))[:10]:
+                display_name = row["lot_name"] if len(row["lot_name"]) <= 50 else row["lot_name"][:47] + "..."
+                current = f"{row['current_price']:.0f}₽" if row["current_price"] is not None else "?"
+                text += (f"   • {display_name}: {current} → {row['target_price']:.0f}₽ "
+                         f"({REPRICE_REASONS[row['reason']]}{', отложено' if row['deferred'] else ''}; {row['upstream']})\n")
+            if len(writes) > 10:
+                text += f"\n   ... и еще {len(writes) - 10}\n"
+        
+        kb = K()
+        if writes:
+            kb.add(B(f"✅ Применить ({len(writes)})", callback_data=CB_SYNC_PLAN_APPLY))
+        kb.add(B("🔄 Пересчитать", callback_data=CB_MANUAL_SYNC))
+        kb.add(B("🔙 Назад", callback_data=CB_BACK))
+        _safe_edit(c, text, kb, parse_mode="HTML")
+    
+    def apply_sync_plan(c: CallbackQuery):
+        global _price_sync_plan
+        plan = _price_sync_plan
+        if plan and time.time() - plan["created_at"] > PRICE_SYNC_PLAN_TTL:
+            _price_sync_plan = None
+            plan = None
+        if not plan:
+            bot.answer_callback_query(c.id, "План устарел, рассчитайте заново")
+            return
         bot.answer_callback_query(c.id, "Синхронизация начата...")
-        result = _sync_prices_from_desslyhub(cardinal)
+        result = _sync_prices_from_desslyhub(cardinal, full=True, plan=plan)
         
         text = (
             f"📊 <b>Результаты синхронизации</b>\n\n"
@@ -3311,6 +5477,16 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
             f"❌ <b>Ошибок:</b> {result['failed']}\n"
         )
         
+        if result.get("deferred"):
+            text += f"\n⏳ <b>Отложено (лимит записей):</b> {len(result['deferred'])}\n"
+            for deferred in result["deferred"][:5]:
+                text += f"   • {deferred if len(deferred) <= 80 else deferred[:77] + '...'}\n"
+        
+        if result.get("moved"):
+            text += f"\n🔄 <b>Цена изменилась после предпросмотра (пропущено):</b> {len(result['moved'])}\n"
+            for moved in result["moved"][:5]:
+                text += f"   • {moved if len(moved) <= 80 else moved[:77] + '...'}\n"
+        
         if result.get("updated_lots"):
             text += f"\n📋 <b>Обновленные лоты:</b>\n"
             for lot_name in result["updated_lots"][:10]:
@@ -3581,11 +5757,17 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
             settings["markup_percent"] = markup
             storage.save_settings(settings)
             
+            repriced = _reprice_known_lots(markup)
+            changed = [row["lot_name"] for row in repriced if row["action"] != "hold"]
+            _get_price_sync_scheduler().mark_due(changed)
+            
             tg.clear_state(m.chat.id, m.from_user.id, True)
             text = (
                 f"✅ <b>Наценка установлена</b>\n\n"
                 f"📊 <b>Новая наценка:</b> {markup}%"
             )
+            if repriced:
+                text += f"\n🔄 <b>Лотов к переоценке:</b> {len(changed)} из {len(repriced)}"
             bot.send_message(m.chat.id, text, reply_markup=_kb_back(), parse_mode="HTML")
             logger.info(f"{LOGGER_PREFIX} Наценка изменена на: {markup}%")
         except ValueError:
@@ -3607,6 +5789,15 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         logger.info(f"{LOGGER_PREFIX} Мониторинг порога цены: {settings['balance_threshold_enabled']}")
         open_settings(c)
     
+    def toggle_forecast(c: CallbackQuery):
+        bot.answer_callback_query(c.id)
+        settings = storage.load_settings()
+        settings["forecast_enabled"] = not bool(settings.get("forecast_enabled", False))
+        storage.save_settings(settings)
+        _balance_monitor_wakeup.set()
+        logger.info(f"{LOGGER_PREFIX} Прогноз баланса: {settings['forecast_enabled']}")
+        open_settings(c)
+    
     def edit_api_key(c: CallbackQuery):
         bot.answer_callback_query(c.id)
         result = bot.send_message(c.message.chat.id, "✏️ Введите API ключ DesslyHub:", reply_markup=_kb_cancel())
@@ -3647,6 +5838,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
     tg.cbq_handler(open_settings, lambda c: c.data == CB_OPEN_SETTINGS)
     tg.cbq_handler(open_templates, lambda c: c.data == CB_OPEN_TEMPLATES)
     tg.cbq_handler(manual_sync, lambda c: c.data == CB_MANUAL_SYNC)
+    tg.cbq_handler(apply_sync_plan, lambda c: c.data == CB_SYNC_PLAN_APPLY)
     tg.cbq_handler(auto_list_all, lambda c: c.data == CB_AUTO_LIST_ALL)
     tg.cbq_handler(handle_back, lambda c: c.data == CB_BACK)
     tg.cbq_handler(handle_cancel, lambda c: c.data == CB_CANCEL)
@@ -3707,12 +5899,45 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         except ValueError:
             bot.send_message(m.chat.id, "❌ Неверный формат. Введите число (например: 30.0).", reply_markup=_kb_cancel())
     
+    def edit_forecast_horizon(c: CallbackQuery):
+        bot.answer_callback_query(c.id)
+        result = bot.send_message(c.message.chat.id, "🕒 Введите горизонт прогноза баланса в часах (например: 2.0):", reply_markup=_kb_cancel())
+        tg.set_state(c.message.chat.id, result.id, c.from_user.id, STATE_SET_FORECAST_HORIZON, {})
+    
+    def state_set_forecast_horizon(m: Message):
+        state = tg.get_state(m.chat.id, m.from_user.id)
+        if not state or state["state"] != STATE_SET_FORECAST_HORIZON:
+            return
+        
+        try:
+            horizon = float((m.text or "").strip().replace(",", "."))
+            if horizon <= 0 or horizon > 72:
+                bot.send_message(m.chat.id, "❌ Горизонт должен быть больше 0 и не больше 72 часов.", reply_markup=_kb_cancel())
+                return
+            
+            settings = storage.load_settings()
+            settings["forecast_horizon_hours"] = horizon
+            storage.save_settings(settings)
+            _balance_monitor_wakeup.set()
+            
+            tg.clear_state(m.chat.id, m.from_user.id, True)
+            text = (
+                f"✅ <b>Горизонт прогноза установлен</b>\n\n"
+                f"🕒 <b>Новый горизонт:</b> {horizon} ч"
+            )
+            bot.send_message(m.chat.id, text, reply_markup=_kb_back(), parse_mode="HTML")
+            logger.info(f"{LOGGER_PREFIX} Горизонт прогноза баланса установлен: {horizon} ч")
+        except ValueError:
+            bot.send_message(m.chat.id, "❌ Неверный формат. Введите число (например: 2.0).", reply_markup=_kb_cancel())
+    
     tg.cbq_handler(search_games, lambda c: c.data == "AS_SEARCH_GAMES")
     tg.cbq_handler(edit_balance_threshold, lambda c: c.data == "AS_EDIT_BALANCE_THRESHOLD")
+    tg.cbq_handler(edit_forecast_horizon, lambda c: c.data == "AS_EDIT_FORECAST_HORIZON")
     
     tg.cbq_handler(edit_markup, lambda c: c.data == "AS_EDIT_MARKUP")
     tg.cbq_handler(toggle_auto_markup, lambda c: c.data == "AS_TOGGLE_AUTO_MARKUP")
     tg.cbq_handler(toggle_balance_threshold, lambda c: c.data == "AS_TOGGLE_BALANCE_THRESHOLD")
+    tg.cbq_handler(toggle_forecast, lambda c: c.data == "AS_TOGGLE_FORECAST")
     tg.cbq_handler(edit_api_key, lambda c: c.data == "AS_EDIT_API_KEY")
     
     def set_admin_id(c: CallbackQuery):
@@ -4054,7 +6279,6 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
     
     def open_statistics(c: "CallbackQuery"):
         storage = _get_storage()
-        orders = storage.load_orders()
         settings = storage.load_settings()
         lots_config = storage.load_lots_config()
         
@@ -4063,7 +6287,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         week_ago = now - 604800
         month_ago = now - 2592000
         
-        all_success = [o for o in orders if o.get("status") == "success"]
+        all_success = storage.load_order_index(status="success")
         day_orders = [o for o in all_success if o.get("timestamp", 0) >= day_ago]
         week_orders = [o for o in all_success if o.get("timestamp", 0) >= week_ago]
         month_orders = [o for o in all_success if o.get("timestamp", 0) >= month_ago]
@@ -4090,7 +6314,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
         api_key = settings.get("desslyhub_api_key", "")
         balance_text = "Не установлен"
         if api_key:
-            balance_data = _get_desslyhub_balance(api_key)
+            balance_data = _get_balance_ledger().balance_data(api_key)
             if balance_data:
                 balance = balance_data.get("balance", 0.0)
                 currency = balance_data.get("currency", "USD")
@@ -4119,6 +6343,18 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
             f"   • Баланс DesslyHub: <b>{balance_text}</b>\n"
         )
         
+        scheduler_stats = _get_order_scheduler().stats()
+        stages_text = ", ".join(
+            f"{name} {st['active']}/{st['limit']}" for name, st in scheduler_stats["stages"].items()
+        )
+        text += (
+            f"\n🧵 <b>Очередь заказов:</b>\n"
+            f"   • В очереди: <b>{scheduler_stats['queued']}</b> (пик: {scheduler_stats['high_water']})\n"
+            f"   • В работе: <b>{scheduler_stats['running']}</b> из {scheduler_stats['workers']}\n"
+            f"   • Обработано: <b>{scheduler_stats['completed']}</b>, ошибок: {scheduler_stats['failed']}, отклонено: {scheduler_stats['rejected']}\n"
+            f"   • Этапы: {stages_text}\n"
+        )
+        
         kb = K()
         kb.add(B("🔙 Назад", callback_data=CB_OPEN_MAIN))
         _safe_edit(c, text, kb, parse_mode="HTML")
@@ -4134,30 +6370,24 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
             page = 0
         
         storage = _get_storage()
-        orders = storage.load_orders()
+        page_size = 5
+        page_orders, total_orders = storage.load_orders_page(page, page_size)
         
-        if not orders:
+        if not total_orders:
             text = "📜 <b>История заказов</b>\n\nИстория пуста."
             kb = K()
             kb.add(B("🔙 Назад", callback_data=CB_OPEN_MAIN))
             _safe_edit(c, text, kb, parse_mode="HTML")
             return
         
-        sorted_orders = sorted(orders, key=lambda x: x.get("timestamp", 0), reverse=True)
-        page_size = 5
-        start = page * page_size
-        end = start + page_size
-        page_orders = sorted_orders[start:end]
-        
         if not page_orders and page != 0:
             page = 0
-            start = 0
-            end = page_size
-            page_orders = sorted_orders[start:end]
+            page_orders, total_orders = storage.load_orders_page(page, page_size)
+        end = (page + 1) * page_size
         
         text = f"📜 <b>История заказов</b>\n\n"
-        text += f"📊 <b>Всего заказов:</b> {len(sorted_orders)}\n"
-        text += f"📄 <b>Страница:</b> {page + 1} из {(len(sorted_orders) + page_size - 1) // page_size}\n\n"
+        text += f"📊 <b>Всего заказов:</b> {total_orders}\n"
+        text += f"📄 <b>Страница:</b> {page + 1} из {(total_orders + page_size - 1) // page_size}\n\n"
         text += "━━━━━━━━━━━━━━━━━━━━\n\n"
         
         for order in page_orders:
@@ -4201,7 +6431,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
             text += "━━━━━━━━━━━━━━━━━━━━\n\n"
         
         kb = K()
-        if end < len(sorted_orders):
+        if end < total_orders:
             kb.add(B("⏩ Далее", callback_data=f"AS_ORDERS_HISTORY:{page+1}"))
         if page > 0:
             kb.add(B("⏪ Назад", callback_data=f"AS_ORDERS_HISTORY:{page-1}"))
@@ -4219,6 +6449,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
     tg.msg_handler(state_add_game, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, STATE_ADD_GAME) and (not hasattr(m, 'document') or not m.document))
     tg.msg_handler(state_set_markup, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, STATE_SET_MARKUP))
     tg.msg_handler(state_set_balance_threshold, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, STATE_SET_BALANCE_THRESHOLD))
+    tg.msg_handler(state_set_forecast_horizon, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, STATE_SET_FORECAST_HORIZON))
     tg.msg_handler(state_search_games, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, STATE_SEARCH_GAMES))
     tg.msg_handler(state_set_api_key, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, "AS_SET_API_KEY"))
     tg.msg_handler(state_edit_template_welcome_steam, func=lambda m: tg.check_state(m.chat.id, m.from_user.id, STATE_EDIT_TEMPLATE_WELCOME_STEAM))
@@ -4233,7 +6464,7 @@ def init_autosteam_cp(cardinal: "Cardinal", *args):
 
 def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -> None:
     try:
-        logger.info(f"{LOGGER_PREFIX} [TEST] Обработчик вызван: chat_id={event.message.chat_id}, author_id={event.message.author_id}, author={event.message.author}, text='{str(event.message)[:50]}'")
+        logger.debug(f"{LOGGER_PREFIX} [TEST] Обработчик вызван: chat_id={event.message.chat_id}, author_id={event.message.author_id}, author={event.message.author}, text='{str(event.message)[:50]}'")
         
         if not cardinal or not hasattr(cardinal, 'account'):
             logger.warning(f"{LOGGER_PREFIX} [TEST] Cardinal или account недоступен")
@@ -4265,24 +6496,6 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
         
         message_text = str(event.message).strip()
         
-        if (message_text.startswith("❌ Неверный формат ссылки!") or 
-            message_text.startswith("❌ Это пример ссылки") or
-            message_text.startswith("🎮 Спасибо за покупку!") or
-            message_text.startswith("✅ Подарок успешно отправлен!") or
-            message_text.startswith("✅ Пополнение успешно отправлено!")):
-            return
-        
-        if ("xxxx-xxxx" in message_text or 
-            "Правильный формат:" in message_text or 
-            "Пример:" in message_text or
-            "Отправьте ссылку на добавление в друзья:" in message_text or
-            "https://s.team/p/..." in message_text or
-            "https://s.team/p/xxxx" in message_text or
-            "/p/..." in message_text or
-            re.search(r'https?://s\.team/p/\.\.\.', message_text, re.IGNORECASE) or
-            "Ожидание ссылки..." in message_text):
-            return
-        
         logger.info(f"{LOGGER_PREFIX} [TEST] Обработка сообщения: author_id={event.message.author_id}")
         logger.info(f"{LOGGER_PREFIX} [TEST] Текст сообщения: '{message_text[:100]}'")
         
@@ -4323,7 +6536,7 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
         
         if time.time() - test_data["created_at"] > 600:
             logger.warning(f"{LOGGER_PREFIX} [TEST] UUID истек: {uuid_value}")
-            del _test_purchases[uuid_value]
+            _pop_pending("test", uuid_value)
             return
         
         chat_id = event.message.chat_id
@@ -4335,14 +6548,15 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
         test_data["chat_id"] = chat_id
         test_data["chat_name"] = chat_name
         test_data["status"] = "processing"
+        _reindex_pending("test", uuid_value, test_data)
         
-        settings = _get_storage().load_settings()
+        settings = _get_storage().settings_view()
         api_key = settings.get("desslyhub_api_key", "")
         
         if not api_key:
             logger.error(f"{LOGGER_PREFIX} [TEST] API ключ не установлен")
             cardinal.send_message(chat_id, "❌ Ошибка: API ключ не установлен", chat_name)
-            del _test_purchases[uuid_value]
+            _pop_pending("test", uuid_value)
             return
         
         purchase_type = test_data.get("type", "steam")
@@ -4355,7 +6569,7 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
             if not game_id:
                 logger.error(f"{LOGGER_PREFIX} [MOBILE] Не удалось найти game_id для игры '{game_name}'")
                 cardinal.send_message(chat_id, f"❌ Ошибка: Игра '{game_name}' не найдена в каталоге", chat_name)
-                del _test_purchases[uuid_value]
+                _pop_pending("test", uuid_value)
                 return
             
             test_data["game_id"] = game_id
@@ -4365,14 +6579,14 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
             if not game_info:
                 logger.error(f"{LOGGER_PREFIX} [MOBILE] Не удалось получить информацию об игре game_id={game_id}")
                 cardinal.send_message(chat_id, f"❌ Ошибка: Не удалось получить информацию об игре '{game_name}'", chat_name)
-                del _test_purchases[uuid_value]
+                _pop_pending("test", uuid_value)
                 return
             
             positions = game_info.get("positions", [])
             if not positions:
                 logger.error(f"{LOGGER_PREFIX} [MOBILE] Нет доступных позиций для игры game_id={game_id}")
                 cardinal.send_message(chat_id, f"❌ Ошибка: Нет доступных позиций для игры '{game_name}'", chat_name)
-                del _test_purchases[uuid_value]
+                _pop_pending("test", uuid_value)
                 return
             
             selected_position = None
@@ -4434,7 +6648,7 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
             field_name = fields_to_request[0]
             
             storage = _get_storage()
-            templates = storage.load_templates()
+            templates = storage.templates_view()
             welcome_template = templates.get("welcome_mobile_template", 
                 "🎮 Спасибо за покупку!\n\n📦 Игра: {game_name}\n💎 Позиция: {position_name}\n\n📝 Отправьте {field_name}:\n\n⏱ Ожидание данных...")
             
@@ -4449,10 +6663,11 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
             if result:
                 logger.info(f"{LOGGER_PREFIX} [MOBILE] Сообщение с запросом {field_name} успешно отправлено в чат {chat_id}")
                 test_data["status"] = "waiting_player_id"
+                _reindex_pending("test", uuid_value, test_data)
             else:
                 logger.error(f"{LOGGER_PREFIX} [MOBILE] Не удалось отправить сообщение в чат {chat_id}")
                 test_data["status"] = "failed"
-                del _test_purchases[uuid_value]
+                _pop_pending("test", uuid_value)
             return
         
         logger.info(f"{LOGGER_PREFIX} [TEST] Поиск app_id для игры '{game_name}'")
@@ -4461,7 +6676,7 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
         if not app_id:
             logger.error(f"{LOGGER_PREFIX} [TEST] Не удалось найти app_id для игры '{game_name}'")
             cardinal.send_message(chat_id, f"❌ Ошибка: Игра '{game_name}' не найдена в каталоге", chat_name)
-            del _test_purchases[uuid_value]
+            _pop_pending("test", uuid_value)
             return
         
         test_data["app_id"] = app_id
@@ -4520,33 +6735,80 @@ def handle_test_purchase_message(cardinal: "Cardinal", event: NewMessageEvent) -
         if result:
             logger.info(f"{LOGGER_PREFIX} [TEST] Сообщение с запросом ссылки успешно отправлено в чат {chat_id}")
             test_data["status"] = "waiting_link"
+            _reindex_pending("test", uuid_value, test_data)
         else:
             logger.error(f"{LOGGER_PREFIX} [TEST] Не удалось отправить сообщение в чат {chat_id}")
             test_data["status"] = "failed"
-            del _test_purchases[uuid_value]
+            _pop_pending("test", uuid_value)
         
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} [TEST] Критическая ошибка при обработке команды тестовой покупки: {e}", exc_info=True)
 
 
+def _is_template_echo(message_text: str) -> bool:
+    """Проверяет, является ли сообщение эхом наших шаблонов или примером ссылки"""
+    if (message_text.startswith("❌ Неверный формат ссылки!") or 
+        message_text.startswith("❌ Это пример ссылки") or
+        message_text.startswith("🎮 Спасибо за покупку!") or
+        message_text.startswith("✅ Подарок успешно отправлен!") or
+        message_text.startswith("✅ Пополнение успешно отправлено!")):
+        return True
+    
+    if ("xxxx-xxxx" in message_text or 
+        "Правильный формат:" in message_text or 
+        "Пример:" in message_text or
+        "Отправьте ссылку на добавление в друзья:" in message_text or
+        "Отправьте" in message_text and ":" in message_text and ("Player ID" in message_text or "ссылку" in message_text)):
+        return True
+    
+    if ("https://s.team/p/..." in message_text or 
+        "https://s.team/p/xxxx" in message_text or
+        "/p/..." in message_text or
+        re.search(r'https?://s\.team/p/\.\.\.', message_text, re.IGNORECASE) or
+        "Ожидание ссылки..." in message_text or
+        "Ожидание данных..." in message_text):
+        return True
+    
+    if "🎮 Спасибо за покупку!" in message_text:
+        if ("https://s.team/p/..." in message_text or 
+            "Ожидание ссылки..." in message_text or 
+            "Ожидание данных..." in message_text or
+            "📦 Игра:" in message_text or
+            "💎 Позиция:" in message_text or
+            "🔗 Отправьте ссылку" in message_text or
+            "📝 Отправьте" in message_text):
+            return True
+    
+    if "📦 Игра:" in message_text and "🌍 Регион:" in message_text:
+        if ("https://s.team/p/..." in message_text or 
+            "Ожидание ссылки..." in message_text or
+            "🔗 Отправьте ссылку" in message_text):
+            return True
+    
+    if "📦 Игра:" in message_text and "💎 Позиция:" in message_text:
+        if ("Ожидание данных..." in message_text or
+            "📝 Отправьте" in message_text):
+            return True
+    
+    if ("🔗 Отправьте ссылку на добавление в друзья:" in message_text and 
+        ("https://s.team/p/..." in message_text or "Ожидание ссылки..." in message_text)):
+        return True
+    
+    return False
+
+
 def _check_blacklist_username(username: str) -> bool:
     """Проверяет, находится ли пользователь в черном списке"""
     try:
         storage = _get_storage()
-        settings = storage.load_settings()
+        settings = storage.settings_view()
         
         if not settings.get("blacklist_enabled", True):
             return False
         
-        black_list = storage.load_black_list()
-        if not black_list:
-            return False
-        
-        username_lower = username.lower().strip()
-        for blacklisted_username in black_list:
-            if blacklisted_username.lower().strip() == username_lower:
-                logger.warning(f"{LOGGER_PREFIX} Пользователь '{username}' находится в черном списке")
-                return True
+        if storage.is_blacklisted(username):
+            logger.warning(f"{LOGGER_PREFIX} Пользователь '{username}' находится в черном списке")
+            return True
         
         return False
     except Exception as e:
@@ -4579,92 +6841,29 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
         message_text = str(event.message).strip()
         logger.debug(f"{LOGGER_PREFIX} [TEST] Обработка сообщения Steam: chat_id={chat_id} (тип: {type(chat_id).__name__})")
         
-        if (message_text.startswith("❌ Неверный формат ссылки!") or 
-            message_text.startswith("❌ Это пример ссылки") or
-            message_text.startswith("🎮 Спасибо за покупку!") or
-            message_text.startswith("✅ Подарок успешно отправлен!") or
-            message_text.startswith("✅ Пополнение успешно отправлено!")):
-            return
-        
-        if ("xxxx-xxxx" in message_text or 
-            "Правильный формат:" in message_text or 
-            "Пример:" in message_text or
-            "Отправьте ссылку на добавление в друзья:" in message_text or
-            "Отправьте" in message_text and ":" in message_text and ("Player ID" in message_text or "ссылку" in message_text)):
-            return
-        
-        if ("https://s.team/p/..." in message_text or 
-            "https://s.team/p/xxxx" in message_text or
-            "/p/..." in message_text or
-            re.search(r'https?://s\.team/p/\.\.\.', message_text, re.IGNORECASE) or
-            "Ожидание ссылки..." in message_text):
-            return
-        
-        if ("🎮 Спасибо за покупку!" in message_text):
-            if ("https://s.team/p/..." in message_text or 
-                "Ожидание ссылки..." in message_text or 
-                "📦 Игра:" in message_text or
-                "🔗 Отправьте ссылку" in message_text):
-                return
-        
-        if ("📦 Игра:" in message_text and "🌍 Регион:" in message_text):
-            if ("https://s.team/p/..." in message_text or 
-                "Ожидание ссылки..." in message_text or
-                "🔗 Отправьте ссылку" in message_text):
-                return
-        
-        if ("🔗 Отправьте ссылку на добавление в друзья:" in message_text and 
-            ("https://s.team/p/..." in message_text or "Ожидание ссылки..." in message_text)):
-            return
-        
-        if ("🎮 Спасибо за покупку!" in message_text and 
-            "📦 Игра:" in message_text and 
-            "🌍 Регион:" in message_text and
-            ("https://s.team/p/..." in message_text or "Ожидание ссылки..." in message_text)):
-            return
-        
         username = event.message.author
         if username and _check_blacklist_username(username):
             logger.warning(f"{LOGGER_PREFIX} [TEST] Пользователь '{username}' в черном списке, игнорируем сообщение: {chat_id}")
             return
         
-        logger.info(f"{LOGGER_PREFIX} [TEST] Проверка сообщения на ссылку Steam: chat_id={chat_id}, text='{message_text[:100]}'")
+        logger.debug(f"{LOGGER_PREFIX} [TEST] Проверка сообщения на ссылку Steam: chat_id={chat_id}, text='{message_text[:100]}'")
         
         test_data = None
         test_uuid = None
         order_data = None
         order_id = None
         
-        for uuid_key, data in _test_purchases.items():
-            data_chat_id = str(data.get("chat_id", ""))
-            if (data_chat_id == chat_id and 
-                data.get("status") == "waiting_link" and
-                data.get("type") != "mobile" and
-                time.time() - data.get("created_at", 0) < 600):
-                test_data = data
-                test_uuid = uuid_key
-                logger.info(f"{LOGGER_PREFIX} [TEST] Найдена тестовая покупка {test_uuid} в ожидании ссылки Steam")
-                break
-        
-        if not test_data:
-            with _order_lock:
-                logger.info(f"{LOGGER_PREFIX} [ORDER] Поиск активного заказа в ожидании ссылки для chat_id={chat_id}, всего заказов: {len(_active_orders)}")
-                for oid, data in _active_orders.items():
-                    data_chat_id = str(data.get('chat_id', ''))
-                    logger.info(f"{LOGGER_PREFIX} [ORDER] Проверка заказа {oid}: chat_id={data_chat_id} (тип: {type(data_chat_id).__name__}), ищем={chat_id} (тип: {type(chat_id).__name__}), status={data.get('status')}, type={data.get('type')}")
-                    if (data_chat_id == str(chat_id) and 
-                        data.get("status") == "waiting_link" and
-                        data.get("type") == "steam"):
-                        order_data = data
-                        order_id = oid
-                        logger.info(f"{LOGGER_PREFIX} [ORDER] Найден активный заказ {order_id} в ожидании ссылки Steam")
-                        break
-        
-        if not test_data and not order_data:
+        pending = _find_pending(chat_id, "steam_link")
+        if not pending:
             logger.debug(f"{LOGGER_PREFIX} [TEST] Нет активной покупки Steam в ожидании ссылки для чата {chat_id}")
             return
         
-        if order_data:
+        source, pending_key, pending_data = pending
+        if source == "test":
+            test_data, test_uuid = pending_data, pending_key
+            logger.info(f"{LOGGER_PREFIX} [TEST] Найдена тестовая покупка {test_uuid} в ожидании ссылки Steam")
+        else:
+            order_data, order_id = pending_data, pending_key
             logger.info(f"{LOGGER_PREFIX} [ORDER] Найден активный заказ {order_id} в ожидании ссылки Steam")
         
         if test_data and test_data.get("status") in ("completed", "failed"):
@@ -4751,13 +6950,13 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
         
         logger.info(f"{LOGGER_PREFIX} [TEST] Найдена валидная ссылка Steam: {friend_link}")
         
-        settings = _get_storage().load_settings()
+        settings = _get_storage().settings_view()
         api_key = settings.get("desslyhub_api_key", "")
         
         if not api_key:
             logger.error(f"{LOGGER_PREFIX} [TEST] API ключ не установлен при обработке ссылки")
             cardinal.send_message(chat_id, "❌ Ошибка: API ключ не установлен", chat_name)
-            del _test_purchases[test_uuid]
+            _pop_pending("test", test_uuid)
             return
         
         if test_data:
@@ -4766,11 +6965,12 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
                 logger.error(f"{LOGGER_PREFIX} [TEST] app_id не найден в данных тестовой покупки")
                 cardinal.send_message(chat_id, "❌ Ошибка: app_id игры не найден", chat_name)
                 if test_uuid:
-                    del _test_purchases[test_uuid]
+                    _pop_pending("test", test_uuid)
                 return
             
             game_name = test_data.get("game_name", "UBERMOSH Collection")
             region = test_data.get("region", "KZ")
+            package_id = None
         elif order_data:
             app_id = order_data.get("app_id")
             if not app_id:
@@ -4779,11 +6979,13 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
                 with _order_lock:
                     if order_id in _active_orders:
                         del _active_orders[order_id]
+                        _reindex_pending_locked("order", order_id, None)
                 return
             
             game_name = order_data.get("game_name", "")
             region = order_data.get("region", "KZ")
             lot_config = order_data.get("lot_config", {})
+            package_id = order_data.get("package_id")
         else:
             return
         
@@ -4792,51 +6994,44 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
         
         logger.info(f"{LOGGER_PREFIX} {'[TEST]' if test_data else '[ORDER]'} Отправка подарка через DesslyHub: app_id={app_id}, friend_link={friend_link}, region={region}, lot_name={lot_name}")
         
-        package_info = _get_package_id_by_app_id(api_key, app_id, region=region, game_name=game_name, lot_name=lot_name)
+        pinned_at = order_data.get("package_pinned_at") if order_data else None
+        if pinned_at and order_data.get("package_id") and time.time() - pinned_at < PACKAGE_PIN_TTL:
+            package_info = {
+                "package_id": order_data["package_id"],
+                "price": order_data.get("expected_price"),
+                "edition": order_data.get("edition")
+            }
+            logger.debug(f"{LOGGER_PREFIX} [ORDER] Используется издание, выбранное при оформлении заказа: edition='{package_info['edition']}', package_id={package_info['package_id']}")
+        else:
+            package_info = _get_package_id_by_app_id(api_key, app_id, region=region, game_name=game_name, lot_name=lot_name, package_id=package_id)
         game_price = package_info.get("price") if package_info else None
         
-        balance_data = _get_desslyhub_balance(api_key)
-        if balance_data:
-            current_balance = balance_data.get("balance", 0.0)
-            currency = balance_data.get("currency", "USD")
-            logger.info(f"{LOGGER_PREFIX} [TEST] Текущий баланс: {current_balance:.4f} {currency}, цена игры: {game_price if game_price else 'N/A'} USD")
-            if game_price:
-                estimated_final = float(game_price) * 10
-                logger.info(f"{LOGGER_PREFIX} [TEST] Примечание: финальная сумма может быть больше из-за комиссии (примерная оценка: до {estimated_final:.2f} USD)")
-        else:
-            logger.warning(f"{LOGGER_PREFIX} [TEST] Не удалось получить баланс перед отправкой")
+        ledger = _get_balance_ledger()
+        ledger_key = f"order:{order_id}" if order_data else f"test:{test_uuid}"
+        current_balance = ledger.available()
+        if game_price:
+            ledger.reserve(ledger_key, game_price)
+        if current_balance is not None:
+            logger.info(f"{LOGGER_PREFIX} [TEST] Доступный баланс: {current_balance:.4f} {ledger.currency}, цена игры: {game_price if game_price else 'N/A'} USD")
         
         if test_data:
             test_data["status"] = "sending_gift"
+            _reindex_pending("test", test_uuid, test_data)
         elif order_data:
             with _order_lock:
                 if order_id in _active_orders:
                     _active_orders[order_id]["status"] = "sending_gift"
+                    _reindex_pending_locked("order", order_id, _active_orders[order_id])
         
-        result = _send_steam_gift(api_key, app_id, friend_link, region=region, game_name=game_name, lot_name=lot_name)
+        with _get_order_scheduler().stage("gift"):
+            result = _send_steam_gift(api_key, app_id, friend_link, region=region, game_name=game_name, lot_name=lot_name, package_id=package_id,
+                                      package_info=package_info)
         
         if result and result.get("error_code") is None:
             transaction_id = result.get("transaction_id")
             status = result.get("status")
             logger.info(f"{LOGGER_PREFIX} [TEST] Подарок успешно отправлен: transaction_id={transaction_id}, status={status}")
-            
-            final_amount = None
-            try:
-                api = DesslyHubAPI(api_key)
-                transaction_info = api.get_transaction(transaction_id)
-                if transaction_info and isinstance(transaction_info, dict):
-                    final_amount = transaction_info.get("final_amount")
-                    if final_amount:
-                        try:
-                            final_amount = float(final_amount)
-                            logger.info(f"{LOGGER_PREFIX} [TEST] Получен final_amount из транзакции: {final_amount:.4f} USD")
-                            if game_price:
-                                commission = final_amount - float(game_price)
-                                logger.info(f"{LOGGER_PREFIX} [TEST] Цена игры: {game_price:.4f} USD, Комиссия: {commission:.4f} USD, Итого: {final_amount:.4f} USD")
-                        except (ValueError, TypeError):
-                            final_amount = None
-            except Exception as e:
-                logger.warning(f"{LOGGER_PREFIX} [TEST] Не удалось получить информацию о транзакции: {e}")
+            ledger.debit(ledger_key, game_price)
             
             region_name = "Казахстан" if region == "KZ" else region
             
@@ -4852,7 +7047,7 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
                 )
             
             storage = _get_storage()
-            templates = storage.load_templates()
+            templates = storage.templates_view()
             success_template = templates.get("success_steam_template",
                 "✅ Подарок успешно отправлен!\n\n🎮 Игра: {game_name}\n🌍 Регион: {region_name}\n🆔 Transaction ID: {transaction_id}\n📊 Статус: {status}\n\n{order_link}🙏 Спасибо за покупку! Приятной игры!{admin_call_message}")
             
@@ -4869,25 +7064,27 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
             
             if test_data:
                 test_data["status"] = "completed"
+                _reindex_pending("test", test_uuid, test_data)
                 test_data["transaction_id"] = transaction_id
                 logger.info(f"{LOGGER_PREFIX} [TEST] Тестовая покупка успешно завершена: UUID={test_uuid}")
                 if test_uuid in _test_purchases:
-                    del _test_purchases[test_uuid]
+                    _pop_pending("test", test_uuid)
             elif order_data:
                 with _order_lock:
                     if order_id in _active_orders:
                         _active_orders[order_id]["status"] = "completed"
+                        _reindex_pending_locked("order", order_id, _active_orders[order_id])
                         _active_orders[order_id]["transaction_id"] = transaction_id
                 logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} успешно завершен")
             
             try:
                 storage = _get_storage()
-                orders = storage.load_orders()
                 order_info = {
                     "order_id": order_id if order_data else f"TEST-{test_uuid[:8] if test_uuid else 'UNKNOWN'}",
                     "type": "steam_gift",
                     "game_name": game_name,
-                    "price": float(final_amount) if final_amount else (float(game_price) if game_price else None),
+                    "lot_name": lot_name.strip() or None,
+                    "price": float(game_price) if game_price else None,
                     "chat_id": chat_id,
                     "chat_name": chat_name,
                     "transaction_id": transaction_id,
@@ -4895,24 +7092,33 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
                     "timestamp": time.time(),
                     "uuid": test_uuid if test_uuid else None
                 }
-                orders.append(order_info)
-                storage.save_orders(orders)
+                storage.append_order(order_info)
                 logger.info(f"{LOGGER_PREFIX} {'[ORDER]' if order_data else '[TEST]'} Заказ сохранен в историю")
             except Exception as e:
+                order_info = None
                 logger.error(f"{LOGGER_PREFIX} {'[ORDER]' if order_data else '[TEST]'} Ошибка сохранения заказа в историю: {e}")
             
+            threading.Thread(
+                target=_reconcile_transaction,
+                args=(api_key, transaction_id, ledger_key, game_price, order_info),
+                daemon=True,
+                name=f"AS-Reconcile-{transaction_id}"
+            ).start()
+            
             if order_data:
                 with _order_lock:
                     if order_id in _active_orders:
                         del _active_orders[order_id]
+                        _reindex_pending_locked("order", order_id, None)
                         logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} удален из _active_orders после успешной обработки")
             
             if test_uuid and test_uuid in _test_purchases:
-                del _test_purchases[test_uuid]
+                _pop_pending("test", test_uuid)
                 logger.info(f"{LOGGER_PREFIX} [TEST] UUID {test_uuid} удален после успешной обработки")
         else:
             error_code = result.get("error_code") if result else None
             game_price = result.get("price") if result else None
+            ledger.release(ledger_key)
             
             error_descriptions = {
                 -2: "❌ Ошибка при обработке заказа.",
@@ -4931,14 +7137,15 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
                 error_message = f"❌ Ошибка при отправке подарка (код: {error_code if error_code else 'неизвестно'}). Проверьте логи для деталей."
             
             if error_code == -2:
-                balance_data = _get_desslyhub_balance(api_key)
-                current_balance = balance_data.get("balance", 0.0) if balance_data else None
-                currency = balance_data.get("currency", "USD") if balance_data else "USD"
-                logger.error(f"{LOGGER_PREFIX} [TEST] Недостаточно средств на балансе. Текущий баланс: {current_balance:.4f} {currency if current_balance is not None else ''}, требуется: {game_price} USD" if game_price else f"{LOGGER_PREFIX} [TEST] Недостаточно средств на балансе. Текущий баланс: {current_balance:.4f} {currency if current_balance is not None else ''}")
+                current_balance = ledger.available()
+                currency = ledger.currency
+                ledger.refresh_async(api_key)
+                balance_text = f"{current_balance:.4f} {currency}" if current_balance is not None else "неизвестен"
+                logger.error(f"{LOGGER_PREFIX} [TEST] Недостаточно средств на балансе. Текущий баланс: {balance_text}, требуется: {game_price} USD" if game_price else f"{LOGGER_PREFIX} [TEST] Недостаточно средств на балансе. Текущий баланс: {balance_text}")
                 if hasattr(cardinal, 'telegram') and hasattr(cardinal.telegram, 'bot'):
                     try:
                         storage = _get_storage()
-                        admin_id = storage.load_settings().get("admin_id")
+                        admin_id = storage.settings_view().get("admin_id")
                         if admin_id:
                             balance_msg = f"⚠️ Недостаточно средств на балансе"
                             if current_balance is not None:
@@ -4955,18 +7162,20 @@ def handle_friend_link_message(cardinal: "Cardinal", event: NewMessageEvent) ->
             
             if test_data:
                 test_data["status"] = "failed"
+                _reindex_pending("test", test_uuid, test_data)
                 if test_uuid in _test_purchases:
-                    del _test_purchases[test_uuid]
+                    _pop_pending("test", test_uuid)
             elif order_data:
                 with _order_lock:
                     if order_id in _active_orders:
                         _active_orders[order_id]["status"] = "failed"
+                        _reindex_pending_locked("order", order_id, _active_orders[order_id])
                         logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} помечен как failed")
         
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} [TEST] Критическая ошибка при обработке ссылки Steam: {e}", exc_info=True)
         if test_uuid and test_uuid in _test_purchases:
-            del _test_purchases[test_uuid]
+            _pop_pending("test", test_uuid)
 
 
 BIND_TO_PRE_INIT = [init_autosteam_cp]
@@ -4995,80 +7204,28 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
         message_text = str(event.message).strip()
         logger.debug(f"{LOGGER_PREFIX} [MOBILE] Обработка сообщения Mobile: chat_id={chat_id} (тип: {type(chat_id).__name__})")
         
-        if (message_text.startswith("❌ Неверный формат ссылки!") or 
-            message_text.startswith("❌ Это пример ссылки") or
-            message_text.startswith("🎮 Спасибо за покупку!") or
-            message_text.startswith("✅ Подарок успешно отправлен!") or
-            message_text.startswith("✅ Пополнение успешно отправлено!")):
-            return
-        
-        if ("xxxx-xxxx" in message_text or 
-            "Правильный формат:" in message_text or 
-            "Пример:" in message_text or
-            "Отправьте ссылку на добавление в друзья:" in message_text or
-            "Отправьте" in message_text and ":" in message_text and ("Player ID" in message_text or "ссылку" in message_text)):
-            return
-        
-        if ("https://s.team/p/..." in message_text or 
-            "https://s.team/p/xxxx" in message_text or
-            "/p/..." in message_text or
-            re.search(r'https?://s\.team/p/\.\.\.', message_text, re.IGNORECASE) or
-            "Ожидание ссылки..." in message_text or
-            "Ожидание данных..." in message_text):
-            return
-        
-        if ("🎮 Спасибо за покупку!" in message_text):
-            if ("Ожидание данных..." in message_text or 
-                "📦 Игра:" in message_text or
-                "💎 Позиция:" in message_text or
-                "📝 Отправьте" in message_text):
-                return
-        
-        if ("📦 Игра:" in message_text and "💎 Позиция:" in message_text):
-            if ("Ожидание данных..." in message_text or
-                "📝 Отправьте" in message_text):
-                return
-        
-        if ("🎮 Спасибо за покупку!" in message_text and 
-            "📦 Игра:" in message_text and 
-            "💎 Позиция:" in message_text and
-            ("Ожидание данных..." in message_text or "📝 Отправьте" in message_text)):
-            return
-        
         if message_text.startswith("!автовыда") or message_text.startswith("!автовыдача"):
             logger.info(f"{LOGGER_PREFIX} [MOBILE] Игнорируем команду '!автовыда' в обработчике Player ID")
             return
         
-        logger.info(f"{LOGGER_PREFIX} [MOBILE] Проверка сообщения на Player ID: chat_id={chat_id}, text='{message_text[:100]}'")
+        logger.debug(f"{LOGGER_PREFIX} [MOBILE] Проверка сообщения на Player ID: chat_id={chat_id}, text='{message_text[:100]}'")
         
         test_data = None
         test_uuid = None
         order_data = None
         order_id = None
         
-        for uuid_key, data in _test_purchases.items():
-            if (data.get("chat_id") == chat_id and 
-                data.get("status") == "waiting_player_id" and
-                data.get("type") == "mobile" and
-                time.time() - data.get("created_at", 0) < 600):
-                test_data = data
-                test_uuid = uuid_key
-                break
-        
-        if not test_data:
-            with _order_lock:
-                for oid, data in _active_orders.items():
-                    if (data.get("chat_id") == chat_id and 
-                        data.get("status") == "waiting_player_id" and
-                        data.get("type") == "mobile"):
-                        order_data = data
-                        order_id = oid
-                        break
-        
-        if not test_data and not order_data:
-            logger.info(f"{LOGGER_PREFIX} [MOBILE] Нет активной покупки Mobile в ожидании Player ID для чата {chat_id}")
+        pending = _find_pending(chat_id, "mobile_input")
+        if not pending:
+            logger.debug(f"{LOGGER_PREFIX} [MOBILE] Нет активной покупки Mobile в ожидании Player ID для чата {chat_id}")
             return
         
+        source, pending_key, pending_data = pending
+        if source == "test":
+            test_data, test_uuid = pending_data, pending_key
+        else:
+            order_data, order_id = pending_data, pending_key
+        
         if test_data and test_data.get("status") in ("completed", "failed"):
             logger.warning(f"{LOGGER_PREFIX} [MOBILE] Заказ уже завершен, статус: {test_data.get('status')}")
             return
@@ -5097,18 +7254,19 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
         
         logger.info(f"{LOGGER_PREFIX} [MOBILE] Получены данные: {user_data}")
         
-        settings = _get_storage().load_settings()
+        settings = _get_storage().settings_view()
         api_key = settings.get("desslyhub_api_key", "")
         
         if not api_key:
             logger.error(f"{LOGGER_PREFIX} [MOBILE] API ключ не установлен")
             cardinal.send_message(chat_id, "❌ Ошибка: API ключ не установлен", chat_name)
             if test_uuid:
-                del _test_purchases[test_uuid]
+                _pop_pending("test", test_uuid)
             elif order_id:
                 with _order_lock:
                     if order_id in _active_orders:
                         del _active_orders[order_id]
+                        _reindex_pending_locked("order", order_id, None)
             return
         
         if test_data:
@@ -5167,11 +7325,12 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
             logger.error(f"{LOGGER_PREFIX} [MOBILE] position_id не найден")
             cardinal.send_message(chat_id, "❌ Ошибка: Позиция не найдена", chat_name)
             if test_uuid:
-                del _test_purchases[test_uuid]
+                _pop_pending("test", test_uuid)
             elif order_id:
                 with _order_lock:
                     if order_id in _active_orders:
                         del _active_orders[order_id]
+                        _reindex_pending_locked("order", order_id, None)
             return
         
         fields = {}
@@ -5214,16 +7373,25 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
         
         if test_data:
             test_data["status"] = "sending_refill"
+            _reindex_pending("test", test_uuid, test_data)
             reference = test_uuid_ref
         elif order_data:
             with _order_lock:
                 if order_id in _active_orders:
                     _active_orders[order_id]["status"] = "sending_refill"
+                    _reindex_pending_locked("order", order_id, _active_orders[order_id])
             reference = order_id
         else:
             return
         
-        result = _send_mobile_refill(api_key, position_id, fields, reference=reference)
+        ledger = _get_balance_ledger()
+        ledger_key = f"order:{order_id}" if order_data else f"test:{test_uuid}"
+        expected_price = test_data.get("position_price") if test_data else order_data.get("position_price")
+        if expected_price and expected_price != "N/A":
+            ledger.reserve(ledger_key, expected_price)
+        
+        with _get_order_scheduler().stage("gift"):
+            result = _send_mobile_refill(api_key, position_id, fields, reference=reference)
         
         if result and result.get("error_code") is None:
             transaction_id = result.get("transaction_id")
@@ -5237,6 +7405,7 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
                 position_price_float = float(position_price) if position_price and position_price != "N/A" else None
             except:
                 position_price_float = None
+            ledger.debit(ledger_key, position_price_float)
             
             try:
                 api = DesslyHubAPI(api_key)
@@ -5246,6 +7415,7 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
                     if final_amount:
                         try:
                             final_amount = float(final_amount)
+                            ledger.settle(ledger_key, final_amount)
                             logger.info(f"{LOGGER_PREFIX} [MOBILE] Получен final_amount из транзакции: {final_amount:.4f} USD")
                             if position_price_float:
                                 commission = final_amount - position_price_float
@@ -5281,7 +7451,7 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
                 )
             
             storage = _get_storage()
-            templates = storage.load_templates()
+            templates = storage.templates_view()
             success_template = templates.get("success_mobile_template",
                 "✅ Пополнение успешно отправлено!\n\n🎮 Игра: {game_name}\n💎 Позиция: {position_name}\n{field_labels}{server_text}🆔 Transaction ID: {transaction_id}\n📊 Статус: {status}\n\n{order_link}🙏 Спасибо за покупку! Приятной игры!{admin_call_message}")
             
@@ -5300,19 +7470,20 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
             
             if test_data:
                 test_data["status"] = "completed"
+                _reindex_pending("test", test_uuid, test_data)
                 test_data["transaction_id"] = transaction_id
                 logger.info(f"{LOGGER_PREFIX} [MOBILE] Тестовая покупка Mobile успешно завершена: UUID={test_uuid}")
             elif order_data:
                 with _order_lock:
                     if order_id in _active_orders:
                         _active_orders[order_id]["status"] = "completed"
+                        _reindex_pending_locked("order", order_id, _active_orders[order_id])
                         _active_orders[order_id]["transaction_id"] = transaction_id
                 logger.info(f"{LOGGER_PREFIX} [ORDER] [MOBILE] Заказ {order_id} успешно завершен")
             
             
             try:    
                 storage = _get_storage()
-                orders = storage.load_orders()
                 
                 player_id_value = list(fields_data.values())[0] if fields_data else user_data
                 
@@ -5320,6 +7491,7 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
                     "order_id": order_id if order_id else f"MOBILE-{test_uuid[:8] if test_uuid else 'UNKNOWN'}",
                     "type": "mobile_refill",
                     "game_name": game_name,
+                    "lot_name": ((order_data or {}).get("lot_config") or {}).get("lot_name", "").strip() or None,
                     "position_name": position_name,
                     "price": float(final_amount) if final_amount else (position_price_float if position_price_float else None),
                     "player_id": player_id_value,
@@ -5331,17 +7503,17 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
                     "timestamp": time.time(),
                     "uuid": test_uuid if test_uuid else None
                 }
-                orders.append(order_info)
-                storage.save_orders(orders)
+                storage.append_order(order_info)
                 logger.info(f"{LOGGER_PREFIX} [MOBILE] Заказ сохранен в историю")
             except Exception as e:
                 logger.error(f"{LOGGER_PREFIX} [MOBILE] Ошибка сохранения заказа в историю: {e}")
             
             if test_uuid and test_uuid in _test_purchases:
-                del _test_purchases[test_uuid]
+                _pop_pending("test", test_uuid)
                 logger.info(f"{LOGGER_PREFIX} [MOBILE] UUID {test_uuid} удален после успешной обработки")
         else:
             error_code = result.get("error_code") if result else None
+            ledger.release(ledger_key)
             
             error_descriptions = {
                 -200: "❌ Мобильная игра не найдена.",
@@ -5358,10 +7530,11 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
                 position_price = (test_data.get("position_price", "N/A") if test_data 
                                 else (order_data.get("position_price", "N/A") if order_data else "N/A"))
                 logger.error(f"{LOGGER_PREFIX} [MOBILE] Недостаточно средств на балансе. Требуется: {position_price} USD")
+                ledger.refresh_async(api_key)
                 if hasattr(cardinal, 'telegram') and hasattr(cardinal.telegram, 'bot'):
                     try:
                         storage = _get_storage()
-                        admin_id = storage.load_settings().get("admin_id")
+                        admin_id = storage.settings_view().get("admin_id")
                         if admin_id:
                             balance_msg = f"⚠️ Недостаточно средств на балансе"
                             if position_price and position_price != "N/A":
@@ -5374,11 +7547,12 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
             logger.error(f"{LOGGER_PREFIX} [MOBILE] Не удалось отправить пополнение: error_code={error_code}")
             if test_uuid and test_uuid in _test_purchases:
                 test_data["status"] = "failed"
-                del _test_purchases[test_uuid]
+                _pop_pending("test", test_uuid)
             elif order_id:
                 with _order_lock:
                     if order_id in _active_orders:
                         _active_orders[order_id]["status"] = "failed"
+                        _reindex_pending_locked("order", order_id, _active_orders[order_id])
         
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} [MOBILE] Критическая ошибка при обработке Player ID: {e}", exc_info=True)
@@ -5386,6 +7560,194 @@ def handle_mobile_player_id_message(cardinal: "Cardinal", event: NewMessageEvent
 
 _active_orders = {}
 _order_lock = threading.Lock()
+_pending_deliveries: dict[tuple[str, str], dict[tuple[str, object], None]] = {}
+_pending_keys: dict[tuple[str, object], tuple[str, str]] = {}
+PENDING_KINDS = {
+    "waiting_link": "steam_link",
+    "waiting_player_id": "mobile_input"
+}
+
+
+def _reindex_pending_locked(source: str, key, data: dict | None) -> None:
+    """Обновляет индекс ожидающих выдач; вызывается под _order_lock"""
+    ref = (source, key)
+    old_index_key = _pending_keys.pop(ref, None)
+    if old_index_key:
+        refs = _pending_deliveries.get(old_index_key)
+        if refs is not None:
+            refs.pop(ref, None)
+            if not refs:
+                del _pending_deliveries[old_index_key]
+    
+    if not data:
+        return
+    kind = PENDING_KINDS.get(data.get("status"))
+    chat_id = data.get("chat_id")
+    if not kind or chat_id is None or chat_id == "":
+        return
+    
+    index_key = (str(chat_id), kind)
+    _pending_deliveries.setdefault(index_key, {})[ref] = None
+    _pending_keys[ref] = index_key
+
+
+def _reindex_pending(source: str, key, data: dict | None) -> None:
+    with _order_lock:
+        _reindex_pending_locked(source, key, data)
+
+
+def _pop_pending(source: str, key) -> dict | None:
+    with _order_lock:
+        store = _test_purchases if source == "test" else _active_orders
+        data = store.pop(key, None)
+        _reindex_pending_locked(source, key, None)
+    _get_balance_ledger().release(f"{source}:{key}")
+    return data
+
+
+def _find_pending(chat_id, kind: str) -> tuple[str, object, dict] | None:
+    """Ищет ожидающую выдачу для чата: сначала тестовые покупки, затем заказы"""
+    index_key = (str(chat_id), kind)
+    with _order_lock:
+        refs = _pending_deliveries.get(index_key)
+        if not refs:
+            return None
+        
+        for wanted_source in ("test", "order"):
+            for source, key in list(refs):
+                if source != wanted_source:
+                    continue
+                store = _test_purchases if source == "test" else _active_orders
+                data = store.get(key)
+                if (not data or PENDING_KINDS.get(data.get("status")) != kind
+                        or str(data.get("chat_id")) != index_key[0]):
+                    _reindex_pending_locked(source, key, data)
+                    continue
+                if source == "test" and time.time() - data.get("created_at", 0) >= 600:
+                    continue
+                return source, key, data
+    return None
+
+
+class OrderScheduler:
+    """Планировщик заказов: ограниченный пул потоков, очередь с приоритетом и лимиты по этапам"""
+    
+    def __init__(self, workers: int, max_queue: int, stage_limits: dict[str, int]):
+        self.workers = max(1, workers)
+        self._queue: queue.PriorityQueue = queue.PriorityQueue(maxsize=max_queue)
+        self._seq = itertools.count()
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._stages = {name: threading.BoundedSemaphore(limit) for name, limit in stage_limits.items()}
+        self._stage_limits = dict(stage_limits)
+        self._stage_stats = {name: {"active": 0, "waiting": 0, "calls": 0, "wait_total": 0.0} for name in stage_limits}
+        self._metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "running": 0,
+            "high_water": 0
+        }
+    
+    def _ensure_workers(self) -> None:
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._worker, daemon=True, name=f"AS-OrderWorker-{i + 1}")
+                thread.start()
+                self._threads.append(thread)
+    
+    def submit(self, fn, *args, priority: int = 10, name: str = "") -> bool:
+        """Ставит задачу в очередь, возвращает False при переполнении"""
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((priority, next(self._seq), name, fn, args))
+        except queue.Full:
+            with self._lock:
+                self._metrics["rejected"] += 1
+            logger.error(f"{LOGGER_PREFIX} [ORDER] Очередь заказов переполнена ({self._queue.maxsize}), задача '{name}' отклонена")
+            return False
+        
+        with self._lock:
+            self._metrics["submitted"] += 1
+            depth = self._queue.qsize()
+            if depth > self._metrics["high_water"]:
+                self._metrics["high_water"] = depth
+        logger.debug(f"{LOGGER_PREFIX} [ORDER] Задача '{name}' поставлена в очередь (приоритет={priority}, глубина={depth})")
+        return True
+    
+    def _worker(self) -> None:
+        while True:
+            priority, _, name, fn, args = self._queue.get()
+            with self._lock:
+                self._metrics["running"] += 1
+            try:
+                fn(*args)
+                with self._lock:
+                    self._metrics["completed"] += 1
+            except Exception as e:
+                with self._lock:
+                    self._metrics["failed"] += 1
+                logger.error(f"{LOGGER_PREFIX} [ORDER] Ошибка в задаче '{name}': {e}", exc_info=True)
+            finally:
+                with self._lock:
+                    self._metrics["running"] -= 1
+                self._queue.task_done()
+    
+    @contextmanager
+    def stage(self, name: str):
+        """Ограничивает число одновременных операций этапа (chat, catalog, gift)"""
+        semaphore = self._stages.get(name)
+        if semaphore is None:
+            yield
+            return
+        
+        stats = self._stage_stats[name]
+        started = time.time()
+        with self._lock:
+            stats["waiting"] += 1
+        semaphore.acquire()
+        with self._lock:
+            stats["waiting"] -= 1
+            stats["active"] += 1
+            stats["calls"] += 1
+            stats["wait_total"] += time.time() - started
+        try:
+            yield
+        finally:
+            with self._lock:
+                stats["active"] -= 1
+            semaphore.release()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            result = dict(self._metrics)
+            result["queued"] = self._queue.qsize()
+            result["workers"] = self.workers
+            result["stages"] = {}
+            for name, stats in self._stage_stats.items():
+                calls = stats["calls"]
+                result["stages"][name] = {
+                    "active": stats["active"],
+                    "waiting": stats["waiting"],
+                    "limit": self._stage_limits[name],
+                    "avg_wait": stats["wait_total"] / calls if calls else 0.0
+                }
+            return result
+
+
+_order_scheduler: OrderScheduler | None = None
+_order_scheduler_lock = threading.Lock()
+
+
+def _get_order_scheduler() -> OrderScheduler:
+    global _order_scheduler
+    if _order_scheduler is None:
+        with _order_scheduler_lock:
+            if _order_scheduler is None:
+                _order_scheduler = OrderScheduler(ORDER_WORKERS, ORDER_QUEUE_MAX, ORDER_STAGE_LIMITS)
+    return _order_scheduler
 
 
 def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
@@ -5406,7 +7768,7 @@ def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
             return
         
         storage = _get_storage()
-        settings = storage.load_settings()
+        settings = storage.settings_view()
         
         if not settings.get("active", False):
             logger.info(f"{LOGGER_PREFIX} [ORDER] Плагин неактивен, пропускаем заказ {order_id}")
@@ -5417,7 +7779,7 @@ def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
             logger.warning(f"{LOGGER_PREFIX} [ORDER] API ключ не установлен, пропускаем заказ {order_id}")
             return
         
-        lots_config = storage.load_lots_config()
+        lots_config = storage.lots_config_view()
         if not lots_config:
             logger.info(f"{LOGGER_PREFIX} [ORDER] Конфиг лотов пуст, пропускаем заказ {order_id}")
             return
@@ -5427,36 +7789,23 @@ def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
             logger.warning(f"{LOGGER_PREFIX} [ORDER] Не удалось определить название лота для заказа {order_id}")
             return
         
-        lot_name_lower = lot_name.lower().strip()
         lot_config = None
         
-        exact_match = None
+        exact_match = storage.find_lot_config(lot_name)
         partial_matches = []
         
-        for config in lots_config:
-            config_lot_name = config.get("lot_name", "").strip()
-            if not config_lot_name:
-                continue
-            
-            config_lot_name_lower = config_lot_name.lower()
-            
-            if config_lot_name_lower == lot_name_lower:
-                exact_match = config
-                logger.info(f"{LOGGER_PREFIX} [ORDER] Найдено точное совпадение: '{config_lot_name}' == '{lot_name}'")
-                break
-            elif config_lot_name_lower in lot_name_lower:
-                partial_matches.append((len(config_lot_name), config, config_lot_name))
-                logger.debug(f"{LOGGER_PREFIX} [ORDER] Найдено частичное совпадение: '{config_lot_name}' содержится в '{lot_name}' (длина: {len(config_lot_name)})")
-            elif lot_name_lower in config_lot_name_lower:
+        if not exact_match:
+            for config in storage.lot_matcher().partial_matches(lot_name):
+                config_lot_name = config.get("lot_name", "").strip()
                 partial_matches.append((len(config_lot_name), config, config_lot_name))
-                logger.debug(f"{LOGGER_PREFIX} [ORDER] Найдено частичное совпадение: '{lot_name}' содержится в '{config_lot_name}' (длина: {len(config_lot_name)})")
+                logger.debug(f"{LOGGER_PREFIX} [ORDER] Найдено частичное совпадение: '{config_lot_name}' и '{lot_name}' (длина: {len(config_lot_name)})")
         
         if exact_match:
             lot_config = exact_match
             logger.info(f"{LOGGER_PREFIX} [ORDER] Используется точное совпадение: '{lot_config.get('lot_name')}'")
         elif partial_matches:
             partial_matches.sort(key=lambda x: x[0], reverse=True)
-            lot_config = partial_matches[0][1]
+            lot_config = dict(partial_matches[0][1])
             matched_name = partial_matches[0][2]
             logger.info(f"{LOGGER_PREFIX} [ORDER] Используется самое длинное частичное совпадение: '{matched_name}' (длина: {partial_matches[0][0]}) из {len(partial_matches)} совпадений")
             if len(partial_matches) > 1:
@@ -5466,6 +7815,8 @@ def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
             logger.info(f"{LOGGER_PREFIX} [ORDER] Конфиг для лота '{lot_name}' не найден, пропускаем заказ {order_id}")
             return
         
+        _get_price_sync_scheduler().note_sale(lot_config.get("lot_name", "").strip())
+        
         with _order_lock:
             if order_id in _active_orders:
                 logger.warning(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} уже обрабатывается")
@@ -5475,13 +7826,40 @@ def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
                 "started_at": time.time()
             }
         
-        thread = threading.Thread(
-            target=_process_order_thread,
-            args=(cardinal, order, lot_config, api_key, storage),
-            daemon=True,
+        try:
+            priority = int(lot_config.get("priority", 10))
+        except (ValueError, TypeError):
+            priority = 10
+        
+        queued = _get_order_scheduler().submit(
+            _process_order_thread, cardinal, order, lot_config, api_key, storage,
+            priority=priority,
             name=f"Order-{order_id}"
         )
-        thread.start()
+        if not queued:
+            _pop_pending("order", order_id)
+            try:
+                cardinal.send_message(
+                    order.chat_id,
+                    "⏳ Сейчас очень много заказов, автовыдача не успевает. Администратор выдаст ваш заказ вручную, пожалуйста, подождите.",
+                    order.buyer_username
+                )
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} [ORDER] Не удалось уведомить покупателя о заказе {order_id}: {e}")
+            admin_id = settings.get("admin_id")
+            if admin_id and hasattr(cardinal, 'telegram') and hasattr(cardinal.telegram, 'bot'):
+                try:
+                    message = (
+                        f"🚨 <b>Заказ не поставлен в очередь автовыдачи</b>\n\n"
+                        f"🧾 <b>Заказ:</b> <a href=\"https://funpay.com/orders/{order_id}/\">#{order_id}</a>\n"
+                        f"👤 <b>Покупатель:</b> <code>{order.buyer_username}</code>\n"
+                        f"📦 <b>Лот:</b> <code>{lot_config.get('lot_name', '')}</code>\n\n"
+                        f"Очередь переполнена ({ORDER_QUEUE_MAX}), выдайте заказ вручную."
+                    )
+                    cardinal.telegram.bot.send_message(int(admin_id), message, parse_mode="HTML")
+                except Exception as e:
+                    logger.error(f"{LOGGER_PREFIX} [ORDER] Ошибка отправки уведомления о переполнении очереди: {e}")
+            return
         logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} поставлен в очередь обработки")
         
     except Exception as e:
@@ -5489,7 +7867,7 @@ def handle_new_order(cardinal: "Cardinal", event: NewOrderEvent) -> None:
 
 
 def _process_order_thread(cardinal: "Cardinal", order, lot_config: dict, api_key: str, storage: Storage) -> None:
-    """Обработка заказа в отдельном потоке"""
+    """Обработка заказа в потоке пула заказов"""
     order_id = order.id
     try:
         logger.info(f"{LOGGER_PREFIX} [ORDER] Начало обработки заказа {order_id} в потоке")
@@ -5502,7 +7880,8 @@ def _process_order_thread(cardinal: "Cardinal", order, lot_config: dict, api_key
         
         for attempt in range(3):
             try:
-                chat_obj = cardinal.account.get_chat_by_name(chat_name, True)
+                with _get_order_scheduler().stage("chat"):
+                    chat_obj = cardinal.account.get_chat_by_name(chat_name, True)
                 numeric_chat_id = getattr(chat_obj, "id", None)
                 if numeric_chat_id:
                     chat_id = str(numeric_chat_id)
@@ -5552,9 +7931,60 @@ def _process_order_thread(cardinal: "Cardinal", order, lot_config: dict, api_key
         with _order_lock:
             if order_id in _active_orders:
                 _active_orders[order_id]["status"] = "failed"
+                _reindex_pending_locked("order", order_id, _active_orders[order_id])
         logger.info(f"{LOGGER_PREFIX} [ORDER] Завершена обработка заказа {order_id} с ошибкой")
 
 
+def _reconcile_transaction(api_key: str, transaction_id, ledger_key: str, expected_price, order_info: dict | None) -> None:
+    """Фоновая сверка отправленного подарка по final_amount транзакции: баланс и цена заказа в истории"""
+    try:
+        transaction_info = DesslyHubAPI(api_key).get_transaction(transaction_id)
+        final_amount = transaction_info.get("final_amount") if isinstance(transaction_info, dict) else None
+        if not final_amount:
+            return
+        final_amount = float(final_amount)
+    except Exception as e:
+        logger.warning(f"{LOGGER_PREFIX} [ORDER] Не удалось получить информацию о транзакции {transaction_id}: {e}")
+        return
+    
+    _get_balance_ledger().settle(ledger_key, final_amount)
+    logger.info(f"{LOGGER_PREFIX} [ORDER] Получен final_amount из транзакции {transaction_id}: {final_amount:.4f} USD")
+    if expected_price:
+        commission = final_amount - float(expected_price)
+        logger.info(f"{LOGGER_PREFIX} [ORDER] Цена игры: {float(expected_price):.4f} USD, Комиссия: {commission:.4f} USD, Итого: {final_amount:.4f} USD")
+    
+    if order_info is not None and order_info.get("price") != final_amount:
+        try:
+            _get_storage().append_order(dict(order_info, price=final_amount))
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} [ORDER] Ошибка обновления цены заказа в истории: {e}")
+
+
+def _pin_steam_package(api_key: str, order_id, app_id, region: str, game_name: str, lot_config: dict) -> None:
+    """Выбирает издание и ожидаемую цену, пока покупатель присылает ссылку"""
+    with _order_lock:
+        package_id = (_active_orders.get(order_id) or {}).get("package_id")
+    with _get_order_scheduler().stage("catalog"):
+        package_info = _get_package_id_by_app_id(api_key, app_id, region=region, game_name=game_name,
+                                                 lot_name=lot_config.get("lot_name", ""), package_id=package_id)
+    if not package_info or not package_info.get("package_id"):
+        logger.warning(f"{LOGGER_PREFIX} [ORDER] [STEAM] Не удалось заранее выбрать издание для заказа {order_id}, выберем при получении ссылки")
+        return
+    
+    with _order_lock:
+        order_data = _active_orders.get(order_id)
+        if order_data is None or order_data.get("status") != "waiting_link":
+            return
+        order_data["package_id"] = package_info["package_id"]
+        order_data["edition"] = package_info.get("edition")
+        order_data["expected_price"] = package_info.get("price")
+        order_data["package_pinned_at"] = time.time()
+        _reindex_pending_locked("order", order_id, order_data)
+        if package_info.get("price"):
+            _get_balance_ledger().reserve(f"order:{order_id}", package_info["price"])
+    logger.info(f"{LOGGER_PREFIX} [ORDER] [STEAM] Для заказа {order_id} выбрано издание '{package_info.get('edition')}' (package_id={package_info['package_id']}, {package_info.get('price')} USD)")
+
+
 def _process_steam_gift_order(cardinal: "Cardinal", order, lot_config: dict, game_name: str, region: str, 
                                api_key: str, chat_id: str, chat_name: str, storage: Storage) -> None:
     """Обработка заказа Steam Gift"""
@@ -5562,14 +7992,22 @@ def _process_steam_gift_order(cardinal: "Cardinal", order, lot_config: dict, gam
     try:
         logger.info(f"{LOGGER_PREFIX} [ORDER] [STEAM] Обработка заказа {order_id}: игра={game_name}, регион={region}")
         
-        app_id = _get_game_app_id_by_name(game_name, api_key)
+        binding = _get_lot_binding(lot_config, api_key) or {}
+        app_id = binding.get("app_id")
+        if app_id:
+            logger.debug(f"{LOGGER_PREFIX} [ORDER] [STEAM] Использована привязка лота: app_id={app_id}, package_id={binding.get('package_id')}")
+        else:
+            with _get_order_scheduler().stage("catalog"):
+                app_id = _get_game_app_id_by_name(game_name, api_key)
+            if app_id:
+                _save_lot_binding(lot_config, app_id=app_id)
         if not app_id:
             logger.error(f"{LOGGER_PREFIX} [ORDER] [STEAM] Не удалось найти app_id для игры '{game_name}'")
             cardinal.send_message(chat_id, f"❌ Ошибка: Игра '{game_name}' не найдена", chat_name)
             return
         
         storage = _get_storage()
-        templates = storage.load_templates()
+        templates = storage.templates_view()
         welcome_template = templates.get("welcome_steam_template",
             "🎮 Спасибо за покупку!\n\n📦 Игра: {game_name}\n🌍 Регион: {region}\n\n🔗 Отправьте ссылку на добавление в друзья:\nhttps://s.team/p/...\n\n⏱ Ожидание ссылки...")
         
@@ -5589,6 +8027,7 @@ def _process_steam_gift_order(cardinal: "Cardinal", order, lot_config: dict, gam
                 "type": "steam",
                 "game_name": game_name,
                 "app_id": app_id,
+                "package_id": binding.get("package_id") if binding.get("region") == region else None,
                 "region": region,
                 "status": "waiting_link",
                 "created_at": time.time(),
@@ -5597,13 +8036,16 @@ def _process_steam_gift_order(cardinal: "Cardinal", order, lot_config: dict, gam
             
             with _order_lock:
                 _active_orders[order_id] = order_data
+                _reindex_pending_locked("order", order_id, _active_orders[order_id])
                 logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} сохранен в _active_orders: chat_id={order_data['chat_id']}, status={order_data['status']}, всего заказов: {len(_active_orders)}")
-                logger.info(f"{LOGGER_PREFIX} [ORDER] Содержимое _active_orders: {list(_active_orders.keys())}")
+            
+            _pin_steam_package(api_key, order_id, app_id, region, game_name, lot_config)
         else:
             logger.error(f"{LOGGER_PREFIX} [ORDER] [STEAM] Не удалось отправить сообщение для заказа {order_id}")
             with _order_lock:
                 if order_id in _active_orders:
                     _active_orders[order_id]["status"] = "failed"
+                    _reindex_pending_locked("order", order_id, _active_orders[order_id])
                     logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} помечен как failed - не удалось отправить сообщение")
             
     except Exception as e:
@@ -5611,6 +8053,7 @@ def _process_steam_gift_order(cardinal: "Cardinal", order, lot_config: dict, gam
         with _order_lock:
             if order_id in _active_orders:
                 _active_orders[order_id]["status"] = "failed"
+                _reindex_pending_locked("order", order_id, _active_orders[order_id])
                 logger.info(f"{LOGGER_PREFIX} [ORDER] Заказ {order_id} помечен как failed из-за исключения")
 
 
@@ -5621,13 +8064,20 @@ def _process_mobile_refill_order(cardinal: "Cardinal", order, lot_config: dict,
     try:
         logger.info(f"{LOGGER_PREFIX} [ORDER] [MOBILE] Обработка заказа {order_id}: игра={game_name}, количество={amount}")
         
-        game_id = _get_mobile_game_id_by_name(game_name, api_key)
+        binding = _get_lot_binding(lot_config, api_key) or {}
+        game_id = binding.get("game_id")
+        if not game_id:
+            with _get_order_scheduler().stage("catalog"):
+                game_id = _get_mobile_game_id_by_name(game_name, api_key)
+            if game_id:
+                _save_lot_binding(lot_config, game_id=game_id)
         if not game_id:
             logger.error(f"{LOGGER_PREFIX} [ORDER] [MOBILE] Не удалось найти game_id для игры '{game_name}'")
             cardinal.send_message(chat_id, f"❌ Ошибка: Игра '{game_name}' не найдена", chat_name)
             return
         
-        game_info = _get_mobile_game_by_id(api_key, game_id)
+        with _get_order_scheduler().stage("catalog"):
+            game_info = _get_mobile_game_by_id(api_key, game_id)
         if not game_info:
             logger.error(f"{LOGGER_PREFIX} [ORDER] [MOBILE] Не удалось получить информацию об игре game_id={game_id}")
             cardinal.send_message(chat_id, f"❌ Ошибка: Не удалось получить информацию об игре '{game_name}'", chat_name)
@@ -5696,7 +8146,7 @@ def _process_mobile_refill_order(cardinal: "Cardinal", order, lot_config: dict,
         
         field_name = fields_to_request[0]
         
-        templates = storage.load_templates()
+        templates = storage.templates_view()
         welcome_template = templates.get("welcome_mobile_template",
             "🎮 Спасибо за покупку!\n\n📦 Игра: {game_name}\n💎 Позиция: {position_name}\n\n📝 Отправьте {field_name}:\n\n⏱ Ожидание данных...")
         
@@ -5735,6 +8185,9 @@ def _process_mobile_refill_order(cardinal: "Cardinal", order, lot_config: dict,
             
             with _order_lock:
                 _active_orders[order_id] = order_data
+                _reindex_pending_locked("order", order_id, _active_orders[order_id])
+            if position_price and position_price != "N/A":
+                _get_balance_ledger().reserve(f"order:{order_id}", position_price)
         else:
             logger.error(f"{LOGGER_PREFIX} [ORDER] [MOBILE] Не удалось отправить сообщение для заказа {order_id}")
             
@@ -5771,7 +8224,7 @@ def handle_admin_call_message(cardinal: "Cardinal", event: NewMessageEvent) -> N
             return
         
         storage = _get_storage()
-        settings = storage.load_settings()
+        settings = storage.settings_view()
         admin_id = settings.get("admin_id", "")
         
         if not admin_id:
@@ -5815,5 +8268,66 @@ def handle_admin_call_message(cardinal: "Cardinal", event: NewMessageEvent) -> N
         logger.error(f"{LOGGER_PREFIX} [ADMIN_CALL] Критическая ошибка: {e}", exc_info=True)
 
 
-BIND_TO_NEW_MESSAGE = [handle_test_purchase_message, handle_friend_link_message, handle_mobile_player_id_message, handle_admin_call_message]
+MESSAGE_ROUTES = {
+    "test_command": handle_test_purchase_message,
+    "admin_command": handle_admin_call_message,
+    "steam_link": handle_friend_link_message,
+    "mobile_input": handle_mobile_player_id_message
+}
+
+
+def _classify_message(cardinal: "Cardinal", event: NewMessageEvent) -> tuple[list[str], str]:
+    """Классифицирует сообщение один раз: system/own/echo/команда/ожидаемый ввод/idle"""
+    if not cardinal or not hasattr(cardinal, 'account') or not hasattr(cardinal.account, 'id'):
+        return ["system"], ""
+    
+    message = event.message
+    if message.author_id == 0:
+        return ["system"], ""
+    if message.author_id == cardinal.account.id:
+        return ["own"], ""
+    
+    message_type = getattr(message, "type", None)
+    if message_type is None and hasattr(message, "get_message_type"):
+        message_type = message.get_message_type()
+    if message_type and message_type != MessageTypes.NON_SYSTEM:
+        return ["system"], ""
+    
+    message_text = str(message).strip()
+    if not message_text:
+        return ["idle"], message_text
+    
+    if message_text.startswith("!автовыда"):
+        return ["test_command"], message_text
+    if message_text.lower() == "!позвать":
+        return ["admin_command"], message_text
+    
+    chat_id = str(message.chat_id)
+    kinds = [kind for kind in ("steam_link", "mobile_input") if (chat_id, kind) in _pending_deliveries]
+    if not kinds:
+        return ["idle"], message_text
+    
+    if _is_template_echo(message_text):
+        return ["echo"], message_text
+    
+    return kinds, message_text
+
+
+def handle_new_message(cardinal: "Cardinal", event: NewMessageEvent) -> None:
+    """Единый обработчик новых сообщений: классификация и маршрутизация"""
+    try:
+        kinds, message_text = _classify_message(cardinal, event)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка классификации сообщения: {e}", exc_info=True)
+        return
+    
+    for kind in kinds:
+        handler = MESSAGE_ROUTES.get(kind)
+        if handler is None:
+            continue
+        logger.debug(f"{LOGGER_PREFIX} Сообщение в чате {event.message.chat_id} классифицировано как '{kind}'")
+        handler(cardinal, event)
+
+
+BIND_TO_NEW_MESSAGE = [handle_new_message]
 BIND_TO_NEW_ORDER = [handle_new_order]